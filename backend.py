@@ -0,0 +1,35 @@
+"""
+description: matplotlib backend selection for headless machines. The plots
+are only saved to file, but the default interactive backend fails without a
+display, and lmfit imports matplotlib.pyplot as soon as it is imported, so
+the backend has to be chosen before lmfit or pyplot are first imported
+author: Rohan Isaac
+"""
+import os
+import sys
+
+
+def has_display():
+    """ If windows can be opened, always true on Windows and macOS """
+    if sys.platform in ('win32', 'cygwin', 'darwin'):
+        return True
+    return bool(os.environ.get('DISPLAY') or
+                os.environ.get('WAYLAND_DISPLAY'))
+
+
+def select_backend(backend='Agg'):
+    """
+    Use `backend` if there is no display, unless a backend was chosen with
+    the MPLBACKEND environment variable or pyplot is already imported
+
+    Returns
+    -------
+    selected : bool
+        if the backend was changed
+    """
+    if ('MPLBACKEND' in os.environ or has_display() or
+            'matplotlib.pyplot' in sys.modules):
+        return False
+    import matplotlib
+    matplotlib.use(backend)
+    return True
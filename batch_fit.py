@@ -0,0 +1,407 @@
+"""
+description: vectorized fitting engine for stacks of brillouin spectra. Fits
+N spectra at once with the same fixed-layout lorentzian + constant model used
+by `brillouin.fit_file`, using numpy residuals, an analytic jacobian and a
+batched Levenberg-Marquardt solver
+author: Rohan Isaac
+"""
+from __future__ import division
+import numpy as np
+from numpy import pi
+
+# fixed layout of a 256 channel spectrum, same as `brillouin.fit_file`
+LASER_POS = [4, 127, 253]
+WINDOWS = [(21, 110), (146, 235)]
+
+
+def lorentzians(x, p):
+    """
+    Sum of lorentzian peaks on a constant background
+
+    Parameters
+    ----------
+    x : array (points,)
+        x-data shared by all spectra
+    p : array (N, 3 * peaks + 1)
+        amplitude, center, sigma for each peak followed by the background
+
+    Returns
+    -------
+    y : array (N, points)
+    """
+    a = p[:, 0:-1:3, None]
+    c = p[:, 1:-1:3, None]
+    s = p[:, 2:-1:3, None]
+    d = x - c
+    return (a / pi * s / (d * d + s * s)).sum(axis=1) + p[:, -1:]
+
+
+def lorentzians_jac(x, p):
+    """
+    Analytic jacobian of `lorentzians`, array (N, 3 * peaks + 1, points)
+    """
+    a = p[:, 0:-1:3, None]
+    c = p[:, 1:-1:3, None]
+    s = p[:, 2:-1:3, None]
+    d = x - c
+    inv = 1 / (d * d + s * s)
+    lor = s * inv / pi
+    jac = np.empty((p.shape[0], p.shape[1], len(x)))
+    jac[:, 0:-1:3] = lor
+    jac[:, 1:-1:3] = 2 * a * lor * d * inv
+    jac[:, 2:-1:3] = a * inv * (1 / pi - 2 * s * lor)
+    jac[:, -1] = 1
+    return jac
+
+
+def levenberg_marquardt(func, jac, p0, y, weights=None, lower=None,
+                        upper=None, max_iter=200, tol=1e-5, lambda0=1e-3):
+    """
+    Minimize sum(((func(p) - y) * weights)**2) for every row of `y` at once.
+    Each spectrum keeps its own damping factor and stops iterating once it
+    has converged, so easy spectra do not pay for hard ones.
+
+    Parameters
+    ----------
+    func, jac : callable
+        func(p) -> (n, points) model, jac(p) -> (n, params, points) jacobian
+        for a subset p (n, params) of the parameter rows
+    p0 : array (N, params)
+        initial parameters
+    y : array (N, points)
+        data
+    weights : array (N, points) (default=None)
+        residual weights, 0 excludes a point from the fit
+    lower, upper : array (N, params) (default=None)
+        parameters are clipped to these bounds after every step
+    max_iter : int (default=200)
+        maximum number of iterations per spectrum
+    tol : float (default=1e-5)
+        relative decrease in chi-square at which a spectrum is converged
+
+    Returns
+    -------
+    p : array (N, params)
+        best fit parameters
+    cost : array (N,)
+        chi-square at the best fit
+    nfev : array (N,)
+        number of model evaluations per spectrum
+    success : array (N,) of bool
+        if the fit converged within `max_iter`
+    """
+    p = np.array(p0, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n, m = p.shape
+    if weights is None:
+        weights = np.ones_like(y)
+    if lower is not None:
+        p = np.maximum(p, lower)
+    if upper is not None:
+        p = np.minimum(p, upper)
+    diag = np.arange(m)
+
+    r = (func(p) - y) * weights
+    cost = (r * r).sum(axis=1)
+    lam = np.full(n, lambda0)
+    nfev = np.ones(n, dtype=int)
+    success = np.zeros(n, dtype=bool)
+    active = np.arange(n)
+
+    for it in range(max_iter):
+        if not active.size:
+            break
+        pa = p[active]
+        w = weights[active]
+        J = jac(pa) * w[:, None, :]
+        A = np.matmul(J, J.transpose(0, 2, 1))
+        g = np.matmul(J, r[active][:, :, None])[:, :, 0]
+
+        # parameters sitting on a bound and pushed outwards are held fixed
+        # for this step, otherwise the clipped step crawls along the bound
+        held = np.zeros(pa.shape, dtype=bool)
+        if lower is not None:
+            held |= (pa <= lower[active]) & (g > 0)
+        if upper is not None:
+            held |= (pa >= upper[active]) & (g < 0)
+        A[held[:, :, None] | held[:, None, :]] = 0
+        g[held] = 0
+
+        # marquardt scaling of the diagonal, floored for unused parameters
+        scale = np.maximum(A[:, diag, diag], 1e-12)
+        A[:, diag, diag] += lam[active, None] * scale
+        try:
+            step = np.linalg.solve(A, -g[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.matmul(np.linalg.pinv(A), -g[:, :, None])[:, :, 0]
+
+        trial = pa + step
+        if lower is not None:
+            trial = np.maximum(trial, lower[active])
+        if upper is not None:
+            trial = np.minimum(trial, upper[active])
+        r_trial = (func(trial) - y[active]) * w
+        cost_trial = (r_trial * r_trial).sum(axis=1)
+        nfev[active] += 1
+
+        better = cost_trial < cost[active]
+        improved = active[better]
+        drop = cost[improved] - cost_trial[better]
+        p[improved] = trial[better]
+        r[improved] = r_trial[better]
+        cost[improved] = cost_trial[better]
+        lam[improved] /= 10
+        lam[active[~better]] *= 10
+
+        # converged on a small relative decrease in chi-square or step size
+        done = np.zeros(active.size, dtype=bool)
+        small = (np.abs(step) <= tol * (np.abs(pa) + tol)).all(axis=1)
+        done[better] = (drop <= tol * cost[improved]) | small[better]
+        done |= lam[active] > 1e10
+        success[active[done]] = True
+        active = active[~done]
+
+    return p, cost, nfev, success
+
+
+def stderr(jac, p, cost, points):
+    """
+    Standard errors from the jacobian at the best fit, scaled by the reduced
+    chi-square the same way lmfit does
+
+    Parameters
+    ----------
+    points : array (N,) or int
+        number of points used in each fit
+    """
+    J = jac(p)
+    # normalize the jacobian so the inversion is well conditioned
+    norm = np.sqrt((J * J).sum(axis=2))
+    norm[norm == 0] = 1
+    Js = J / norm[:, :, None]
+    cov = np.linalg.pinv(np.matmul(Js, Js.transpose(0, 2, 1)))
+    cov /= norm[:, :, None] * norm[:, None, :]
+    redchi = cost / np.maximum(points - p.shape[1], 1)
+    cov *= redchi[:, None, None]
+    diag = np.arange(p.shape[1])
+    return np.sqrt(np.abs(cov[:, diag, diag]))
+
+
+def fit_peaks(x, y, centers, sigmas, amplitudes, background=None,
+              center_min=None, center_max=None, sigma_min=None,
+              sigma_max=None, weights=None, **kws):
+    """
+    Fit a lorentzian + constant model with a fixed number of peaks to a stack
+    of spectra
+
+    Parameters
+    ----------
+    x : array (points,)
+    y : array (N, points)
+    centers, sigmas, amplitudes : array (N, peaks)
+        initial guesses for every peak
+    background : array (N,) (default=0)
+        initial constant background
+    center_min, center_max : array (N, peaks) (default=None)
+        bounds on the peak centers, by default the peaks can move at most the
+        width of the data outside it
+    sigma_min, sigma_max : array (N, peaks) (default=None)
+        bounds on the peak widths
+    weights : array (N, points) (default=None)
+        residual weights, 0 excludes a point from the fit
+    kws :
+        passed on to `levenberg_marquardt`
+
+    Returns
+    -------
+    result : dict of arrays
+        'center', 'sigma', 'amplitude' (N, peaks) and 'c' (N,) with matching
+        '_err' stderrs, as well as 'chisqr', 'redchi', 'nfev' and 'success'
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n, k = np.shape(centers)
+    m = 3 * k + 1
+
+    p0 = np.empty((n, m))
+    p0[:, 0:-1:3] = amplitudes
+    p0[:, 1:-1:3] = centers
+    p0[:, 2:-1:3] = sigmas
+    p0[:, -1] = 0 if background is None else background
+
+    lower = np.full((n, m), -np.inf)
+    upper = np.full((n, m), np.inf)
+    # keep the peaks inside the data
+    lower[:, 1:-1:3] = x.min() - len(x) if center_min is None else center_min
+    upper[:, 1:-1:3] = x.max() + len(x) if center_max is None else center_max
+    lower[:, 2:-1:3] = 1e-6 if sigma_min is None else sigma_min
+    if sigma_max is not None:
+        upper[:, 2:-1:3] = sigma_max
+
+    def func(p):
+        return lorentzians(x, p)
+
+    def jac(p):
+        return lorentzians_jac(x, p)
+
+    p, cost, nfev, success = levenberg_marquardt(
+        func, jac, p0, y, weights=weights, lower=lower, upper=upper, **kws)
+    points = len(x) if weights is None else (weights != 0).sum(axis=1)
+    if weights is None:
+        err = stderr(jac, p, cost, points)
+    else:
+        err = stderr(lambda q: jac(q) * weights[:, None, :], p, cost, points)
+
+    return {'amplitude': p[:, 0:-1:3], 'amplitude_err': err[:, 0:-1:3],
+            'center': p[:, 1:-1:3], 'center_err': err[:, 1:-1:3],
+            'sigma': p[:, 2:-1:3], 'sigma_err': err[:, 2:-1:3],
+            'c': p[:, -1], 'c_err': err[:, -1],
+            'chisqr': cost, 'redchi': cost / np.maximum(points - m, 1),
+            'nfev': nfev, 'success': success}
+
+
+def find_fwhm_batch(y, position, x=None):
+    """
+    `spectra.Spectra.find_fwhm` of one point in each of many spectra at once
+
+    Parameters
+    ----------
+    y : array (N, points)
+    position : array of int (N,)
+        index of the peak in each spectrum
+    x : array (points,) (default=None)
+        x-data shared by all spectra, the index if not given
+
+    Returns
+    -------
+    fwhm : np.ndarray (N,)
+        distance between the nearest points either side of the peak at or
+        below half its height (or the ends of the data), in x-data units
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n, points = y.shape
+    position = np.asarray(position)
+    idx = np.arange(points)
+    below = y <= (y[np.arange(n), position] / 2)[:, None]
+    before = below & (idx < position[:, None])
+    after = below & (idx > position[:, None])
+    # last point below before the peak and first one after it
+    left = np.where(before.any(axis=1),
+                    points - 1 - before[:, ::-1].argmax(axis=1), 0)
+    right = np.where(after.any(axis=1), after.argmax(axis=1), points - 1)
+    if x is None:
+        return right - left
+    x = np.asarray(x)
+    return x[right] - x[left]
+
+
+def _window_peaks(y, width=5, window_size=7, order=3):
+    """
+    Initial positions of the four peaks in an inelastic window. The outer two
+    model the tails of the laser peaks at the window edges, the inner two are
+    the two most intense maxima of the smoothed data at least `width` apart
+    """
+    # scipy.signal takes longer to import than the rest of this module
+    from scipy import signal
+    ys = signal.savgol_filter(y, window_size, order, axis=1)
+    idx = np.arange(ys.shape[1])
+    peak = np.zeros(ys.shape, dtype=bool)
+    peak[:, 1:-1] = (ys[:, 1:-1] > ys[:, :-2]) & (ys[:, 1:-1] >= ys[:, 2:])
+    peak[:, (idx < width) | (idx >= ys.shape[1] - width)] = False
+    ys = np.where(peak, ys, -np.inf)
+    first = ys.argmax(axis=1)
+    ys[np.abs(idx - first[:, None]) < width] = -np.inf
+    second = np.where(np.isfinite(ys.max(axis=1)), ys.argmax(axis=1), first)
+
+    pos = np.empty((len(y), 4), dtype=int)
+    pos[:, 0] = 1
+    pos[:, 1] = np.minimum(first, second)
+    pos[:, 2] = np.maximum(first, second)
+    pos[:, 3] = ys.shape[1] - 3
+    return pos
+
+
+def fit_stack(y, width=5, chunk=1000, **kws):
+    """
+    Fit a stack of full 256 channel spectra in three sections, the three
+    laser peaks over the full range, and four peaks in each of the inelastic
+    windows, the vectorized equivalent of `brillouin.fit_file`
+
+    Parameters
+    ----------
+    y : array (N, 256)
+        counts for N spectra
+    width : float (default=5)
+        guess of the brillouin peak width in channels
+    chunk : int (default=1000)
+        number of spectra fitted together, keeps the jacobians small enough
+        to stay in cache
+    kws :
+        passed on to `levenberg_marquardt`
+
+    Returns
+    -------
+    l, b1, b2 : dict of arrays
+        `fit_peaks` results for the laser peaks and the two inelastic windows,
+        with the window channels in 'x'
+    """
+    y = np.atleast_2d(y)
+    parts = [_fit_chunk(y[i:i + chunk], width, **kws)
+             for i in range(0, len(y), chunk)]
+    if len(parts) == 1:
+        return parts[0]
+
+    sections = []
+    for res in zip(*parts):
+        merged = dict((k, np.concatenate([r[k] for r in res]))
+                      for k in res[0] if k != 'x')
+        merged['x'] = res[0]['x']
+        sections.append(merged)
+    return tuple(sections)
+
+
+def _fit_chunk(y, width, **kws):
+    """ `fit_stack` on a single chunk of spectra """
+    y = np.asarray(y, dtype=float)
+    n, points = y.shape
+    x = np.arange(points)
+    rows = np.arange(n)[:, None]
+
+    # laser peaks, width guessed from the most intense peak
+    pw = find_fwhm_batch(y, y.argmax(axis=1)).astype(float)[:, None]
+    pw = np.maximum(pw, 1)
+    pos = np.tile(LASER_POS, (n, 1))
+    l = fit_peaks(x, y, pos, np.repeat(pw / 2, 3, axis=1),
+                  y[rows, pos] * pi * pw / 2,
+                  sigma_min=pw * 0.25, sigma_max=pw * 2, **kws)
+    l['x'] = x
+
+    sections = [l]
+    for start, stop in WINDOWS:
+        wx = x[start:stop]
+        wy = y[:, start:stop]
+        pos = _window_peaks(wy, width=width)
+        sig = np.full(pos.shape, width / 2)
+        cen = wx[pos].astype(float)
+        amp = wy[rows, pos] * pi * sig
+        # the outer peaks sit just outside the window, scaled to the tails
+        cen[:, 0] = wx[0] - width
+        cen[:, 3] = wx[-1] + width
+        amp[:, 0] = wy[:, 0] * pi * (width ** 2 + sig[:, 0] ** 2) / sig[:, 0]
+        amp[:, 3] = wy[:, -1] * pi * (width ** 2 + sig[:, 3] ** 2) / sig[:, 3]
+        # the brillouin peaks should not wander off into the laser tails,
+        # and the tails are kept close to the window where they are well
+        # defined
+        cmin = cen - 2 * width
+        cmax = cen + 2 * width
+        cmin[:, 0] = wx[0] - 3 * width
+        cmax[:, 0] = wx[0]
+        cmin[:, 3] = wx[-1]
+        cmax[:, 3] = wx[-1] + 3 * width
+        res = fit_peaks(wx, wy, cen, sig, amp, center_min=cmin,
+                        center_max=cmax, sigma_min=sig / 2,
+                        sigma_max=sig * 4, **kws)
+        res['x'] = wx
+        sections.append(res)
+
+    return tuple(sections)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+description: benchmark of the peak search in the inelastic windows, comparing
+the speed and agreement of the wavelet (cwt) search with the vectorized
+prominence search
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import signal
+import spectra as sp
+from datfile import load_folder
+from batch_fit import WINDOWS
+
+
+class Quiet:
+    """ Silence the progress prints of Spectra """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def window_stack(counts):
+    """ x-data and (N, points) smoothed data of every inelastic window """
+    stacks = []
+    for start, stop in WINDOWS:
+        x = np.arange(start, stop)
+        y = signal.savgol_filter(counts[:, start:stop].astype(float), 5, 3,
+                                 axis=1)
+        stacks.append((x, counts[:, start:stop].astype(float), y))
+    return stacks
+
+
+def run_cwt(x, raw, smooth):
+    """ Peak positions from `Spectra.find_peaks` as used in `fit_file` """
+    peaks = []
+    with Quiet():
+        for r, s in zip(raw, smooth):
+            b = sp.Spectra(x, r)
+            b.y_smooth = s
+            peaks.append(b.find_peaks(width=5, threshold=0, limit=4,
+                                      smooth=True)[1])
+    return peaks
+
+
+def run_prominence(x, raw, smooth):
+    """ Peak positions from `find_peaks_batch` on the whole stack """
+    xscale = len(x) / (x.max() - x.min())
+    num, pos = sp.find_peaks_batch(smooth, 5 * xscale, threshold=0, limit=4,
+                                   data_max=raw.max(axis=1))
+    return [list(p[:n]) for n, p in zip(num, pos)]
+
+
+def agreement(a, b, tol=2):
+    """
+    Fraction of the peaks in `b` within `tol` points of a peak in `a`, and the
+    mean distance of those that are
+    """
+    matched = []
+    total = 0
+    for pa, pb in zip(a, b):
+        total += len(pb)
+        for p in pb:
+            d = min([abs(p - q) for q in pa] or [np.inf])
+            if d <= tol:
+                matched.append(d)
+    frac = len(matched) / total if total else np.nan
+    return frac, np.mean(matched) if matched else np.nan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('folder', nargs='?',
+                        default=os.path.join('sample_data', 'test_full'))
+    parser.add_argument('-n', '--copies', type=int, default=1,
+                        help='repeat the spectra to benchmark larger stacks')
+    args = parser.parse_args()
+
+    names, headers, counts = load_folder(args.folder, cache=False)
+    counts = np.tile(counts, (args.copies, 1))
+    print "%s spectra, %s windows each" % (len(counts), len(WINDOWS))
+    print "%-8s %10s %10s %12s %10s %10s" % ('window', 'cwt (s)', 'prom (s)',
+                                             'speedup', 'agree', 'mean d')
+
+    for i, (x, raw, smooth) in enumerate(window_stack(counts)):
+        t = time.time()
+        cwt = run_cwt(x, raw, smooth)
+        t_cwt = time.time() - t
+        t = time.time()
+        prom = run_prominence(x, raw, smooth)
+        t_prom = time.time() - t
+        frac, dist = agreement(cwt, prom)
+        print "%-8s %10.4f %10.4f %11.1fx %9.1f%% %10.2f" % (
+            'b%s' % (i + 1), t_cwt, t_prom, t_cwt / t_prom, 100 * frac, dist)
+
+if __name__ == '__main__':
+    main()
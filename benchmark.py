@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+description: benchmark suite for the fitting pipeline. Times each stage on
+the sample data and on synthetic spectra at scale, reports throughput and
+peak memory, saves the results as JSON and compares them to a baseline.
+Module import times are checked against fixed targets
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+from scipy import signal
+import matplotlib
+matplotlib.use('Agg')
+import spectra as sp
+import batch_fit
+import synthetic
+from brillouin import (fit_counts, plot_fit, calculate_shifts, peak_widths,
+                       results_array, shift_array)
+from brillouin_folder import process_folder
+from datfile import dat_files, read_dat
+from bench_peaks import Quiet
+
+SAMPLE_FOLDER = os.path.join('sample_data', 'test_full')
+SIZES = [1000, 10000, 100000]
+RESULTS = 'benchmark_results.json'
+BASELINE = 'benchmark_baseline.json'
+
+# most seconds each module may take to import in a fresh interpreter without
+# a display, over the startup of the interpreter itself. lmfit imports
+# matplotlib.pyplot, so every module that fits with it has that cost.
+IMPORT_TARGETS = {'brillouin_fit': 0.2, 'batch_fit': 0.2, 'writers': 0.2,
+                  'spectra': 1.0, 'brillouin': 1.0, 'brillouin_folder': 1.5}
+
+# Spectra methods timed inside `fit_counts`
+SPECTRA_STAGES = ['guess_peak_width', 'smooth_data', 'find_peaks',
+                  'build_model', 'fit_data']
+
+
+def max_rss_mb():
+    """ Peak resident memory of this process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Timer:
+    """ Accumulated time and call count of each stage """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage, count=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, count)
+
+    def add(self, stage, seconds, count=1):
+        t = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+        t['seconds'] += seconds
+        t['count'] += count
+        t['max_rss_mb'] = max_rss_mb()
+
+    def note(self, stage, **values):
+        """ Keep other results of a stage, eg. the accuracy of a fit """
+        self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0,
+                                       'max_rss_mb': max_rss_mb()})
+        self.stages[stage].update(values)
+
+    def results(self):
+        for t in self.stages.values():
+            t['per_second'] = (t['count'] / t['seconds'] if t['seconds']
+                               else None)
+        return self.stages
+
+
+@contextmanager
+def timed_methods(cls, names, timer, prefix=''):
+    """ Time every call to the methods `names` of `cls` while in the block """
+    originals = dict((name, getattr(cls, name)) for name in names)
+
+    def wrap(name, method):
+        def timed(*args, **kws):
+            with timer(prefix + name):
+                return method(*args, **kws)
+        return timed
+
+    for name, method in originals.items():
+        setattr(cls, name, wrap(name, method))
+    try:
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(cls, name, method)
+
+
+def import_time(module, repeat=3):
+    """
+    Best of `repeat` times to import `module` in a new interpreter without a
+    display, less the time of an interpreter that imports nothing
+    """
+    env = dict((k, v) for k, v in os.environ.items()
+               if k not in ('DISPLAY', 'WAYLAND_DISPLAY', 'MPLBACKEND'))
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = here
+
+    def best(code):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env,
+                                  cwd=here)
+            times.append(time.time() - start)
+        return min(times)
+
+    return max(best('import %s' % module) - best('pass'), 0.0)
+
+
+def bench_imports(modules, timer, repeat=3):
+    """ `import_time` of each of `modules` """
+    for module in modules:
+        timer.add('import/%s' % module, import_time(module, repeat))
+
+
+def check_imports(results, targets=IMPORT_TARGETS):
+    """
+    Returns
+    -------
+    slow : list of string
+        modules that took longer to import than their target
+    """
+    slow = []
+    for module, target in sorted(targets.items()):
+        t = results['stages'].get('import/%s' % module)
+        if t is not None and t['seconds'] > target:
+            print "import %s took %.3f s, the target is %.3f s" % (
+                module, t['seconds'], target)
+            slow.append(module)
+    return slow
+
+
+def bench_sample(folder, timer):
+    """ Per-file stages of `brillouin_folder.process_file` on real data """
+    out = tempfile.mkdtemp()
+    try:
+        with Quiet(), timed_methods(sp.Spectra, SPECTRA_STAGES, timer,
+                                    'Spectra.'):
+            for f in dat_files(folder):
+                with timer('read_dat'):
+                    header, counts = read_dat(os.path.join(folder, f))
+                try:
+                    with timer('fit_counts'):
+                        fits = fit_counts(counts)
+                    with timer('calculate_shifts'):
+                        calculate_shifts(*fits)
+                        peak_widths(*fits)
+                except Exception:
+                    timer.add('failed', 0.0)
+                    continue
+                with timer('plot_fit'):
+                    plot_fit(*fits, save_path=os.path.join(out, f[:-3] +
+                                                           'pdf'),
+                             filename=f)
+    finally:
+        shutil.rmtree(out)
+
+
+def bench_folder(folder, timer):
+    """ Whole `process_folder` runs on a copy of the folder """
+    n = len(dat_files(folder))
+    for mode in ['none', 'background']:
+        work = tempfile.mkdtemp()
+        try:
+            copy = os.path.join(work, 'data')
+            shutil.copytree(folder, copy)
+            with Quiet(), timer('process_folder[plot=%s]' % mode, n):
+                process_folder(copy, 0.56, False, plot=mode)
+        finally:
+            shutil.rmtree(work)
+
+
+def bench_scale(n, timer, lmfit_limit=100):
+    """
+    Stages on `n` synthetic spectra, with the rms error of the average shift
+    against the ground truth. The lmfit pipeline is only run on the first
+    `lmfit_limit` of them, its throughput scales linearly
+    """
+    with timer('%s/synthetic' % n, n):
+        counts, truth = synthetic.generate(n)
+    true = np.column_stack([truth[k] for k in ['f1', 'f2', 'f3', 'f4',
+                                               'f_avg']])
+
+    with timer('%s/guess_batch' % n, n):
+        sp.guess_batch(counts, smooth=(5, 3))
+
+    with timer('%s/find_peaks_batch' % n, n):
+        for start, stop in batch_fit.WINDOWS:
+            y = counts[:, start:stop].astype(float)
+            sp.find_peaks_batch(signal.savgol_filter(y, 5, 3, axis=1), 5,
+                                threshold=0, limit=4, data_max=y.max(axis=1))
+
+    with timer('%s/fit_stack' % n, n):
+        l, b1, b2 = batch_fit.fit_stack(counts)
+    centers = np.hstack([l['center'], b1['center'][:, 1:3],
+                         b2['center'][:, 1:3]])
+    shifts, _ = shift_array(centers)
+    timer.note('%s/fit_stack' % n, **synthetic.recovery(shifts, true))
+
+    m = min(n, lmfit_limit)
+    shifts = np.full((m, 5), np.nan)
+    with Quiet():
+        for i, c in enumerate(counts[:m]):
+            try:
+                with timer('%s/fit_counts' % n):
+                    fits = fit_counts(c)
+            except Exception:
+                timer.add('%s/failed' % n, 0.0)
+                continue
+            shifts[i] = results_array([fits])[0][0, :5]
+    timer.note('%s/fit_counts' % n, **synthetic.recovery(shifts, true[:m]))
+
+
+def _run(func, args, queue):
+    """ Run one benchmark group in a fresh process, queue its stages """
+    timer = Timer()
+    try:
+        func(*(args[:1] + (timer,) + args[1:]))
+    finally:
+        queue.put(timer.results())
+
+
+def run(folder, sizes, lmfit_limit=100):
+    """
+    Run all the benchmarks, each group in its own process so that the
+    reported peak memory belongs to that group
+
+    Returns
+    -------
+    results : dict
+        machine info and {stage: {'seconds', 'count', 'per_second',
+        'max_rss_mb'}}
+    """
+    groups = [(bench_imports, (sorted(IMPORT_TARGETS),)),
+              (bench_sample, (folder,)), (bench_folder, (folder,))]
+    groups += [(bench_scale, (n, lmfit_limit)) for n in sizes]
+    stages = {}
+    for func, args in groups:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_run, args=(func, args, queue))
+        proc.start()
+        stages.update(queue.get())
+        proc.join()
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'folder': folder,
+            'stages': stages}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare the time per item of every stage with a baseline
+
+    Returns
+    -------
+    regressions : list of string
+        stages slower than the baseline by more than `tolerance`
+    """
+    print "%-36s %12s %12s %9s" % ('stage', 'base (ms)', 'now (ms)', 'change')
+    regressions = []
+    for stage in sorted(results['stages']):
+        now = results['stages'][stage]
+        base = baseline['stages'].get(stage)
+        if base is None or not now['count'] or not base['count']:
+            continue
+        t_now = 1e3 * now['seconds'] / now['count']
+        t_base = 1e3 * base['seconds'] / base['count']
+        if not t_base:
+            continue
+        change = t_now / t_base - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(stage)
+            flag = '  <-- slower'
+        print "%-36s %12.3f %12.3f %+8.1f%%%s" % (stage, t_base, t_now,
+                                                  100 * change, flag)
+    return regressions
+
+
+def report(results):
+    """
+    Print the stage times, throughput and peak memory, and the rms error of
+    the average shift for fits of synthetic spectra
+    """
+    print "%-36s %10s %8s %12s %10s %10s" % ('stage', 'time (s)', 'count',
+                                             'per second', 'mem (MB)',
+                                             'F_avg rms')
+    for stage in sorted(results['stages']):
+        t = results['stages'][stage]
+        rate = t['per_second']
+        print "%-36s %10.3f %8d %12s %10.1f %10s" % (
+            stage, t['seconds'], t['count'],
+            '%.1f' % rate if rate is not None else '-', t['max_rss_mb'],
+            '%.5f' % t['rms'][4] if 'rms' in t else '-')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('folder', nargs='?', default=SAMPLE_FOLDER)
+    parser.add_argument('-n', '--sizes', type=int, nargs='*', default=SIZES,
+                        help='numbers of synthetic spectra')
+    parser.add_argument('--lmfit-limit', type=int, default=100,
+                        help='max spectra fitted with lmfit per size')
+    parser.add_argument('-o', '--output', default=RESULTS,
+                        help='JSON file to save the results to')
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help='JSON results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='also save the results as the new baseline')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='allowed slowdown before a stage is flagged')
+    args = parser.parse_args()
+
+    results = run(args.folder, args.sizes, args.lmfit_limit)
+    report(results)
+    slow = check_imports(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        shutil.copy(args.output, args.baseline)
+        print "Saved baseline to %s" % args.baseline
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print "\nCompared to %s (%s)" % (args.baseline, baseline['date'])
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print "%s stages slower than the baseline" % len(regressions)
+            sys.exit(1)
+    if slow:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -1,14 +1,29 @@
 """
 description: functions to automate peak fitting, plotting and outputting fit
-values to brillouin data
+values to brillouin data. matplotlib and uncertainties are only imported
+when a fit is plotted or `calculate_shifts` is used
 author: Rohan Isaac
 """
 from __future__ import division
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
+import backend
 import spectra as sp
-from uncertainties import ufloat
+from datfile import read_dat
+from instrument import timed
+
+# nominal channels of the laser peaks, and the inelastic windows used when
+# they cannot be placed from the laser fit
+LASER_POS = [4, 127, 253]
+WINDOWS = [(21, 110), (146, 235)]
+# channels around each nominal laser position searched for its maximum
+LASER_SEARCH = 10
+# gap between a laser peak and the inelastic window next to it, in fitted
+# laser sigmas, and its limits in channels
+WINDOW_MARGIN = 7.0
+MIN_MARGIN = 17
+MAX_MARGIN = 25
+# fewest channels in an inelastic window
+MIN_WINDOW = 40
 
 
 def par_val(fit_obj, fit_param):
@@ -17,58 +32,275 @@ def par_val(fit_obj, fit_param):
 
 
 def full_param(fit_obj, fit_param):
+    from uncertainties import ufloat
     p = fit_obj.out.params[fit_param]
     return ufloat(p.value, p.stderr)
 
 
-def fit_file(fname):
+def fit_file(fname, previous=None, lean=False, **kws):
     """
-    Fit a single file in three sections, and return the three fit objects
+    Fit a single file in three sections, and return the three fit objects,
+    or with `lean` their `spectra.FitSummary`, which the functions below
+    accept in their place but which can not be plotted. See `fit_counts`
+    for the other parameters
     """
-    x = np.arange(256)
-    y = np.genfromtxt(fname, skip_header=12)
+    header, counts = read_dat(fname)
+    fits = fit_counts(counts, previous, **kws)
+    if lean:
+        return tuple(s.summary() for s in fits)
+    return fits
 
-    # fit the main peaks first
-    l = sp.Spectra(x, y)
-    l.peak_pos = [4, 127, 253]
-    l.num_peaks = 3
-    l.build_model(bg_ord=0)
-    l.fit_data()
 
-    # extract inelastic ranges
-    b1x = x[21:110]
-    b1y = y[21:110]
-    b2x = x[146:235]
-    b2y = y[146:235]
+def warm_start(x, y, previous, width=None, shift_tol=2.0, chi_tol=2.0,
+               peak_type='LO', max_nfev=None, deadline=None):
+    """
+    Fit a section of a spectrum starting from the converged parameters of the
+    same section of a previous spectrum, without searching for peaks
+
+    Parameters
+    ----------
+    previous : Spectra or FitSummary
+        fit object of the same section in the previous spectrum
+    width : float (default=None)
+        peak width used for the bounds on sigma, guessed from the data if
+        not given
+    shift_tol : float (default=2.0)
+        max distance (in x-data units) that a peak inside the data range may
+        move from its starting position. Peaks outside the range (the laser
+        tails at the edges of the inelastic windows) are not checked.
+    chi_tol : float (default=2.0)
+        max ratio of the reduced chi-square to that of the previous fit,
+        both normalized by the mean counts to allow for intensity changes
+    peak_type : string (default='LO')
+        see `Spectra.build_model`
+    max_nfev, deadline :
+        budget of the fit, see `Spectra.fit_data`
+
+    Returns
+    -------
+    fit_obj : Spectra or None
+        None if there is no previous fit, or if the fit fails one of the
+        tolerances and has to be redone from a peak search
+    """
+    if previous is None:
+        return None
+    s, ok = _warm_fit(x, y, previous, width, shift_tol, chi_tol, peak_type,
+                      max_nfev, deadline)
+    return s if ok else None
+
 
-    # inelastic range 1
-    b1 = sp.Spectra(b1x, b1y)
-    b1.smooth_data(window_size=5, order=3)
-    b1.find_peaks(width=5, threshold=0, limit=4, smooth=True)
-    b1.build_model(bg_ord=0)
-    b1.fit_data()
+@timed('warm_start', lambda args, result: {'accepted': result[1]})
+def _warm_fit(x, y, previous, width=None, shift_tol=2.0, chi_tol=2.0,
+              peak_type='LO', max_nfev=None, deadline=None):
+    """
+    The fit of `warm_start`, and if it is within the tolerances, so that
+    rejected fits can still be counted
+    """
+    params = previous.out.params
+    seed = np.array([params['p%s_center' % i].value
+                     for i in range(previous.num_peaks)])
+
+    s = sp.Spectra(x, y)
+    if width is not None:
+        s.set_peak_width(width)
+    s.peak_pos = list(np.clip(np.searchsorted(x, seed), 0, len(x) - 1))
+    s.num_peaks = previous.num_peaks
+    s.build_model(peak_type=peak_type, bg_ord=0, init_params=params)
+    s.fit_data(max_nfev, deadline)
+
+    centers = np.array([s.out.params['p%s_center' % i].value
+                        for i in range(s.num_peaks)])
+    inside = (seed >= x[0]) & (seed <= x[-1])
+    shift = np.abs(centers - seed)[inside].max() if inside.any() else 0
+    chi = s.out.redchi / np.mean(y)
+    y_prev = (previous.y_mean if isinstance(previous, sp.FitSummary)
+              else np.mean(previous.y))
+    chi_prev = previous.out.redchi / y_prev
+    if not s.out.success or shift > shift_tol or chi > chi_tol * chi_prev:
+        sp._print("Warm start outside tolerance, searching for peaks")
+        return s, False
+    return s, True
+
+
+def laser_positions(y):
+    """
+    Channels of the laser peaks, the maximum of `y` within `LASER_SEARCH`
+    channels of each of `LASER_POS`, so that the fit starts on them when the
+    spectrum has drifted
+    """
+    pos = []
+    for p in LASER_POS:
+        lo = max(p - LASER_SEARCH, 0)
+        pos.append(lo + int(np.argmax(y[lo:p + LASER_SEARCH + 1])))
+    return pos
 
-    # inelastic range 2
-    b2 = sp.Spectra(b2x, b2y)
-    b2.smooth_data(window_size=5, order=3)
-    b2.find_peaks(width=5, threshold=0, limit=4, smooth=True)
-    b2.build_model(bg_ord=0)
-    b2.fit_data()
 
+def inelastic_windows(l, channels=256):
+    """
+    Channel ranges of the two inelastic windows, from the fitted laser peaks
+
+    Each window starts and stops `WINDOW_MARGIN` fitted sigmas (limited to
+    `MIN_MARGIN` - `MAX_MARGIN` channels) away from the laser peaks on either
+    side, so the windows follow the laser peaks when they drift and keep
+    clear of their cores when they broaden, while still including some of
+    their tails (which are fitted as the outer peaks of each window). A
+    window reaching into the steep side of a laser line is not described by
+    those outer peaks, and the misfit inflates the reduced chi-square and
+    so the stderrs of the brillouin peaks.
+
+    Parameters
+    ----------
+    l : Spectra
+        fit of the laser peaks, see `fit_counts`
+    channels : int (default=256)
+
+    Returns
+    -------
+    windows : list of (start, stop)
+        slices of the counts, `WINDOWS` if the fit does not give two windows
+        of at least `MIN_WINDOW` channels
+    """
+    centers = [par_val(l, 'p%s_center' % i) for i in range(3)]
+    margins = [np.clip(WINDOW_MARGIN * par_val(l, 'p%s_sigma' % i),
+                       MIN_MARGIN, MAX_MARGIN) for i in range(3)]
+    edges = [c + m * side for c, m in zip(centers, margins)
+             for side in (-1, 1)]
+    windows = [(int(np.ceil(edges[1])), int(np.floor(edges[2])) + 1),
+               (int(np.ceil(edges[3])), int(np.floor(edges[4])) + 1)]
+    valid = all(np.isfinite(edges)) and all(
+        0 <= a and b <= channels and b - a >= MIN_WINDOW for a, b in windows)
+    if not valid:
+        sp._print("Laser fit does not place the windows, using %s" %
+                  WINDOWS)
+        return WINDOWS
+    return windows
+
+
+@timed('fit_counts')
+def fit_counts(counts, previous=None, shift_tol=2.0, chi_tol=2.0,
+               peak_method='cwt', peak_type='LO', center_range=None,
+               max_nfev=None, deadline=None):
+    """
+    Fit the 256 channel counts of a spectrum in three sections, and return the
+    three fit objects. The laser peaks are fitted first, and the inelastic
+    windows are placed between them, see `inelastic_windows`.
+
+    Parameters
+    ----------
+    counts : array (256,)
+    previous : tuple of Spectra or FitSummary (default=None)
+        fit objects of the previous spectrum in a series (the output of this
+        function, or their summaries). Each section is then started from
+        the previous converged parameters, see `warm_start`, and the peak
+        search is only run when that fails.
+    shift_tol, chi_tol : float
+        tolerances of the warm start, see `warm_start`
+    peak_method : string (default='cwt')
+        how peaks are found in the inelastic windows, 'cwt' or 'prominence',
+        see `Spectra.find_peaks`
+    peak_type : string (default='LO')
+        lorentzian peak model, 'LO' or 'FLO' (same model with an analytic
+        jacobian), see `Spectra.build_model`
+    center_range : float (default=None)
+        bound the peak centers of the fits that start from a peak search to
+        within this many channels of the peaks found, see
+        `Spectra.build_model`
+    max_nfev : int (default=None)
+        function evaluations allowed for all the fits of the spectrum
+        together, each fit gets what the ones before it left. The nfev of a
+        section fit includes that of a rejected warm start of the section,
+        so the nfev of the three fits add up to the evaluations used.
+    deadline : float (default=None)
+        time budget of each fit, see `Spectra.fit_data`
+    """
+    y = np.asarray(counts, dtype=float)
+    x = np.arange(len(y))
+    pl, pb1, pb2 = previous if previous is not None else (None, None, None)
+    build = dict(peak_type=peak_type, bg_ord=0, center_range=center_range)
+    spent = [0]
+
+    def left():
+        # each fit may use what the fits before it left
+        return None if max_nfev is None else max_nfev - spent[0]
+
+    def section(sx, sy, prev, width, search):
+        """ Fit a section from `prev`, or from a peak search by `search` """
+        warm = None
+        if prev is not None:
+            warm, ok = _warm_fit(sx, sy, prev, width, shift_tol, chi_tol,
+                                 peak_type, left(), deadline)
+            spent[0] += warm.out.nfev
+            if ok:
+                return warm
+        s = sp.Spectra(sx, sy)
+        search(s)
+        s.build_model(**build)
+        s.fit_data(left(), deadline)
+        spent[0] += s.out.nfev
+        if warm is not None:
+            s.out.nfev += warm.out.nfev
+        return s
+
+    def laser_search(s):
+        s.peak_pos = laser_positions(y)
+        s.num_peaks = 3
+
+    def window_search(s):
+        s.smooth_data(window_size=5, order=3)
+        s.find_peaks(width=5, threshold=0, limit=4, smooth=True,
+                     method=peak_method)
+
+    # fit the main peaks first, then the inelastic windows between them
+    l = section(x, y, pl, None, laser_search)
+    (s1, e1), (s2, e2) = inelastic_windows(l, len(y))
+    b1 = section(x[s1:e1], y[s1:e1], pb1, 5, window_search)
+    b2 = section(x[s2:e2], y[s2:e2], pb2, 5, window_search)
     return l, b1, b2
 
 
+def plot_data(l, b1, b2):
+    """
+    Everything `render_fit` needs to draw a fit, so that plotting can happen
+    later or in another process without the fit objects
+
+    Returns
+    -------
+    data : dict
+        'centers', the three laser and four brillouin peak centers, and
+        'windows', [x, y, best_fit] of both inelastic windows, all as plain
+        lists so they can be pickled or stored as JSON
+    """
+    if b1.y is None or b2.y is None:
+        raise ValueError("fit summaries without data can not be plotted")
+    centers = [par_val(l, 'p%s_center' % i) for i in range(3)]
+    centers += [par_val(b, 'p%s_center' % i) for b in (b1, b2) for i in (1, 2)]
+    return {'centers': centers,
+            'windows': [[np.asarray(b.x, dtype=float).tolist(),
+                         np.asarray(b.y, dtype=float).tolist(),
+                         b.out.best_fit.tolist()] for b in (b1, b2)]}
+
+
 def plot_fit(l, b1, b2, save_path, filename, spacing=0.56, crossed=False):
+    """ Plot the fit objects of a file, see `render_fit` """
+    return render_fit(plot_data(l, b1, b2), save_path, filename,
+                      spacing=spacing, crossed=crossed)
+
+
+@timed('render_fit')
+def render_fit(data, save_path, filename, spacing=0.56, crossed=False,
+               fit_csv=True):
+    """
+    Plot the data, fit and shifts of a file from its `plot_data`
+
+    If `save_path` is given the figure is saved there and closed, and unless
+    `fit_csv` is False the best fit of the inelastic windows is also saved to
+    a _fit.csv file next to it, otherwise the figure is returned
+    """
     arr_height = 85
 
     # compute the plain values, no uncertainties
-    l1 = par_val(l, 'p0_center')
-    l2 = par_val(l, 'p1_center')
-    l3 = par_val(l, 'p2_center')
-    p1 = par_val(b1, 'p1_center')
-    p2 = par_val(b1, 'p2_center')
-    p3 = par_val(b2, 'p1_center')
-    p4 = par_val(b2, 'p2_center')
+    l1, l2, l3, p1, p2, p3, p4 = data['centers']
+    (b1_x, b1_y, b1_fit), (b2_x, b2_y, b2_fit) = data['windows']
 
     fsr_icm = 1 / (2 * spacing)  # 1/cm
     fsr_ch = (l3 - l1) / 2  # ch
@@ -86,22 +318,18 @@ def plot_fit(l, b1, b2, save_path, filename, spacing=0.56, crossed=False):
         f3 = wn_ch * (p4 - l2)
         f4 = wn_ch * (l3 - p3)
 
+    backend.select_backend()
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as mlines
     fig, ax = plt.subplots(figsize=(12, 4))
 
     # data
-    plt.step(b1.x, b1.y, 'b')
-    plt.step(b2.x, b2.y, 'b')
+    plt.step(b1_x, b1_y, 'b')
+    plt.step(b2_x, b2_y, 'b')
 
     # fits
-    plt.plot(b1.x, b1.out.best_fit, 'r', lw=2)
-    plt.plot(b2.x, b2.out.best_fit, 'r', lw=2)
-
-    # also save the data in a file
-    b1_fit = np.vstack((b1.x, b1.out.best_fit))
-    b2_fit = np.vstack((b2.x, b2.out.best_fit))
-    b_fit = np.concatenate((b1_fit, b2_fit), axis=1)
-
-    np.savetxt(save_path[:-4]+'_fit.csv', b_fit.T, delimiter=',')
+    plt.plot(b1_x, b1_fit, 'r', lw=2)
+    plt.plot(b2_x, b2_fit, 'r', lw=2)
 
     # brillouin peaks
     for i in [p1, p2, p3, p4]:
@@ -176,6 +404,14 @@ def plot_fit(l, b1, b2, save_path, filename, spacing=0.56, crossed=False):
         return fig
     else:
         fig.savefig(save_path)
+        plt.close(fig)
+        if not fit_csv:
+            return
+
+        # also save the data in a file
+        b_fit = np.concatenate((np.vstack((b1_x, b1_fit)),
+                                np.vstack((b2_x, b2_fit))), axis=1)
+        np.savetxt(save_path[:-4]+'_fit.csv', b_fit.T, delimiter=',')
         return
 
 
@@ -223,3 +459,208 @@ def peak_widths(a, b, c):
     # fwhm = 2.0 * sigma for lorentzian
     fwhm = [2.0 * full_param(i, 'p%s_sigma' % j) for (i, j) in peaks]
     return fwhm
+
+
+# (section, peak) of L1, L2, L3, P1, P2, P3, P4 in the three fits of a file
+PEAKS = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 1), (2, 2)]
+
+# packed fit results of a file, see `summary_array`
+SUMMARY_DTYPE = np.dtype([('center', 'f8', len(PEAKS)),
+                          ('center_err', 'f8', len(PEAKS)),
+                          ('sigma', 'f8', len(PEAKS)),
+                          ('sigma_err', 'f8', len(PEAKS)),
+                          ('success', '?'), ('nfev', 'i4')])
+
+
+def stack_fits(fits, name='center', covar=False):
+    """
+    Values and stderrs of one parameter of the seven peaks of many files
+
+    Parameters
+    ----------
+    fits : list of (a, b, c) or array of `SUMMARY_DTYPE`
+        the three fit objects (or their summaries) of each file, see
+        `fit_file`, or the records of `summary_array`
+    name : string (default='center')
+        peak parameter, 'center' or 'sigma' for records, or any peak
+        parameter for fit objects
+    covar : bool (default=False)
+        also return the covariance of the parameters, from the covariance
+        matrix of each fit. Parameters of different sections are
+        uncorrelated. Not available for records.
+
+    Returns
+    -------
+    values : np.ndarray (N, 7)
+        in the order L1, L2, L3, P1, P2, P3, P4
+    errors : np.ndarray (N, 7)
+    cov : np.ndarray (N, 7, 7), only with `covar`
+        nan where a fit has no covariance
+    """
+    if isinstance(fits, np.ndarray):
+        if covar:
+            raise ValueError("summary records have no covariance")
+        return fits[name], fits[name + '_err']
+    n = len(fits)
+    values = np.empty((n, len(PEAKS)))
+    errors = np.empty((n, len(PEAKS)))
+    cov = np.zeros((n, len(PEAKS), len(PEAKS)))
+    for i, sections in enumerate(fits):
+        for j, (sec, peak) in enumerate(PEAKS):
+            p = sections[sec].out.params['p%s_%s' % (peak, name)]
+            values[i, j] = p.value
+            errors[i, j] = p.stderr if p.stderr is not None else np.nan
+        if not covar:
+            continue
+        for sec in range(3):
+            out = sections[sec].out
+            cols = [j for j, (s, _) in enumerate(PEAKS) if s == sec]
+            names = ['p%s_%s' % (PEAKS[j][1], name) for j in cols]
+            if out.covar is None or any(v not in out.var_names
+                                        for v in names):
+                cov[i, cols, :] = np.nan
+                continue
+            idx = [out.var_names.index(v) for v in names]
+            cov[i][np.ix_(cols, cols)] = out.covar[np.ix_(idx, idx)]
+    if covar:
+        return values, errors, cov
+    return values, errors
+
+
+def summary_array(fits):
+    """
+    Pack the fits of many files into records of `SUMMARY_DTYPE`, the peak
+    centers and widths with their stderrs, if all three fits converged and
+    their function evaluations, about 230 bytes per file. `results_array`
+    takes the records in place of the fits (without `covar`).
+
+    Parameters
+    ----------
+    fits : list of (a, b, c)
+        the three fit objects (or their summaries) of each file
+
+    Returns
+    -------
+    records : np.ndarray of `SUMMARY_DTYPE` (N,)
+    """
+    records = np.zeros(len(fits), dtype=SUMMARY_DTYPE)
+    if not len(fits):
+        return records
+    records['center'], records['center_err'] = stack_fits(fits)
+    records['sigma'], records['sigma_err'] = stack_fits(fits, 'sigma')
+    records['success'] = [all(s.out.success for s in f) for f in fits]
+    records['nfev'] = [sum(s.out.nfev for s in f) for f in fits]
+    return records
+
+
+def shift_array(centers, errors=None, cov=None, spacing=0.56, crossed=False):
+    """
+    Brillouin shifts and their uncertainties for many spectra at once, the
+    array version of `calculate_shifts`
+
+    With wn/ch = 1/(2d) / ((L3 - L1)/2) each shift is wn/ch times a
+    difference D of peak centers, so its derivatives are wn/ch times the
+    coefficients of D, plus D * wn/ch**2 * d (for L1) and minus that (for
+    L3) from the dependence of wn/ch on the laser peaks.
+
+    Parameters
+    ----------
+    centers : array (N, 7)
+        L1, L2, L3, P1, P2, P3, P4, see `stack_fits`
+    errors : array (N, 7) (default=None)
+        stderrs of the centers, taken as independent
+    cov : array (N, 7, 7) (default=None)
+        full covariance of the centers, used instead of `errors`
+    spacing : float (default=0.56)
+        mirror spacing d in cm
+    crossed : bool (default=False)
+
+    Returns
+    -------
+    shifts : np.ndarray (N, 5)
+        F1, F2, F3, F4 and their average in 1/cm
+    u_shifts : np.ndarray (N, 5)
+        standard uncertainties, None if neither `errors` nor `cov` is given
+    """
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+    # peak differences D = C . centers, in the order of `PEAKS`
+    if not crossed:
+        coef = np.array([[-1, 0, 0, 1, 0, 0, 0],
+                         [0, 1, 0, 0, -1, 0, 0],
+                         [0, -1, 0, 0, 0, 1, 0],
+                         [0, 0, 1, 0, 0, 0, -1]], dtype=float)
+    else:
+        coef = np.array([[-1, 0, 0, 0, 1, 0, 0],
+                         [0, 1, 0, -1, 0, 0, 0],
+                         [0, -1, 0, 0, 0, 0, 1],
+                         [0, 0, 1, 0, 0, -1, 0]], dtype=float)
+    coef = np.vstack((coef, coef.mean(axis=0)))
+
+    wn_ch = 1 / (spacing * (centers[:, 2] - centers[:, 0]))
+    diff = centers.dot(coef.T)
+    shifts = wn_ch[:, None] * diff
+    if errors is None and cov is None:
+        return shifts, None
+
+    # jacobian (N, 5, 7)
+    jac = wn_ch[:, None, None] * coef
+    dw = spacing * wn_ch[:, None] ** 2 * diff
+    jac[:, :, 0] += dw
+    jac[:, :, 2] -= dw
+    if cov is not None:
+        var = np.einsum('nkj,njl,nkl->nk', jac, cov, jac)
+    else:
+        var = np.einsum('nkj,nj->nk', jac ** 2,
+                        np.atleast_2d(errors) ** 2)
+    return shifts, np.sqrt(var)
+
+
+def width_array(sigmas, errors=None, wfactor=2.0):
+    """
+    FWHM of the seven peaks of many spectra, the array version of
+    `peak_widths`
+
+    Parameters
+    ----------
+    sigmas : array (N, 7)
+        see `stack_fits`
+    errors : array (N, 7) (default=None)
+    wfactor : float (default=2.0)
+        fwhm / sigma, 2 for lorentzians
+
+    Returns
+    -------
+    fwhm, u_fwhm : np.ndarray (N, 7)
+    """
+    sigmas = np.atleast_2d(np.asarray(sigmas, dtype=float))
+    if errors is None:
+        return wfactor * sigmas, None
+    return wfactor * sigmas, wfactor * np.atleast_2d(errors)
+
+
+def results_array(fits, spacing=0.56, crossed=False, covar=False):
+    """
+    Shifts and peak widths of many files, in the columns of output.csv
+
+    Parameters
+    ----------
+    fits : list of (a, b, c) or array of `SUMMARY_DTYPE`
+        the three fit objects (or their summaries) of each file, or the
+        records of `summary_array`
+    covar : bool (default=False)
+        propagate the full covariance of the peak centers of each fit, not
+        only their stderrs
+
+    Returns
+    -------
+    values, errors : np.ndarray (N, 12)
+        F1 - F4, F_avg, then the FWHM of L1 - L3 and P1 - P4
+    """
+    if covar:
+        centers, u_centers, cov = stack_fits(fits, covar=True)
+    else:
+        (centers, u_centers), cov = stack_fits(fits), None
+    shifts, u_shifts = shift_array(centers, u_centers, cov, spacing=spacing,
+                                   crossed=crossed)
+    fwhm, u_fwhm = width_array(*stack_fits(fits, 'sigma'))
+    return np.hstack((shifts, fwhm)), np.hstack((u_shifts, u_fwhm))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+description: batch runner for many folders of brillouin files, given as a
+directory tree or a manifest with the spacing and crossed setting of each
+folder. All files go through one queue of worker processes, every fit is
+checkpointed in the folder's fit store, and an interrupted run resumes
+without refitting finished files
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import csv
+import time
+import argparse
+import multiprocessing
+from brillouin_folder import (_process_job, _render_job, write_output,
+                              store_settings)
+from datfile import dat_files
+from store import FitStore, file_hash
+
+
+def find_folders(root):
+    """ Sorted list of all folders under `root` that contain DAT files """
+    folders = []
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        if any(f.endswith('.DAT') for f in files):
+            folders.append(path)
+    return folders
+
+
+def read_manifest(path, spacing=0.56, crossed=False):
+    """
+    Read a manifest of folders, one per line as `folder[, spacing[,
+    crossed]]`. Blank lines and lines starting with # are skipped, relative
+    folders are relative to the manifest and missing values use the
+    defaults.
+
+    Returns
+    -------
+    folders : list of (folder, spacing, crossed)
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    folders = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            row = [v.strip() for v in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            fol = os.path.join(base, row[0])
+            s = float(row[1]) if len(row) > 1 and row[1] else spacing
+            c = (row[2].lower() in ('1', 'true', 'yes', 'y')
+                 if len(row) > 2 and row[2] else crossed)
+            folders.append((fol, s, c))
+    return folders
+
+
+class _Folder:
+    """
+    Progress of one folder in a batch, raises EnvironmentError if the folder
+    cannot be read
+    """
+
+    def __init__(self, path, spacing, crossed, settings):
+        self.path = os.path.abspath(path)
+        self.spacing = spacing
+        self.crossed = crossed
+        self.settings = settings
+        self.files = dat_files(self.path)
+        self.store = FitStore(self.path)
+        self.digests = {}
+        self.pending = set()
+        self.failed = []
+
+    def write(self):
+        """ Write output.csv from the store, once no files are pending """
+        rows = []
+        for f in self.files:
+            values = self.store.get(f, self.digests[f], self.spacing,
+                                    self.crossed, self.settings)
+            if values is not None:
+                rows.append((f, values, self.store.status(f)))
+        self.store.prune(self.files)
+        write_output(self.path, rows, self.spacing, self.crossed)
+
+
+def process_batch(folders, workers=1, plot='none', peak_method='cwt',
+                  verbose=False, covar=False):
+    """
+    Fit all the DAT files in a list of folders with one pool of workers, and
+    write output.csv in each folder as soon as all its files are done
+
+    Every result is saved to the `store.FitStore` of its folder as it comes
+    in, and files already in a store (with the same contents, spacing,
+    crossed setting and fit options) are not fitted again, so a batch that
+    was interrupted can simply be run again. Folders that cannot be read
+    are reported and skipped, and a folder listed more than once is only
+    processed with its first entry.
+
+    Parameters
+    ----------
+    folders : list of (folder, spacing, crossed)
+    workers : int (default=1)
+        number of processes, 0 or None uses one per core
+    plot : string (default='none')
+        'none', 'demand' (plot data kept in the stores, see
+        `brillouin_folder.render_folder`) or 'background'
+    peak_method : string (default='cwt')
+    verbose : bool (default=False)
+        print the progress and report of every fit
+    covar : bool (default=False)
+        see `brillouin_folder.process_folder`
+
+    Returns
+    -------
+    failed : dict
+        {folder: list of files that could not be fitted, or None if the
+        folder could not be read}
+    """
+    start = time.time()
+    settings = store_settings(peak_method, covar)
+    batch = []
+    missing = {}
+    seen = {}
+    for fol, spacing, crossed in folders:
+        path = os.path.abspath(fol)
+        if path in seen:
+            print "%s is listed more than once, using the first entry%s" % (
+                path, "" if seen[path] == (spacing, crossed) else
+                " (spacing %s, crossed %s)" % seen[path])
+            continue
+        seen[path] = (spacing, crossed)
+        try:
+            batch.append(_Folder(path, spacing, crossed, settings))
+        except EnvironmentError as e:
+            print "Cannot read %s, skipping (%s)" % (path, e)
+            missing[path] = None
+    opts = {'plot': plot != 'none', 'profile': False, 'verbose': verbose}
+    fit_kws = {'peak_method': peak_method, 'covar': covar}
+    jobs = []
+    owner = {}
+    skipped = 0
+    for fol in batch:
+        for f in fol.files:
+            fname = os.path.join(fol.path, f)
+            fol.digests[f] = file_hash(fname)
+            if fol.store.get(f, fol.digests[f], fol.spacing, fol.crossed,
+                             settings) is not None:
+                skipped += 1
+                continue
+            fol.pending.add(f)
+            owner[fname] = fol
+            jobs.append((fname, fol.spacing, fol.crossed, None, opts,
+                         fit_kws))
+    print "%s folders, %s files, %s already done, fitting %s" % (
+        len(batch), skipped + len(jobs), skipped, len(jobs))
+
+    # folders with nothing left to fit
+    for fol in batch:
+        if not fol.pending:
+            fol.write()
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, max(len(jobs), 1))
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_process_job, jobs)
+    else:
+        results = (_process_job(j) for j in jobs)
+    render_pool = None
+    if plot == 'background' and jobs:
+        render_pool = multiprocessing.Pool(1)
+
+    done = 0
+    renders = []
+    try:
+        for fname, result, error, events in results:
+            fol = owner[fname]
+            f = os.path.basename(fname)
+            done += 1
+            if error is not None:
+                print "Failed to fit %s, skipping (%s)" % (fname, error)
+                fol.failed.append(f)
+            else:
+                values, params, data, status = result
+                fol.store.put(f, fol.digests[f], fol.spacing, fol.crossed,
+                              params, values, status, settings)
+                if plot == 'demand':
+                    fol.store.put_plot(f, fol.spacing, fol.crossed, data)
+                elif render_pool is not None:
+                    renders.append(render_pool.apply_async(_render_job, ((
+                        fname, fol.spacing, fol.crossed, data, True),)))
+            fol.pending.discard(f)
+            if not fol.pending:
+                fol.write()
+            elapsed = time.time() - start
+            print "[%s/%s] %s (%.2f files/s, %.0f s left)" % (
+                done, len(jobs), fname, done / elapsed,
+                (len(jobs) - done) * elapsed / done)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if render_pool is not None:
+            render_pool.close()
+            render_pool.join()
+        for fol in batch:
+            fol.store.close()
+
+    for r in renders:
+        fname, error = r.get()
+        if error is not None:
+            print "Failed to plot %s (%s)" % (fname, error)
+
+    failed = dict((fol.path, fol.failed) for fol in batch if fol.failed)
+    n_failed = sum(len(v) for v in failed.values())
+    print "Done, %s files fitted, %s failed in %.1f s" % (
+        done - n_failed, n_failed, time.time() - start)
+    if missing:
+        print "%s folders could not be read: %s" % (
+            len(missing), ", ".join(sorted(missing)))
+        failed.update(missing)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('root', help='directory tree, or manifest file with '
+                        'lines of folder, spacing, crossed')
+    parser.add_argument('-s', '--spacing', type=float, default=0.56,
+                        help='default mirror spacing in cm')
+    parser.add_argument('-c', '--crossed', action='store_true',
+                        help='brillouin peaks are crossed by default')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='number of processes, 0 uses one per core')
+    parser.add_argument('-p', '--plot',
+                        choices=['none', 'demand', 'background'],
+                        default='none', help='how the fit plots are made')
+    parser.add_argument('--peaks', choices=['cwt', 'prominence'],
+                        default='cwt',
+                        help='peak search in the inelastic windows')
+    parser.add_argument('--covar', action='store_true',
+                        help='use the fit covariance for the uncertainties')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the report of every fit')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.root):
+        folders = [(f, args.spacing, args.crossed)
+                   for f in find_folders(args.root)]
+    else:
+        folders = read_manifest(args.root, args.spacing, args.crossed)
+    try:
+        process_batch(folders, workers=args.workers, plot=args.plot,
+                      peak_method=args.peaks, verbose=args.verbose,
+                      covar=args.covar)
+    except KeyboardInterrupt:
+        print "\nInterrupted, run again to resume"
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+description: headless fit-only entry point for servers and clusters. Fits DAT
+files or folders of them and writes the rows of output.csv, without plots,
+the fit store or any GUI. Nothing here imports a GUI toolkit, matplotlib uses
+its Agg backend when there is no display, and the fitting modules are only
+imported once there is something to fit, so --help and argument errors
+return at once
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import sys
+import time
+import argparse
+from datfile import dat_files, read_dat
+from instrument import collect, Collector, TIME_BUDGET
+from writers import csv_header, csv_row
+
+
+def find_files(paths):
+    """ DAT files of `paths`, folders are expanded to their sorted files """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in dat_files(path)]
+        else:
+            files.append(path)
+    return files
+
+
+def load_fitting():
+    """
+    Import the fitting modules, with the Agg backend of matplotlib if there
+    is no display (lmfit imports pyplot)
+
+    Returns
+    -------
+    seconds : float
+        time taken by the imports
+    """
+    start = time.time()
+    import backend
+    backend.select_backend()
+    # imported for the time they take, `fit_files` uses them
+    import supervisor  # noqa
+    import brillouin  # noqa
+    return time.time() - start
+
+
+def fit_files(files, out, spacing=0.56, crossed=False, series=False,
+              covar=False, verbose=True, **fit_kws):
+    """
+    Fit the files and write a line of output.csv for each to `out` as soon
+    as it is done. Files that fail are reported on stderr and left out.
+    Call `load_fitting` first when there is no display.
+
+    Parameters
+    ----------
+    files : list of string
+    out : file
+    spacing : float (default=0.56)
+        mirror spacing in cm
+    crossed : bool (default=False)
+    series : bool (default=False)
+        start each fit from the fits of the file before it
+    covar : bool (default=False)
+        see `brillouin.results_array`
+    verbose : bool (default=True)
+        print the report of every fit
+    fit_kws :
+        options of `supervisor.supervised_fit`
+
+    Returns
+    -------
+    failed : list of string
+    """
+    import spectra
+    from supervisor import supervised_fit
+    from brillouin import results_array
+    spectra.verbose = verbose
+    out.write(csv_header())
+    failed = []
+    previous = None
+    for fname in files:
+        try:
+            header, counts = read_dat(fname)
+            fits, status = supervised_fit(
+                counts, previous if series else None, **fit_kws)
+            n, s = results_array([fits], spacing=spacing, crossed=crossed,
+                                 covar=covar)
+        except Exception as e:
+            sys.stderr.write("%s: %s: %s\n" % (fname, type(e).__name__, e))
+            failed.append(fname)
+            previous = None
+            continue
+        previous = fits
+        out.write(csv_row(os.path.basename(fname),
+                          zip(n[0].tolist(), s[0].tolist()), status))
+        out.flush()
+    return failed
+
+
+def main():
+    start = time.time()
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='DAT files or folders of them')
+    parser.add_argument('-s', '--spacing', type=float, default=0.56,
+                        help='mirror spacing in cm')
+    parser.add_argument('-c', '--crossed', action='store_true',
+                        help='brillouin peaks are crossed')
+    parser.add_argument('--series', action='store_true',
+                        help='start each fit from the previous file')
+    parser.add_argument('--peaks', choices=['cwt', 'prominence'],
+                        default='cwt',
+                        help='peak search in the inelastic windows')
+    parser.add_argument('--covar', action='store_true',
+                        help='use the fit covariance for the uncertainties')
+    parser.add_argument('--time-budget', type=float, default=TIME_BUDGET,
+                        help='seconds of fitting allowed per file')
+    parser.add_argument('-o', '--output',
+                        help='csv file to write, stdout if not given')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the report of every fit')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the startup and fitting times to stderr')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        parser.error("no DAT files in %s" % " ".join(args.paths))
+    # the fit reports go to stderr so they do not mix with the csv
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    out = open(args.output, 'w') if args.output else stdout
+    startup = time.time() - start
+    try:
+        imports = load_fitting()
+        with collect() as events:
+            failed = fit_files(files, out, args.spacing, args.crossed,
+                               args.series, args.covar, not args.quiet,
+                               peak_method=args.peaks,
+                               time_budget=args.time_budget)
+    finally:
+        if args.output:
+            out.close()
+        sys.stdout = stdout
+    total = time.time() - start
+    sys.stderr.write("Fitted %s of %s files\n" % (len(files) - len(failed),
+                                                 len(files)))
+    if args.profile:
+        sys.stderr.write("startup %.3f s, fitting imports %.3f s, total "
+                         "%.3f s\n" % (startup, imports, total))
+        sys.stderr.write(Collector(events).report(total) + "\n")
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,51 +6,665 @@ file
 author: Rohan Isaac
 """
 import os
-from brillouin import fit_file, plot_fit, calculate_shifts, peak_widths
+import time
+import argparse
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+from brillouin import plot_data, render_fit, results_array
+import spectra
+from datfile import (dat_files, load_folder, read_dat, read_header,
+                     HEADER_DTYPE)
+from global_fit import fit_global
+from store import FitStore, file_hash, fit_params
+from supervisor import supervised_fit, TIME_BUDGET, MAX_NFEV
+from instrument import timed, collect, Collector
+from writers import (WRITERS, result_columns, curve_array, write_results,
+                     csv_header, csv_row, csv_footer)
 
 # ----------------------------------------------------------------------------
 # Set user defined variables here
 spacing = 0.56  # cm
 crossed = False  # case-sensitive
 folder = 'sample_data'
+workers = 1  # number of processes, 0 uses one per core
+cache = False  # keep the parsed spectra in a cache file in the folder
+incremental = False  # only refit files that are new or changed
+series = False  # start each fit from the previous file's fit
+peak_method = 'cwt'  # 'cwt' or 'prominence'
+global_fit = False  # fit each spectrum as one model, see global_fit.py
+time_budget = TIME_BUDGET  # seconds of fitting per file before giving up
+plot = 'background'  # 'none', 'demand' (render later) or 'background'
+profile = False  # print where the time went at the end
+verbose = True  # print the progress and report of every fit
 # end user defined parameters
 # ----------------------------------------------------------------------------
 
 
-def process_folder(fol, spacing, crossed):
+def store_settings(peak_method='cwt', covar=False, series=False,
+                   global_fit=False, time_budget=TIME_BUDGET):
+    """
+    Settings the results of a file are stored with in the `store.FitStore`
+    of its folder besides spacing and crossed, stored results are only
+    reused with the same settings. See `process_folder` for the arguments.
+    """
+    return {'peak_method': peak_method, 'covar': bool(covar),
+            'series': bool(series), 'global_fit': bool(global_fit),
+            'time_budget': time_budget}
+
+
+@timed('process_file')
+def process_file(fname, spacing, crossed, counts=None, previous=None,
+                 plot=True, covar=False, global_fit=False,
+                 time_budget=TIME_BUDGET, max_nfev=MAX_NFEV, **fit_kws):
+    """
+    Fit, plot and compute the shifts and peak widths of a single DAT file
+
+    Parameters
+    ----------
+    counts : array (default=None)
+        counts of the file if already loaded, otherwise the file is read
+    previous : tuple of Spectra (default=None)
+        fits of the previous file in a series to start from, see
+        `brillouin.fit_counts`
+    plot : bool (default=True)
+        save a pdf of the fit next to the file
+    covar : bool (default=False)
+        propagate the covariance of the fitted centers into the shift
+        uncertainties, see `brillouin.results_array`
+    global_fit : bool (default=False)
+        fit the spectrum as a single model with `global_fit.fit_global`
+        instead of in three sections, the uncertainties are then always
+        from its joint covariance
+    time_budget, max_nfev :
+        fitting time and function evaluations allowed for the file, see
+        `supervisor.supervised_fit`. A global fit is not retried, it gets
+        the whole budget, is 'suspect:not-converged' when it runs out of
+        function evaluations and fails when it runs out of time.
+    fit_kws :
+        other options of `brillouin.fit_counts` (or `global_fit.fit_global`)
+
+    Returns
+    -------
+    values : list of (value, uncertainty) tuples, the four shifts and their
+        average followed by the seven peak widths
+    params : list of dict
+        fit parameters of the three sections (or the global fit), see
+        `store.fit_params`
+    fits : tuple of Spectra
+        the three fit objects, or (GlobalFit,)
+    status : string
+        'ok', or how the fit was retried or why it is suspect, see
+        `supervisor.supervised_fit`
+    """
+    if counts is None:
+        header, counts = read_dat(fname)
+    if global_fit:
+        deadline = time.time() + time_budget if time_budget else None
+        g = fit_global(counts, spacing, crossed,
+                       previous[0] if previous is not None else None,
+                       max_nfev=max_nfev, deadline=deadline, **fit_kws)
+        if getattr(g.out, 'aborted', False):
+            raise ValueError("no usable fit (global: budget)")
+        fits = (g,)
+        status = 'ok' if g.out.success else 'suspect:not-converged'
+        n, s = g.results()
+    else:
+        fits, status = supervised_fit(counts, previous, time_budget,
+                                      max_nfev, **fit_kws)
+        n, s = results_array([fits], spacing=spacing, crossed=crossed,
+                             covar=covar)
+        n, s = n[0], s[0]
+    if plot:
+        render_fit(fit_plot_data(fits), fname[:-3] + 'pdf',
+                   filename=os.path.basename(fname), spacing=spacing,
+                   crossed=crossed)
+    values = zip(n.tolist(), s.tolist())
+    return values, fit_params(fits), fits, status
+
+
+def fit_plot_data(fits):
+    """ `brillouin.plot_data` of the fits of a file from `process_file` """
+    if len(fits) == 1:
+        return fits[0].plot_data()
+    return plot_data(*fits)
+
+
+@contextmanager
+def _events(profile):
+    """ Collect the instrumentation events in the block if `profile` """
+    if profile:
+        with collect() as events:
+            yield events
+    else:
+        yield []
+
+
+def _process_job(job):
+    """
+    Worker wrapper around `process_file`. Any error is caught and returned so
+    that one bad file does not stop the rest of the batch. The plot is not
+    drawn, its `brillouin.plot_data` is returned instead if requested, as
+    well as the instrumentation events when profiling
+    """
+    fname, spacing, crossed, counts, opts, fit_kws = job
+    spectra.verbose = opts['verbose']
+    with _events(opts['profile']) as events:
+        try:
+            values, params, fits, status = process_file(
+                fname, spacing, crossed, counts, plot=False, **fit_kws)
+            data = fit_plot_data(fits) if opts['plot'] else None
+            return fname, (values, params, data, status), None, events
+        except Exception as e:
+            return (fname, None, '{}: {}'.format(type(e).__name__, e),
+                    events)
+
+
+def _process_run(jobs):
+    """
+    Worker for series mode, processes a run of consecutive files in order,
+    starting each fit from the fits of the file before it
+    """
+    results = []
+    previous = None
+    for fname, spacing, crossed, counts, opts, fit_kws in jobs:
+        spectra.verbose = opts['verbose']
+        with _events(opts['profile']) as events:
+            try:
+                values, params, previous, status = process_file(
+                    fname, spacing, crossed, counts, previous, plot=False,
+                    **fit_kws)
+                data = fit_plot_data(previous) if opts['plot'] else None
+                results.append((fname, (values, params, data, status), None,
+                                events))
+            except Exception as e:
+                previous = None
+                results.append((fname, None,
+                                '{}: {}'.format(type(e).__name__, e), events))
+    return results
+
+
+def _render_job(job):
+    """
+    Worker that saves the pdf of a file from its plot data, returns the
+    filename and the error if it failed
+    """
+    fname, spacing, crossed, data, fit_csv = job
+    try:
+        render_fit(data, fname[:-3] + 'pdf', filename=os.path.basename(fname),
+                   spacing=spacing, crossed=crossed, fit_csv=fit_csv)
+        return fname, None
+    except Exception as e:
+        return fname, '{}: {}'.format(type(e).__name__, e)
+
+
+def render_folder(fol, files=None, workers=1):
+    """
+    Save the plots of a folder processed with `plot='demand'`, from the plot
+    data kept in its `store.FitStore`
+
+    Parameters
+    ----------
+    files : list of string (default=None)
+        DAT filenames to plot, all the stored files if None
+    workers : int (default=1)
+        number of processes to render with, 0 or None uses one per core
+
+    Returns
+    -------
+    failed : list of string
+        files that could not be plotted
+    """
     folname = os.path.abspath(fol)
-    out_file = open(os.path.join(folname, 'output.csv'), 'w')
-
-    # write header (shifts, avg, peak_widths (laser and brillouin))
-    out_file.write("Filename,")
-    out_file.write("".join(["F{0},u_F{0},".format(i) for i in range(1, 5)]))
-    out_file.write("F_avg,u_F_avg,")
-    out_file.write("".join(["l{0},u_l{0},".format(i) for i in range(1, 4)]))
-    out_file.write("".join(["b{0},u_b{0},".format(i) for i in range(1, 5)]))
-    out_file.write("\n")
-
-    for f in os.listdir(folname):
-        if f.endswith('.DAT'):
-            fname = os.path.join(folname, f)
-
-            a, b, c = fit_file(fname)
-            plot_fit(a, b, c, fname[:-3] + 'pdf',
-                     filename=f, spacing=spacing, crossed=crossed)
-            shifts = calculate_shifts(
-                a, b, c, spacing=spacing, crossed=crossed)
-            fwhms = peak_widths(a, b, c)
-            out_file.write(f+',')
-            out_file.write(
-                "".join(["{},{},".format(a.n, a.s) for a in shifts]))
-            out_file.write("".join(["{},{},".format(a.n, a.s) for a in fwhms]))
-            out_file.write("\n")
-    out_file.write("\nFolder{}\nSpacing:{} cm\nCrossed:{}\n".format(
-        fol, spacing, crossed))
+    store = FitStore(folname)
+    jobs = [(os.path.join(folname, f), s, c, data, True)
+            for f, s, c, data in store.plots(files)]
+    store.close()
+    if files is not None and len(jobs) < len(files):
+        print "No stored fit for %s of %s files" % (len(files) - len(jobs),
+                                                    len(files))
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, max(len(jobs), 1))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(_render_job, jobs)
+    else:
+        pool = None
+        results = (_render_job(j) for j in jobs)
+
+    failed = []
+    try:
+        for fname, error in results:
+            if error is not None:
+                f = os.path.basename(fname)
+                print "Failed to plot %s (%s)" % (f, error)
+                failed.append(f)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print "Plotted %s of %s files" % (len(jobs) - len(failed), len(jobs))
+    return failed
+
+
+def write_output(fol, rows, spacing, crossed):
+    """
+    Write output.csv in folder `fol`
+
+    Parameters
+    ----------
+    rows : list of (filename, values, status)
+        values and status as returned by `process_file`
+    """
+    out_file = open(os.path.join(os.path.abspath(fol), 'output.csv'), 'w')
+    out_file.write(csv_header())
+    for f, values, status in rows:
+        out_file.write(csv_row(f, values, status))
+
+    out_file.write(csv_footer(fol, spacing, crossed))
     out_file.close()
 
 
+def process_folder(fol, spacing, crossed, workers=1, cache=False,
+                   incremental=False, series=False, peak_method='cwt',
+                   global_fit=False, plot='background', render_workers=1,
+                   profile=False, verbose=True, covar=False, formats=(),
+                   time_budget=TIME_BUDGET, progress=None, cancel=None):
+    """
+    Process every DAT file in `fol` and write the results to output.csv
+
+    Parameters
+    ----------
+    fol : string
+        folder containing the DAT files
+    spacing : float
+        mirror spacing in cm
+    crossed : bool
+        if the brillouin peaks are crossed
+    workers : int (default=1)
+        number of processes to fit files with, 0 or None uses one per core.
+        Rows are always written in sorted filename order.
+    cache : bool (default=False)
+        read the spectra through the folder cache (see `datfile.load_folder`)
+        so that re-processing a folder does not parse the DAT files again
+    incremental : bool (default=False)
+        keep the results in a `store.FitStore` in the folder and only fit
+        (and plot) files that are new, changed, or were fitted with
+        different settings (spacing, crossed, peak_method, covar, series,
+        global_fit or time_budget). output.csv is always rebuilt for all files.
+    series : bool (default=False)
+        treat the files (in sorted order) as a time series of the same
+        sample, and start each fit from the converged fit of the previous
+        file instead of a peak search. With several workers each one
+        processes a contiguous run of files.
+    peak_method : string (default='cwt')
+        peak search in the inelastic windows, 'cwt' or 'prominence'
+    global_fit : bool (default=False)
+        fit each spectrum as one model, with L2 tied to the midpoint of L1
+        and L3 and the shifts as parameters, see `global_fit.fit_global`
+    plot : string (default='background')
+        how the pdf of each fit is made. 'none' skips plotting, 'demand'
+        keeps the plot data in the folder's `store.FitStore` to be rendered
+        later with `render_folder`, and 'background' renders the plots in
+        separate processes while the fitting goes on
+    render_workers : int (default=1)
+        number of processes rendering plots in 'background' mode
+    profile : bool (default=False)
+        time the fitting stages of every file (see `instrument`) and print a
+        summary of where the time went
+    verbose : bool (default=True)
+        print the progress and fit report of every fit
+    covar : bool (default=False)
+        use the covariance of the fitted peak centers for the shift
+        uncertainties instead of treating them as independent
+    formats : list of string (default=())
+        also write the results of all files as typed columns to output.npz,
+        output.h5 and/or output.parquet ('npz', 'hdf5', 'parquet', see
+        `writers`), with the fit status and DAT header of every file and the
+        best-fit curves as one array. The plots then skip the _fit.csv
+        files.
+    time_budget : float (default=`supervisor.TIME_BUDGET`)
+        seconds of fitting allowed per file. Failed fits are retried with
+        other strategies within this time, see `supervisor.supervised_fit`,
+        and the status column of output.csv says how each file was fitted.
+    progress : function (default=None)
+        called as progress(done, total, filename, error) after each file is
+        fitted, error is None unless the fit failed
+    cancel : threading.Event (default=None)
+        when set the remaining fits are abandoned, output.csv is written
+        with the files fitted so far
+
+    Returns
+    -------
+    failed : list of string
+        files that could not be fitted
+    """
+    start = time.time()
+    folname = os.path.abspath(fol)
+    if cache:
+        files, headers, counts = load_folder(folname)
+        counts_list = [np.array(c) for c in counts]
+    else:
+        files = dat_files(folname)
+        counts_list = [None] * len(files)
+
+    if plot not in ('none', 'demand', 'background'):
+        raise ValueError("plot must be 'none', 'demand' or 'background'")
+    for fmt in formats:
+        if fmt not in WRITERS:
+            raise ValueError("unknown output format %r" % fmt)
+    store = FitStore(folname) if incremental or plot == 'demand' else None
+    settings = store_settings(peak_method, covar, series, global_fit,
+                              time_budget)
+    done = {}
+    status = {}
+    digests = {}
+    jobs = []
+    for f, c in zip(files, counts_list):
+        fname = os.path.join(folname, f)
+        if store is not None:
+            digests[f] = file_hash(fname)
+        if incremental:
+            values = store.get(f, digests[f], spacing, crossed, settings)
+            if values is not None:
+                done[f] = values
+                status[f] = store.status(f)
+                continue
+        opts = {'plot': plot != 'none' or bool(formats), 'profile': profile,
+                'verbose': verbose}
+        jobs.append((fname, spacing, crossed, c, opts,
+                     {'peak_method': peak_method, 'covar': covar,
+                      'global_fit': global_fit,
+                      'time_budget': time_budget}))
+    if incremental:
+        print "%s of %s files unchanged, fitting %s" % (
+            len(done), len(files), len(jobs))
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, max(len(jobs), 1))
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+    renders = []
+    render_pool = None
+    if plot == 'background' and jobs:
+        render_pool = multiprocessing.Pool(max(render_workers or 1, 1))
+    if series:
+        # split into one contiguous run of files per worker
+        size = max(-(-len(jobs) // workers), 1)
+        runs = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        if pool is not None:
+            runs = pool.imap(_process_run, runs)
+        else:
+            runs = (_process_run(r) for r in runs)
+        results = (r for run in runs for r in run)
+    elif pool is not None:
+        results = pool.imap(_process_job, jobs)
+    else:
+        results = (_process_job(j) for j in jobs)
+
+    failed = []
+    plots = {}
+    collector = Collector()
+    cancelled = False
+    try:
+        for n, (fname, result, error, events) in enumerate(results):
+            collector.events.extend(events)
+            f = os.path.basename(fname)
+            if progress is not None:
+                progress(n + 1, len(jobs), f, error)
+            if error is not None:
+                print "Failed to fit %s, skipping (%s)" % (f, error)
+                failed.append(f)
+            else:
+                values, params, data, status[f] = result
+                done[f] = values
+                if formats:
+                    plots[f] = data
+                if store is not None:
+                    store.put(f, digests[f], spacing, crossed, params,
+                              values, status[f], settings)
+                    if plot == 'demand':
+                        store.put_plot(f, spacing, crossed, data)
+                if render_pool is not None:
+                    renders.append(render_pool.apply_async(
+                        _render_job, ((fname, spacing, crossed, data,
+                                       not formats),)))
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+    finally:
+        if pool is not None:
+            if cancelled:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if render_pool is not None:
+            render_pool.close()
+            render_pool.join()
+        if store is not None:
+            store.prune(files)
+            store.close()
+
+    write_output(fol, [(f, done[f], status[f]) for f in files if f in done],
+                 spacing, crossed)
+    if formats:
+        if not cache:
+            headers = np.array([read_header(os.path.join(folname, f))
+                                for f in files], dtype=HEADER_DTYPE)
+        empty = [(np.nan, np.nan)] * 12
+        table = np.array([done.get(f, empty) for f in files], dtype=float)
+        columns = result_columns(files, table[..., 0], table[..., 1],
+                                 [status.get(f, 'failed') for f in files],
+                                 headers)
+        meta = {'folder': folname, 'spacing': spacing,
+                'crossed': bool(crossed), 'peak_method': peak_method,
+                'series': bool(series), 'covar': bool(covar),
+                'global_fit': bool(global_fit), 'time_budget': time_budget,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        curves = curve_array([plots.get(f) for f in files])
+        for fmt in formats:
+            write_results(os.path.join(folname, 'output'), fmt, columns,
+                          meta, curves)
+
+    for r in renders:
+        fname, error = r.get()
+        if error is not None:
+            print "Failed to plot %s (%s)" % (os.path.basename(fname), error)
+
+    if cancelled:
+        print "Cancelled, %s of %s files fitted" % (n + 1, len(jobs))
+    if failed:
+        print "%s of %s files failed to fit: %s" % (len(failed), len(jobs),
+                                                    ", ".join(failed))
+    if profile:
+        wall = time.time() - start
+        stages = collector.summary()
+        busy = stages.get('process_file', {}).get('seconds')
+        print "\n%s files in %.2f s (%.2f files/s), %s workers" % (
+            len(jobs), wall, len(jobs) / wall, workers)
+        print collector.report(total=busy)
+    return failed
+
+
+def watch_folder(fol, spacing, crossed, interval=1.0, plot=False,
+                 idle_timeout=None, verbose=True, **fit_kws):
+    """
+    Watch a folder while the instrument writes to it, and fit every new DAT
+    file as soon as it is complete, appending its row to output.csv.
+
+    A file counts as complete once its size and modification time are the
+    same on two polls and it holds all 256 channels. Each fit is started
+    from the previous one (see `brillouin.fit_counts`), and files already in
+    output.csv are skipped, so the watch can be stopped (Ctrl-C) and
+    restarted, also on a folder processed with `process_folder`. The footer
+    of output.csv is taken off while watching and written again at the end.
+    Only the filenames seen and the last fit are kept in memory.
+
+    Parameters
+    ----------
+    interval : float (default=1.0)
+        seconds between polls of the folder
+    plot : bool (default=False)
+        also save a pdf of every fit (slower)
+    idle_timeout : float (default=None)
+        stop after this many seconds without a new file, watch forever if
+        None
+    verbose : bool (default=True)
+        print the report of every fit, a line per file is always printed
+    fit_kws :
+        options of `process_file` (peak_method, covar, global_fit,
+        time_budget, ...)
+
+    Raises
+    ------
+    ValueError
+        if output.csv was written with another spacing or crossed setting
+    """
+    spectra.verbose = verbose
+    folname = os.path.abspath(fol)
+    out_path = os.path.join(folname, 'output.csv')
+    footer = csv_footer(fol, spacing, crossed)
+
+    # rows end at the blank line before the footer of `write_output`
+    rows = []
+    if os.path.exists(out_path):
+        with open(out_path) as f:
+            lines = f.read().splitlines()
+        end = lines.index('') if '' in lines else len(lines)
+        rows = [line for line in lines[1:end]
+                if line.split(',', 1)[0].endswith('.DAT')]
+        settings = footer.splitlines()[2:]
+        if lines[end + 2:end + 4] not in ([], settings):
+            raise ValueError("%s was written with %s, not %s" % (
+                out_path, ", ".join(lines[end + 2:end + 4]),
+                ", ".join(settings)))
+    with open(out_path, 'w') as f:
+        f.write(csv_header())
+        f.writelines(line + "\n" for line in rows)
+    done = set(line.split(',', 1)[0] for line in rows)
+
+    pending = {}
+    previous = None
+    last_new = time.time()
+    print "Watching %s (Ctrl-C to stop)" % folname
+    try:
+        while idle_timeout is None or time.time() - last_new < idle_timeout:
+            for f in dat_files(folname):
+                if f in done:
+                    continue
+                fname = os.path.join(folname, f)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                stamp = (st.st_size, st.st_mtime)
+                if pending.get(f) != stamp:
+                    # new or still growing, check again on the next poll
+                    pending[f] = stamp
+                    continue
+                try:
+                    header, counts = read_dat(fname)
+                except ValueError:
+                    continue
+
+                start = time.time()
+                del pending[f]
+                done.add(f)
+                last_new = start
+                try:
+                    values, params, previous, status = process_file(
+                        fname, spacing, crossed, counts, previous,
+                        plot=plot, **fit_kws)
+                except Exception as e:
+                    previous = None
+                    print "Failed to fit %s, skipping (%s: %s)" % (
+                        f, type(e).__name__, e)
+                    continue
+                with open(out_path, 'a') as out_file:
+                    out_file.write(csv_row(f, values, status))
+                print "%s: F_avg = %.4f +/- %.4f /cm (%.2f s, %s)" % (
+                    f, values[4][0], values[4][1], time.time() - start,
+                    status)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with open(out_path, 'a') as out_file:
+            out_file.write(footer)
+    print "Stopped watching %s, %s files in output.csv" % (folname, len(done))
+
+
 def main():
-    process_folder(folder, spacing, crossed)
+    parser = argparse.ArgumentParser(
+        description='Fit all the DAT files in a folder and write output.csv')
+    parser.add_argument('folder', nargs='?', default=folder)
+    parser.add_argument('-s', '--spacing', type=float, default=spacing,
+                        help='mirror spacing in cm')
+    parser.add_argument('-c', '--crossed', action='store_true',
+                        default=crossed, help='brillouin peaks are crossed')
+    parser.add_argument('-w', '--workers', type=int, default=workers,
+                        help='number of processes, 0 uses one per core')
+    parser.add_argument('--cache', action='store_true', default=cache,
+                        help='cache the parsed spectra in the folder')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        default=incremental,
+                        help='only fit new or changed files')
+    parser.add_argument('--series', action='store_true', default=series,
+                        help='start each fit from the previous file')
+    parser.add_argument('--peaks', choices=['cwt', 'prominence'],
+                        default=peak_method,
+                        help='peak search in the inelastic windows')
+    parser.add_argument('--global', action='store_true', dest='global_fit',
+                        default=global_fit,
+                        help='fit each spectrum as a single model')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep fitting new files as they are written')
+    parser.add_argument('-p', '--plot',
+                        choices=['none', 'demand', 'background'],
+                        default=plot, help='how the fit plots are made')
+    parser.add_argument('-f', '--format', nargs='+', default=[],
+                        choices=list(WRITERS),
+                        help='also write the results in these formats')
+    parser.add_argument('--covar', action='store_true',
+                        help='use the fit covariance for the uncertainties')
+    parser.add_argument('--time-budget', type=float, default=time_budget,
+                        help='seconds of fitting allowed per file')
+    parser.add_argument('--profile', action='store_true', default=profile,
+                        help='print the time spent in each fitting stage')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        default=not verbose,
+                        help='do not print the report of every fit')
+    parser.add_argument('--render', nargs='*', metavar='FILE',
+                        help='only render the plots stored with --plot '
+                        'demand, of the given files or all of them')
+    args = parser.parse_args()
+    if args.render is not None:
+        render_folder(args.folder, args.render or None, args.workers)
+        return
+    if args.watch:
+        if args.plot == 'demand':
+            parser.error("--plot demand keeps the plots in the fit store, "
+                         "which --watch does not use")
+        watch_folder(args.folder, args.spacing, args.crossed,
+                     plot=args.plot != 'none', verbose=not args.quiet,
+                     peak_method=args.peaks, global_fit=args.global_fit,
+                     covar=args.covar, time_budget=args.time_budget)
+        return
+    process_folder(args.folder, args.spacing, args.crossed,
+                   workers=args.workers, cache=args.cache,
+                   incremental=args.incremental, series=args.series,
+                   peak_method=args.peaks, global_fit=args.global_fit,
+                   plot=args.plot,
+                   profile=args.profile, verbose=not args.quiet,
+                   covar=args.covar, formats=args.format,
+                   time_budget=args.time_budget)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
@@ -1,69 +1,176 @@
 #!/usr/bin/env python
 """
 description: GUI for folder processing script. Takes folder, spacing and bool
-peak crossed value and runs folder process to output csv
+peak crossed value and runs folder process to output csv. The folder is
+processed in a background thread that reports progress through a queue, so
+the window stays responsive and the run can be cancelled
 author: Rohan Isaac
 """
+from __future__ import division
+import time
+import threading
+import multiprocessing
+import Queue
 import Tkinter as tk
 import tkFileDialog
 import ttk
 from brillouin_folder import process_folder
 
+# how often the window checks for progress, in ms
+POLL_INTERVAL = 100
+
+events = Queue.Queue()
+cancel_event = threading.Event()
+
+
+def run(folder_value, spacing_value, crossed_value):
+    """ Process the folder, runs in the worker thread """
+    def progress(done, total, filename, error):
+        events.put(('progress', done, total, filename, error))
+
+    try:
+        failed = process_folder(folder_value, spacing_value, crossed_value,
+                                verbose=False, progress=progress,
+                                cancel=cancel_event)
+        events.put(('done', failed))
+    except Exception as e:
+        events.put(('error', '{}: {}'.format(type(e).__name__, e)))
+
 
 def process(*args):
     try:
-        output.set('Processing folder...')
         folder_value = str(folder.get())
         spacing_value = float(spacing.get())
-        crossed_value = bool(crossed.get())
-        process_folder(folder_value, spacing_value, crossed_value)
-        output.set('Done.')
-    except:
+        crossed_value = bool(int(crossed.get() or 0))
+    except ValueError:
         output.set('Error! Check paramters and try again')
+        return
+
+    cancel_event.clear()
+    failures.delete(0, tk.END)
+    progress_bar['value'] = 0
+    output.set('Processing folder...')
+    process_button.state(['disabled'])
+    cancel_button.state(['!disabled'])
+    state['start'] = time.time()
+
+    worker = threading.Thread(target=run, args=(folder_value, spacing_value,
+                                                crossed_value))
+    worker.daemon = True
+    worker.start()
+    root.after(POLL_INTERVAL, poll)
+
+
+def cancel(*args):
+    cancel_event.set()
+    cancel_button.state(['disabled'])
+    output.set('Cancelling after the current file...')
+
+
+def poll():
+    """ Show the events from the worker thread, until it is finished """
+    finished = False
+    while True:
+        try:
+            event = events.get_nowait()
+        except Queue.Empty:
+            break
+        if event[0] == 'progress':
+            done, total, filename, error = event[1:]
+            elapsed = time.time() - state['start']
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            progress_bar['maximum'] = total
+            progress_bar['value'] = done
+            if not cancel_event.is_set():
+                output.set('%s of %s files, %.2f files/s, %d s left' % (
+                    done, total, rate, eta))
+            if error is not None:
+                failures.insert(tk.END, '%s: %s' % (filename, error))
+        elif event[0] == 'done':
+            failed = event[1]
+            finished = True
+            if cancel_event.is_set():
+                output.set('Cancelled.')
+            elif failed:
+                output.set('Done, %s files failed.' % len(failed))
+            else:
+                output.set('Done.')
+        elif event[0] == 'error':
+            finished = True
+            output.set('Error! %s' % event[1])
+
+    if finished:
+        process_button.state(['!disabled'])
+        cancel_button.state(['disabled'])
+    else:
+        root.after(POLL_INTERVAL, poll)
 
 
 def askdirectory(*args):
     folder.set(tkFileDialog.askdirectory())
     output.set('')
 
-root = tk.Tk()
-root.title("Brillouin data processing")
 
-mainframe = ttk.Frame(root, padding="3 5 12 12")
-mainframe.grid(column=0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
-mainframe.columnconfigure(0, weight=1)
-mainframe.rowconfigure(0, weight=1)
+def main():
+    """ Build the window, the widgets are module globals of the callbacks """
+    global root, folder, spacing, crossed, output, state, progress_bar
+    global failures, process_button, cancel_button
+    root = tk.Tk()
+    root.title("Brillouin data processing")
+
+    mainframe = ttk.Frame(root, padding="3 5 12 12")
+    mainframe.grid(column=0, row=0, sticky=(tk.N, tk.W, tk.E, tk.S))
+    mainframe.columnconfigure(0, weight=1)
+    mainframe.rowconfigure(0, weight=1)
+
+    folder = tk.StringVar()
+    spacing = tk.StringVar()
+    crossed = tk.StringVar()
+    output = tk.StringVar()
+    state = {'start': None}
 
-folder = tk.StringVar()
-spacing = tk.StringVar()
-crossed = tk.StringVar()
-output = tk.StringVar()
+    folder_entry = ttk.Entry(mainframe, width=20, textvariable=folder)
+    spacing_entry = ttk.Entry(mainframe, width=7, textvariable=spacing)
 
-folder_entry = ttk.Entry(mainframe, width=20, textvariable=folder)
-spacing_entry = ttk.Entry(mainframe, width=7, textvariable=spacing)
+    folder_entry.grid(column=2, row=1, sticky=(tk.W, tk.E))
+    spacing_entry.grid(column=2, row=2, sticky=(tk.W, tk.E))
 
+    ttk.Label(mainframe, textvariable=output).grid(
+        column=2, row=4, sticky=(tk.W, tk.E))
+    ttk.Checkbutton(mainframe, text="Peaks crossed?",
+                    variable=crossed).grid(column=2, row=3, stick=tk.E)
+    ttk.Label(mainframe, text="Folder").grid(column=1, row=1, sticky=tk.E)
+    ttk.Label(mainframe, text="Spacing").grid(column=1, row=2, sticky=tk.E)
+    ttk.Label(mainframe, text="Status").grid(column=1, row=4, sticky=tk.E)
+    ttk.Label(mainframe, text="cm").grid(column=3, row=2, sticky=tk.W)
+    ttk.Button(mainframe, text="Browse", command=askdirectory).grid(
+        column=3, row=1, sticky=tk.E)
 
-folder_entry.grid(column=2, row=1, sticky=(tk.W, tk.E))
-spacing_entry.grid(column=2, row=2, sticky=(tk.W, tk.E))
+    progress_bar = ttk.Progressbar(mainframe, orient=tk.HORIZONTAL,
+                                   mode='determinate')
+    progress_bar.grid(column=2, row=5, sticky=(tk.W, tk.E))
+    ttk.Label(mainframe, text="Failed").grid(column=1, row=6, sticky=(tk.N,
+                                                                      tk.E))
+    failures = tk.Listbox(mainframe, width=50, height=5)
+    failures.grid(column=2, row=6, sticky=(tk.W, tk.E))
 
-ttk.Label(mainframe, textvariable=output).grid(
-    column=2, row=4, sticky=(tk.W, tk.E))
-ttk.Checkbutton(mainframe, text="Peaks crossed?",
-                variable=crossed).grid(column=2, row=3, stick=tk.E)
-ttk.Label(mainframe, text="Folder").grid(column=1, row=1, sticky=tk.E)
-ttk.Label(mainframe, text="Spacing").grid(column=1, row=2, sticky=tk.E)
-ttk.Label(mainframe, text="Status").grid(column=1, row=4, sticky=tk.E)
-ttk.Label(mainframe, text="cm").grid(column=3, row=2, sticky=tk.W)
-ttk.Button(mainframe, text="Browse", command=askdirectory).grid(
-    column=3, row=1, sticky=tk.E)
-ttk.Button(mainframe, text="Process", command=process).grid(
-    column=3, row=5, sticky=tk.W)
+    process_button = ttk.Button(mainframe, text="Process", command=process)
+    process_button.grid(column=3, row=7, sticky=tk.W)
+    cancel_button = ttk.Button(mainframe, text="Cancel", command=cancel)
+    cancel_button.grid(column=2, row=7, sticky=tk.E)
+    cancel_button.state(['disabled'])
 
+    for child in mainframe.winfo_children():
+        child.grid_configure(padx=5, pady=5)
 
-for child in mainframe.winfo_children():
-    child.grid_configure(padx=5, pady=5)
+    folder_entry.focus()
+    root.bind('<Return>', process)
 
-folder_entry.focus()
-root.bind('<Return>', process)
+    root.mainloop()
 
-root.mainloop()
+if __name__ == '__main__':
+    # the folder is rendered in a pool of processes, which re-import this
+    # module on Windows and in the frozen executable
+    multiprocessing.freeze_support()
+    main()
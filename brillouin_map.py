@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+description: mapping mode for rasters of brillouin files taken at (x, y)
+stage positions. The counts of the grid are kept as a memory-mapped
+(ny, nx, 256) cube, fitted in tiles, and the shifts, peak widths and their
+uncertainties are written to memory-mapped (ny, nx, 12) maps, so maps larger
+than memory can be processed and an interrupted run resumes at the first
+unfinished tile
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+import spectra as sp
+from batch_fit import fit_stack
+from brillouin import results_array, shift_array, width_array
+from datfile import CHANNELS, dat_files, read_dat
+from supervisor import supervised_fit
+from writers import VALUE_NAMES
+
+MAP_DIR = 'map'
+META_FILE = 'map.json'
+# arrays of a map directory, see `open_map`
+ARRAYS = ['counts', 'present', 'values', 'errors', 'status', 'tiles']
+STATUS_DTYPE = 'S32'
+
+
+def grid_files(files, pattern=None, shape=None, serpentine=False):
+    """
+    Place DAT files on a grid
+
+    Parameters
+    ----------
+    files : list of string
+        DAT filenames
+    pattern : string (default=None)
+        regular expression with named groups `x` and `y`, searched in each
+        filename for its stage position. The grid axes are the sorted
+        distinct positions, and files that do not match are left out.
+    shape : (ny, nx) (default=None)
+        without a `pattern`, the files in sorted order fill the grid a row
+        at a time
+    serpentine : bool (default=False)
+        with `shape`, every other row was scanned backwards
+
+    Returns
+    -------
+    names : np.ndarray of object (ny, nx)
+        filename at each grid point, None where there is no file
+    xs, ys : np.ndarray
+        stage positions of the columns and rows, the indices without a
+        `pattern`
+    """
+    files = sorted(files)
+    if pattern is not None:
+        regex = re.compile(pattern)
+        pos = {}
+        for f in files:
+            m = regex.search(f)
+            if m is not None:
+                pos[f] = (float(m.group('y')), float(m.group('x')))
+        if not pos:
+            raise ValueError("no filename matches %r" % pattern)
+        ys = np.unique([p[0] for p in pos.values()])
+        xs = np.unique([p[1] for p in pos.values()])
+        names = np.empty((len(ys), len(xs)), dtype=object)
+        for f, (y, x) in pos.items():
+            names[np.searchsorted(ys, y), np.searchsorted(xs, x)] = f
+        return names, xs, ys
+
+    if shape is None:
+        raise ValueError("need a filename pattern or a grid shape")
+    ny, nx = shape
+    if len(files) > ny * nx:
+        raise ValueError("%s files do not fit a %s x %s grid" % (
+            len(files), ny, nx))
+    names = np.empty(ny * nx, dtype=object)
+    names[:len(files)] = files
+    names = names.reshape(ny, nx)
+    if serpentine:
+        names[1::2] = names[1::2, ::-1]
+    return names, np.arange(nx, dtype=float), np.arange(ny, dtype=float)
+
+
+def create_map(out, fol, names, xs, ys, spacing=0.56, crossed=False,
+               tile=32, engine='stack', options=None):
+    """
+    Create the map directory `out` for the grid of `grid_files`, reading the
+    counts of every file into counts.npy
+
+    Every array is a .npy file, opened memory-mapped by `open_map`:
+
+    - counts (ny, nx, 256) uint32
+    - present (ny, nx) bool, grid points with a file
+    - values, errors (ny, nx, 12) float, the columns of output.csv, nan
+      until fitted
+    - status (ny, nx) string, fit status of each point (see
+      `supervisor.supervised_fit`), empty until fitted
+    - tiles (ty, tx) bool, tiles that are done
+
+    map.json holds the grid and the fit settings, including the `engine`
+    and `options` of `fit_map` (as JSON), and is written last so a map that
+    was interrupted while reading the files is created again.
+    """
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    meta_path = os.path.join(out, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    ny, nx = names.shape
+    shape = (-(-ny // tile), -(-nx // tile))
+
+    def new(name, dtype, dims, fill):
+        arr = open_memmap(os.path.join(out, name + '.npy'), mode='w+',
+                          dtype=dtype, shape=dims)
+        arr[...] = fill
+        return arr
+
+    counts = new('counts', np.uint32, (ny, nx, CHANNELS), 0)
+    present = new('present', bool, (ny, nx), False)
+    for iy in range(ny):
+        for ix in range(nx):
+            if names[iy, ix] is not None:
+                header, counts[iy, ix] = read_dat(
+                    os.path.join(fol, names[iy, ix]))
+                present[iy, ix] = True
+    arrays = [counts, present,
+              new('values', float, (ny, nx, len(VALUE_NAMES)), np.nan),
+              new('errors', float, (ny, nx, len(VALUE_NAMES)), np.nan),
+              new('status', STATUS_DTYPE, (ny, nx), ''),
+              new('tiles', bool, shape, False)]
+    for arr in arrays:
+        arr.flush()
+
+    meta = {'folder': os.path.abspath(fol), 'spacing': spacing,
+            'crossed': bool(crossed), 'tile': tile, 'engine': engine,
+            'options': _options(options), 'columns': VALUE_NAMES,
+            'x': xs.tolist(), 'y': ys.tolist(), 'names': names.tolist(),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def _options(fit_kws):
+    """ Fit options as they read back from map.json """
+    return json.loads(json.dumps(fit_kws or {}))
+
+
+def open_map(out, mode='r+'):
+    """
+    Open a map directory made by `create_map`
+
+    Returns
+    -------
+    meta : dict
+        contents of map.json
+    arrays : dict
+        {name: memory-mapped array} for every name in `ARRAYS`
+    """
+    with open(os.path.join(out, META_FILE)) as f:
+        meta = json.load(f)
+    arrays = dict((name, np.load(os.path.join(out, name + '.npy'),
+                                 mmap_mode=mode)) for name in ARRAYS)
+    return meta, arrays
+
+
+def fit_stack_tile(counts, spacing, crossed):
+    """
+    Fit a stack of spectra at once with `batch_fit.fit_stack`
+
+    Parameters
+    ----------
+    counts : array (N, 256)
+    spacing : float
+        mirror spacing in cm
+    crossed : bool
+
+    Returns
+    -------
+    values, errors : np.ndarray (N, 12)
+        shifts and peak widths in the columns of output.csv
+    status : np.ndarray of string (N,)
+        'ok', 'suspect:not-converged' or 'suspect:stderr'
+    """
+    l, b1, b2 = fit_stack(counts)
+    centers = np.hstack([l['center'], b1['center'][:, 1:3],
+                         b2['center'][:, 1:3]])
+    u_centers = np.hstack([l['center_err'], b1['center_err'][:, 1:3],
+                           b2['center_err'][:, 1:3]])
+    sigmas = np.hstack([l['sigma'], b1['sigma'][:, 1:3],
+                        b2['sigma'][:, 1:3]])
+    u_sigmas = np.hstack([l['sigma_err'], b1['sigma_err'][:, 1:3],
+                          b2['sigma_err'][:, 1:3]])
+    shifts, u_shifts = shift_array(centers, u_centers, spacing=spacing,
+                                   crossed=crossed)
+    fwhm, u_fwhm = width_array(sigmas, u_sigmas)
+    values = np.hstack((shifts, fwhm))
+    errors = np.hstack((u_shifts, u_fwhm))
+    success = l['success'] & b1['success'] & b2['success']
+    status = np.where(success, 'ok', 'suspect:not-converged')
+    status[success & ~np.isfinite(errors).all(axis=1)] = 'suspect:stderr'
+    return values, errors, status
+
+
+def fit_lmfit_tile(counts, spacing, crossed, **fit_kws):
+    """
+    Fit a stack of spectra one by one with `supervisor.supervised_fit`,
+    returns as `fit_stack_tile`, with nan and the status 'failed' for
+    spectra that could not be fitted
+    """
+    n = len(counts)
+    values = np.full((n, len(VALUE_NAMES)), np.nan)
+    errors = np.full((n, len(VALUE_NAMES)), np.nan)
+    status = np.empty(n, dtype=object)
+    for i, c in enumerate(counts):
+        try:
+            fits, status[i] = supervised_fit(c, **fit_kws)
+        except ValueError:
+            status[i] = 'failed'
+            continue
+        v, e = results_array([fits], spacing=spacing, crossed=crossed)
+        values[i], errors[i] = v[0], e[0]
+    return values, errors, status
+
+
+def fit_map(out, engine='stack', progress=None, **fit_kws):
+    """
+    Fit the tiles of a map that are not done yet
+
+    The results of each tile are flushed to disk before the tile is marked
+    as done, so the map can be interrupted at any time and resumed.
+
+    Parameters
+    ----------
+    out : string
+        map directory, see `create_map`
+    engine : string (default='stack')
+        'stack' fits each tile at once with `batch_fit.fit_stack` (fixed
+        windows, fast), 'lmfit' fits its spectra one by one with
+        `supervisor.supervised_fit` (adaptive windows and retries, slower)
+    progress : function (default=None)
+        called as progress(done, total) after each tile
+    fit_kws :
+        options of `supervisor.supervised_fit` for the 'lmfit' engine
+
+    Returns
+    -------
+    fitted : int
+        number of tiles fitted
+
+    Raises
+    ------
+    ValueError
+        if the map was made for another engine or other options, its tiles
+        would not be comparable
+    """
+    if engine not in ('stack', 'lmfit'):
+        raise ValueError("engine must be 'stack' or 'lmfit'")
+    meta, arrays = open_map(out)
+    if (meta.get('engine'), meta.get('options')) != (engine,
+                                                     _options(fit_kws)):
+        raise ValueError("%s was made for engine %s with options %s" % (
+            out, meta.get('engine'), meta.get('options')))
+    tile = meta['tile']
+    tiles = arrays['tiles']
+    ny, nx = arrays['present'].shape
+    pending = zip(*np.nonzero(~tiles))
+    for k, (ty, tx) in enumerate(pending):
+        rows = slice(ty * tile, min((ty + 1) * tile, ny))
+        cols = slice(tx * tile, min((tx + 1) * tile, nx))
+        present = np.array(arrays['present'][rows, cols])
+        counts = np.array(arrays['counts'][rows, cols][present])
+        if len(counts):
+            if engine == 'stack':
+                values, errors, status = fit_stack_tile(
+                    counts, meta['spacing'], meta['crossed'])
+            else:
+                values, errors, status = fit_lmfit_tile(
+                    counts, meta['spacing'], meta['crossed'], **fit_kws)
+            for name, result in [('values', values), ('errors', errors),
+                                 ('status', status.astype(STATUS_DTYPE))]:
+                block = np.array(arrays[name][rows, cols])
+                block[present] = result
+                arrays[name][rows, cols] = block
+                arrays[name].flush()
+        tiles[ty, tx] = True
+        tiles.flush()
+        if progress is not None:
+            progress(k + 1, len(pending))
+    return len(pending)
+
+
+def process_map(fol, pattern=None, shape=None, serpentine=False,
+                spacing=0.56, crossed=False, tile=32, out=None,
+                engine='stack', restart=False, **fit_kws):
+    """
+    Build (or reopen) the map of a folder of DAT files and fit it
+
+    An existing map directory with the same grid, spacing, crossed setting,
+    tile size, engine and fit options is resumed, otherwise (or with
+    `restart`) it is created again from the DAT files.
+
+    Parameters
+    ----------
+    fol : string
+        folder of DAT files
+    pattern, shape, serpentine :
+        how the files are placed on the grid, see `grid_files`
+    spacing : float (default=0.56)
+        mirror spacing in cm
+    crossed : bool (default=False)
+    tile : int (default=32)
+        tiles of tile x tile grid points are fitted and saved together
+    out : string (default=None)
+        map directory, `MAP_DIR` in the folder by default
+    engine : string (default='stack')
+        see `fit_map`
+    restart : bool (default=False)
+        create the map again even if it could be resumed
+    fit_kws :
+        see `fit_map`
+
+    Returns
+    -------
+    out : string
+        the map directory
+    """
+    start = time.time()
+    fol = os.path.abspath(fol)
+    out = out or os.path.join(fol, MAP_DIR)
+    names, xs, ys = grid_files(dat_files(fol), pattern, shape, serpentine)
+
+    meta = None
+    if not restart and os.path.exists(os.path.join(out, META_FILE)):
+        meta, arrays = open_map(out, mode='r')
+        same = (meta['names'] == names.tolist() and
+                meta['spacing'] == spacing and
+                meta['crossed'] == bool(crossed) and meta['tile'] == tile and
+                meta.get('engine') == engine and
+                meta.get('options') == _options(fit_kws))
+        done = int(arrays['tiles'].sum())
+        del arrays
+        if same:
+            print "Resuming %s, %s tiles already done" % (out, done)
+        else:
+            print "Grid, settings or engine changed, creating %s again" % out
+            meta = None
+    if meta is None:
+        meta = create_map(out, fol, names, xs, ys, spacing, crossed, tile,
+                          engine, fit_kws)
+        print "Created %s, %s x %s grid of %s files" % (
+            out, len(ys), len(xs), sum(n is not None for n in names.flat))
+
+    def progress(done, total):
+        elapsed = time.time() - start
+        print "[%s/%s] tiles (%.0f s left)" % (
+            done, total, (total - done) * elapsed / done)
+
+    fit_map(out, engine, progress, **fit_kws)
+    meta, arrays = open_map(out, mode='r')
+    status = arrays['status'][arrays['present']]
+    counts = dict(zip(*np.unique(status, return_counts=True)))
+    print "Done in %.1f s: %s" % (time.time() - start, ", ".join(
+        "%s %s" % (n, s) for s, n in sorted(counts.items())))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('folder')
+    grid = parser.add_mutually_exclusive_group(required=True)
+    grid.add_argument('--pattern',
+                      help='regular expression with named groups x and y '
+                      'for the stage position in the filenames, eg. '
+                      r"'x(?P<x>[-\d.]+)_y(?P<y>[-\d.]+)'")
+    grid.add_argument('--shape', type=int, nargs=2, metavar=('NY', 'NX'),
+                      help='grid filled by the sorted files, row by row')
+    parser.add_argument('--serpentine', action='store_true',
+                        help='every other row was scanned backwards')
+    parser.add_argument('-s', '--spacing', type=float, default=0.56,
+                        help='mirror spacing in cm')
+    parser.add_argument('-c', '--crossed', action='store_true',
+                        help='brillouin peaks are crossed')
+    parser.add_argument('-t', '--tile', type=int, default=32,
+                        help='tile size in grid points')
+    parser.add_argument('-o', '--out', help='map directory')
+    parser.add_argument('-e', '--engine', choices=['stack', 'lmfit'],
+                        default='stack', help='fitting engine')
+    parser.add_argument('--restart', action='store_true',
+                        help='do not resume an existing map')
+    args = parser.parse_args()
+
+    sp.verbose = False
+    try:
+        process_map(args.folder, args.pattern, args.shape, args.serpentine,
+                    args.spacing, args.crossed, args.tile, args.out,
+                    args.engine, args.restart)
+    except KeyboardInterrupt:
+        print "\nInterrupted, run again to resume"
+
+if __name__ == '__main__':
+    main()
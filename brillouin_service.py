@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+"""
+description: local fitting service for instrument control software. A
+long-lived server on a localhost port or a Unix socket keeps a pool of
+worker processes with the fitting modules imported and the model templates
+built, and answers lines of JSON with the shifts and peak widths of the
+spectra sent. Spectra that arrive together, in one request or from several
+clients, are fitted as a batch
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import sys
+import json
+import time
+import Queue
+import signal
+import socket
+import argparse
+import threading
+import SocketServer
+import multiprocessing
+import numpy as np
+from datfile import CHANNELS, read_dat
+from instrument import TIME_BUDGET
+from writers import VALUE_NAMES
+
+ADDRESS = ('127.0.0.1', 8765)
+# most spectra fitted in one batch, and how long the first spectrum of a
+# batch waits for others to join it, in seconds
+BATCH_SIZE = 1024
+BATCH_WAIT = 0.002
+# seconds a request waits for its results on top of the time budget of its
+# spectra, before the worker fitting them is taken to have died
+RESULT_TIMEOUT = 60.0
+ENGINES = ['lmfit', 'stack']
+# default engine, 'stack' is about ten times faster than 'lmfit'
+ENGINE = 'stack'
+
+
+def parse_address(address):
+    """
+    ('host', port) for 'host:port' or a port number, otherwise `address` is
+    the path of a Unix socket
+    """
+    if isinstance(address, tuple):
+        return address
+    if isinstance(address, int) or str(address).isdigit():
+        return (ADDRESS[0], int(address))
+    if ':' in address and os.path.sep not in address:
+        host, port = address.rsplit(':', 1)
+        return (host or ADDRESS[0], int(port))
+    return address
+
+
+def _warm(verbose=False):
+    """
+    Worker initializer, imports the fitting modules and fits a synthetic
+    spectrum with each engine, so that the model templates and the caches
+    of numpy, scipy and lmfit are ready before the first request
+    """
+    # the server stops the pool on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import backend
+    backend.select_backend()
+    import spectra
+    import synthetic
+    spectra.verbose = verbose
+    # a spectrum that fits at the first attempt, so warming up is quick
+    counts, truth = synthetic.generate(1, drift=0, seed=1)
+    for engine in ENGINES:
+        _fit_job((engine, counts, 0.56, False, {}))
+
+
+def _fit_job(job):
+    """
+    Fit a stack of spectra in a worker
+
+    Parameters
+    ----------
+    job : tuple
+        (engine, counts (N, 256), spacing, crossed, options of
+        `supervisor.supervised_fit` for the 'lmfit' engine)
+
+    Returns
+    -------
+    values, errors : np.ndarray (N, 12)
+    status : list of string (N,)
+    error : string
+        None, or the error if the whole job failed
+    """
+    engine, counts, spacing, crossed, fit_kws = job
+    from brillouin_map import fit_stack_tile, fit_lmfit_tile
+    try:
+        if engine == 'stack':
+            values, errors, status = fit_stack_tile(counts, spacing,
+                                                     crossed)
+        else:
+            values, errors, status = fit_lmfit_tile(counts, spacing,
+                                                     crossed, **fit_kws)
+        return values, errors, [str(s) for s in status], None
+    except Exception as e:
+        return None, None, None, '{}: {}'.format(type(e).__name__, e)
+
+
+class _Pending:
+    """ A spectrum waiting in the batch queue, and its result """
+
+    def __init__(self, counts, key):
+        self.counts = counts
+        self.key = key
+        self.result = None
+        self.done = threading.Event()
+
+    def set(self, result):
+        self.result = result
+        self.done.set()
+
+
+def result_dict(values, errors, status):
+    """ JSON result of a spectrum, nan values are null """
+    def clean(v):
+        return v if np.isfinite(v) else None
+    return {'values': dict(zip(VALUE_NAMES, map(clean, values))),
+            'errors': dict(zip(VALUE_NAMES, map(clean, errors))),
+            'status': status}
+
+
+class FitService:
+    """
+    Warm worker pool with a batch queue in front of it
+
+    Spectra are submitted one by one, a background thread takes them off the
+    queue, waits up to `batch_wait` for more, groups them by engine and
+    settings, and sends each group to the pool. The 'stack' engine fits a
+    group at once, the 'lmfit' engine splits it over the workers.
+    """
+
+    def __init__(self, workers=1, batch_size=BATCH_SIZE,
+                 batch_wait=BATCH_WAIT, timeout=RESULT_TIMEOUT):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.pool = None
+        self.thread = None
+        self.running = False
+        self.batches = 0
+        self.fitted = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def _new_pool(self):
+        """ Pool of warm workers """
+        pool = multiprocessing.Pool(self.workers, _warm)
+        # one job per worker, returns once every initializer has run
+        pool.map(len, [[]] * self.workers, chunksize=1)
+        return pool
+
+    @staticmethod
+    def _close_pool(pool, wait=0):
+        """
+        Terminate a pool from another thread, a pool with a killed worker
+        can block in `terminate`, so this waits at most `wait` seconds
+        """
+        thread = threading.Thread(target=pool.terminate)
+        thread.daemon = True
+        thread.start()
+        thread.join(wait)
+
+    def start(self):
+        """ Start the workers and wait until they are warm """
+        self.pool = self._new_pool()
+        self.running = True
+        self.thread = threading.Thread(target=self._batcher)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def restart(self, pool):
+        """
+        Replace `pool` by a new one, if it is still in use. A worker that
+        dies can leave the task queue of its pool locked, so nothing sent
+        to that pool is fitted any more
+        """
+        with self.lock:
+            if self.pool is not pool:
+                return
+            print "A worker did not answer, restarting the workers"
+            self.pool = self._new_pool()
+            self.restarts += 1
+        self._close_pool(pool)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        if self.pool is not None:
+            self._close_pool(self.pool, wait=5.0)
+
+    def submit(self, counts, spacing=0.56, crossed=False, engine=ENGINE,
+               **fit_kws):
+        """
+        Queue spectra for fitting
+
+        Parameters
+        ----------
+        counts : array (256,) or (N, 256)
+        spacing : float (default=0.56)
+            mirror spacing in cm
+        crossed : bool (default=False)
+        engine : string (default=`ENGINE`)
+            'stack' fits the batch with `batch_fit.fit_stack` (fixed
+            windows), 'lmfit' fits each spectrum with
+            `supervisor.supervised_fit` (windows between the fitted laser
+            peaks and retries, much slower)
+        fit_kws :
+            options of `supervisor.supervised_fit`, they have to be JSON
+            serializable
+
+        Returns
+        -------
+        pending : list of _Pending
+            wait on `done`, then `result` is the dict of `result_dict` or
+            {'error': message}
+        """
+        if engine not in ENGINES:
+            raise ValueError("engine must be one of %s" % ", ".join(ENGINES))
+        counts = np.atleast_2d(np.asarray(counts, dtype=float))
+        if counts.ndim != 2 or counts.shape[1] != CHANNELS:
+            raise ValueError("counts must have %s channels" % CHANNELS)
+        # spectra with the same key are fitted together, the options are
+        # serialized so that lists and dicts can be part of it
+        try:
+            options = json.dumps(fit_kws, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            raise ValueError("options must be JSON serializable (%s)" % e)
+        key = (engine, float(spacing), bool(crossed), options)
+        pending = [_Pending(c, key) for c in counts]
+        for p in pending:
+            self.queue.put(p)
+        return pending
+
+    def fit(self, counts, spacing=0.56, crossed=False, engine=ENGINE,
+            **fit_kws):
+        """
+        `submit` and wait, returns the list of results. Spectra without a
+        result after `timeout` seconds plus their time budgets (the worker
+        died) get an error result, spectra fitted without a time budget
+        only get `timeout` seconds.
+        """
+        pool = self.pool
+        pending = self.submit(counts, spacing, crossed, engine, **fit_kws)
+        budget = (fit_kws.get('time_budget', TIME_BUDGET) or 0
+                  if engine == 'lmfit' else 0)
+        deadline = None
+        timed_out = False
+        if self.timeout is not None:
+            wait = self.timeout + budget * len(pending)
+            deadline = time.time() + wait
+        for p in pending:
+            if deadline is None:
+                p.done.wait()
+            elif not p.done.wait(max(deadline - time.time(), 0)):
+                p.set({'error': 'no result after %.0f s, the worker fitting '
+                       'it may have died' % wait})
+                timed_out = True
+        if timed_out:
+            self.restart(pool)
+        return [p.result for p in pending]
+
+    def _batcher(self):
+        while self.running:
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except Queue.Empty:
+                continue
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.time(), 0)))
+                except Queue.Empty:
+                    break
+            # an error must not stop the thread, the requests of the batch
+            # fail instead of waiting for ever
+            try:
+                groups = {}
+                for p in batch:
+                    groups.setdefault(p.key, []).append(p)
+                for key, group in groups.items():
+                    self._dispatch(key, group)
+            except Exception as e:
+                for p in batch:
+                    if not p.done.is_set():
+                        p.set({'error': '{}: {}'.format(type(e).__name__,
+                                                        e)})
+            self.batches += 1
+
+    def _dispatch(self, key, group):
+        engine, spacing, crossed, options = key
+        fit_kws = dict((str(k), v) for k, v in json.loads(options).items())
+        if engine == 'stack':
+            chunks = [group]
+        else:
+            size = -(-len(group) // self.workers)
+            chunks = [group[i:i + size] for i in range(0, len(group), size)]
+        for chunk in chunks:
+            counts = np.array([p.counts for p in chunk])
+            self.pool.apply_async(
+                _fit_job, ((engine, counts, spacing, crossed, fit_kws),),
+                callback=lambda result, chunk=chunk: self._deliver(chunk,
+                                                                   result))
+
+    def _deliver(self, chunk, result):
+        values, errors, status, error = result
+        for i, p in enumerate(chunk):
+            if error is not None:
+                p.set({'error': error})
+            else:
+                p.set(result_dict(values[i], errors[i], status[i]))
+        self.fitted += len(chunk)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """
+    One connection, any number of requests, each a line of JSON answered
+    by a line of JSON. Requests are
+
+    - {"counts": [...] or [[...], ...], "spacing": 0.56, "crossed": false,
+      "engine": "stack", "options": {...}, "id": ...}: fit the spectra,
+      answered with {"id": ..., "results": [...], "seconds": ...}
+    - {"op": "ping"}: answered with the service statistics
+
+    Errors are answered with {"id": ..., "error": message}.
+    """
+
+    def handle(self):
+        service = self.server.service
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            start = time.time()
+            rid = None
+            try:
+                request = json.loads(line)
+                rid = request.get('id')
+                if request.get('op', 'fit') == 'ping':
+                    reply = {'workers': service.workers,
+                             'batches': service.batches,
+                             'fitted': service.fitted,
+                             'restarts': service.restarts}
+                else:
+                    options = dict((str(k), v) for k, v in
+                                   request.get('options', {}).items())
+                    reply = {'results': service.fit(
+                        request['counts'], request.get('spacing', 0.56),
+                        request.get('crossed', False),
+                        request.get('engine', ENGINE), **options)}
+            except Exception as e:
+                reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+            reply['id'] = rid
+            reply['seconds'] = time.time() - start
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address=ADDRESS, workers=1, batch_size=BATCH_SIZE,
+          batch_wait=BATCH_WAIT):
+    """
+    Run the service until interrupted
+
+    Parameters
+    ----------
+    address : ('host', port) or string (default=`ADDRESS`)
+        see `parse_address`
+    workers : int (default=1)
+        number of worker processes, 0 uses one per core
+    batch_size, batch_wait :
+        see `FitService`
+    """
+    address = parse_address(address)
+    service = FitService(workers, batch_size, batch_wait)
+    start = time.time()
+    service.start()
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    server.service = service
+    print "Serving on %s with %s warm workers (started in %.1f s)" % (
+        address, service.workers, time.time() - start)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+
+
+class Client:
+    """
+    Connection to a running service
+
+    Examples
+    --------
+    >>> client = Client(8765)
+    >>> result, = client.fit(counts, spacing=0.56)
+    >>> result['values']['F_avg']
+    """
+
+    def __init__(self, address=ADDRESS, timeout=None):
+        address = parse_address(address)
+        family = (socket.AF_INET if isinstance(address, tuple)
+                  else socket.AF_UNIX)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+        self.count = 0
+
+    def request(self, message):
+        """ Send a request dict and return the reply dict """
+        self.sock.sendall(json.dumps(message) + "\n")
+        line = self.file.readline()
+        if not line:
+            raise IOError("service closed the connection")
+        return json.loads(line)
+
+    def fit(self, counts, spacing=0.56, crossed=False, engine=ENGINE,
+            **options):
+        """
+        Fit one spectrum (256,) or a stack (N, 256)
+
+        Returns
+        -------
+        results : list of dict
+            'values' and 'errors' by the column names of output.csv, and
+            'status', or 'error' if the spectrum could not be fitted
+
+        Raises
+        ------
+        ValueError
+            if the service rejected the request
+        """
+        self.count += 1
+        reply = self.request({'id': self.count,
+                              'counts': np.asarray(counts).tolist(),
+                              'spacing': spacing, 'crossed': crossed,
+                              'engine': engine, 'options': options})
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply['results']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-a', '--address', default='%s:%s' % ADDRESS,
+                        help='host:port, port or Unix socket path')
+    commands = parser.add_subparsers(dest='command')
+    server = commands.add_parser('serve', help='run the service')
+    server.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes, 0 uses one per core')
+    server.add_argument('--batch-wait', type=float, default=BATCH_WAIT,
+                        help='seconds a spectrum waits for others to batch '
+                        'with')
+    client = commands.add_parser('fit', help='fit DAT files with a running '
+                                 'service and print the latency')
+    client.add_argument('files', nargs='+')
+    client.add_argument('-s', '--spacing', type=float, default=0.56,
+                        help='mirror spacing in cm')
+    client.add_argument('-c', '--crossed', action='store_true',
+                        help='brillouin peaks are crossed')
+    client.add_argument('-e', '--engine', choices=ENGINES, default=ENGINE,
+                        help='fitting engine')
+    client.add_argument('-b', '--batch', action='store_true',
+                        help='send all the files in one request')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.address, args.workers, batch_wait=args.batch_wait)
+        return
+    c = Client(args.address)
+    counts = [read_dat(f)[1] for f in args.files]
+    groups = ([(args.files, counts)] if args.batch else
+              [([f], [y]) for f, y in zip(args.files, counts)])
+    for names, y in groups:
+        start = time.time()
+        results = c.fit(y, args.spacing, args.crossed, args.engine)
+        ms = 1e3 * (time.time() - start) / len(names)
+        for f, r in zip(names, results):
+            if 'error' in r:
+                print "%s: %s" % (os.path.basename(f), r['error'])
+            else:
+                print "%s: F_avg %.5f +- %.5f %s (%.1f ms)" % (
+                    os.path.basename(f), r['values']['F_avg'],
+                    r['errors']['F_avg'] or np.nan, r['status'], ms)
+    c.close()
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
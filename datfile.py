@@ -0,0 +1,157 @@
+"""
+description: fast reader for the instrument DAT files, and an on-disk cache
+of all the spectra in a folder so they only have to be parsed once
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import numpy as np
+
+CHANNELS = 256
+HEADER_LINES = 12
+
+# header label in the DAT file, field name, dtype
+HEADER_FIELDS = [('Sample', 'sample', 'S64'),
+                 ('Scan number', 'scan_number', 'i8'),
+                 ('Wavelength', 'wavelength', 'f8'),
+                 ('Polarization', 'polarization', 'S64'),
+                 ('Power', 'power', 'f8'),
+                 ('Mirror sp.', 'mirror_spacing', 'f8'),
+                 ('Ch. duration', 'channel_duration', 'f8'),
+                 ('Scan amplitude', 'scan_amplitude', 'f8')]
+HEADER_DTYPE = np.dtype([(name, dtype) for _, name, dtype in HEADER_FIELDS])
+
+CACHE_COUNTS = '.spectra_cache.npy'
+CACHE_INDEX = '.spectra_index.npz'
+
+
+def parse_header(lines):
+    """
+    Parse the header lines of a DAT file into a record of `HEADER_DTYPE`.
+    Missing or empty numeric values are left as 0 (nan for floats)
+    """
+    header = np.zeros((), dtype=HEADER_DTYPE)
+    for name in HEADER_DTYPE.names:
+        if HEADER_DTYPE[name].kind == 'f':
+            header[name] = np.nan
+    labels = dict((label, (name, dtype)) for label, name, dtype
+                  in HEADER_FIELDS)
+
+    for line in lines:
+        label, sep, value = line.partition(b':')
+        label = label.strip().decode('ascii', 'replace')
+        value = value.strip()
+        if not sep or label not in labels or not value:
+            continue
+        name, dtype = labels[label]
+        try:
+            header[name] = value if dtype.startswith('S') else float(value)
+        except ValueError:
+            pass
+    return header[()]
+
+
+def read_dat(fname):
+    """
+    Read a DAT file
+
+    Returns
+    -------
+    header : np.record of `HEADER_DTYPE`
+        scan number, wavelength, mirror spacing etc.
+    counts : np.ndarray of uint32 (256,)
+        counts in each channel
+
+    Raises
+    ------
+    ValueError
+        if the file does not contain 256 channels, eg. while it is still
+        being written
+    """
+    with open(fname, 'rb') as f:
+        lines = f.read().split(b'\n', HEADER_LINES)
+    if len(lines) <= HEADER_LINES:
+        raise ValueError("%s: incomplete header" % fname)
+    counts = np.fromstring(lines[HEADER_LINES], sep=' ')
+    if len(counts) != CHANNELS:
+        raise ValueError("%s: expected %s channels, found %s" %
+                         (fname, CHANNELS, len(counts)))
+    return parse_header(lines[:HEADER_LINES]), counts.astype(np.uint32)
+
+
+def read_header(fname):
+    """ Header of a DAT file without reading the counts, see `read_dat` """
+    with open(fname, 'rb') as f:
+        lines = [f.readline() for i in range(HEADER_LINES)]
+    return parse_header(lines)
+
+
+def dat_files(folder):
+    """ Sorted list of DAT files in folder """
+    return sorted(f for f in os.listdir(folder) if f.endswith('.DAT'))
+
+
+def load_folder(folder, cache=True):
+    """
+    Read all the DAT files in a folder
+
+    With `cache` the spectra are stored in two hidden files in the folder,
+    the counts as a single (N, 256) array that is memory-mapped on the next
+    call, and an index of the filenames, modification times, sizes and
+    headers. Only files that are new or changed since the cache was written
+    are parsed again.
+
+    Parameters
+    ----------
+    folder : string
+    cache : bool (default=True)
+        use and update the cache files in the folder
+
+    Returns
+    -------
+    names : list of string
+        DAT filenames, sorted
+    headers : np.ndarray of `HEADER_DTYPE` (N,)
+    counts : np.ndarray of uint32 (N, 256)
+        memory-mapped when read straight from the cache
+    """
+    names = dat_files(folder)
+    stats = [os.stat(os.path.join(folder, f)) for f in names]
+    mtimes = np.array([s.st_mtime for s in stats], dtype='f8')
+    sizes = np.array([s.st_size for s in stats], dtype='i8')
+
+    counts_path = os.path.join(folder, CACHE_COUNTS)
+    index_path = os.path.join(folder, CACHE_INDEX)
+
+    cached = {}
+    if cache and os.path.exists(counts_path) and os.path.exists(index_path):
+        try:
+            index = dict(np.load(index_path))
+            counts = np.load(counts_path, mmap_mode='r')
+            c_names = [str(n) for n in index['names']]
+            if (c_names == names and
+                    np.array_equal(index['mtimes'], mtimes) and
+                    np.array_equal(index['sizes'], sizes)):
+                return names, index['headers'], counts
+            for i, f in enumerate(c_names):
+                cached[f] = (index['mtimes'][i], index['sizes'][i],
+                             index['headers'][i], np.array(counts[i]))
+            del counts
+        except (IOError, ValueError, KeyError):
+            # unreadable cache, rebuild it
+            cached = {}
+
+    headers = np.zeros(len(names), dtype=HEADER_DTYPE)
+    counts = np.zeros((len(names), CHANNELS), dtype=np.uint32)
+    for i, f in enumerate(names):
+        hit = cached.get(f)
+        if hit is not None and hit[0] == mtimes[i] and hit[1] == sizes[i]:
+            headers[i], counts[i] = hit[2], hit[3]
+        else:
+            headers[i], counts[i] = read_dat(os.path.join(folder, f))
+
+    if cache:
+        np.save(counts_path, counts)
+        np.savez(index_path, names=np.array(names), mtimes=mtimes,
+                 sizes=sizes, headers=headers)
+    return names, headers, counts
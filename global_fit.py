@@ -0,0 +1,365 @@
+"""
+description: global fit of a whole brillouin spectrum in one optimization.
+The laser peaks and both inelastic windows are fitted jointly, with L2 tied
+to the midpoint of L1 and L3 and the four shifts as fit parameters, so the
+shift uncertainties come from the joint covariance
+author: Rohan Isaac
+"""
+from __future__ import division
+import time
+import numpy as np
+from numpy import pi
+import backend
+backend.select_backend()  # lmfit imports pyplot
+from lmfit import Parameters, minimize
+import spectra as sp
+from batch_fit import lorentzians, lorentzians_jac
+from brillouin import WINDOWS, laser_positions
+from instrument import timed
+
+# peaks found within this many channels of a window edge are laser tails
+EDGE = 10
+# noise of the laser section, as a fraction of the highest count
+LASER_NOISE = 0.01
+
+# peaks and background of each section, the laser section (all channels)
+# and the two inelastic windows
+SECTIONS = [(['L1', 'L2', 'L3'], 'bg_l'),
+            (['T1', 'P1', 'P2', 'T2'], 'bg_b1'),
+            (['T3', 'P3', 'P4', 'T4'], 'bg_b2')]
+
+# brillouin peak centers in terms of the shift parameters, for uncrossed and
+# crossed spectra, as (laser peak, side, shift): the center is that of the
+# laser peak plus side * shift * ch_wn. P1 - P4 are in channel order, ch_wn
+# is the number of channels per wavenumber
+CENTERS = {False: {'P1': ('L1', 1, 'f1'), 'P2': ('L2', -1, 'f2'),
+                   'P3': ('L2', 1, 'f3'), 'P4': ('L3', -1, 'f4')},
+           True: {'P2': ('L1', 1, 'f1'), 'P1': ('L2', -1, 'f2'),
+                  'P4': ('L2', 1, 'f3'), 'P3': ('L3', -1, 'f4')}}
+
+
+def _fit_info(args, g):
+    return {'nfev': g.out.nfev, 'success': bool(g.out.success),
+            'redchi': g.out.redchi}
+
+
+class GlobalFit:
+    """
+    Joint model of a 256 channel spectrum, with the same three sections as
+    `brillouin.fit_counts`:
+
+    - all channels: lorentzians L1, L2, L3 and a constant bg_l
+    - each inelastic window: the two brillouin peaks (P1, P2 or P3, P4), a
+      lorentzian for the laser tail at each edge (T1, T2 or T3, T4) and a
+      constant (bg_b1 or bg_b2)
+
+    The residuals of the sections are fitted together, so the laser centers
+    and the shifts are set by all of them at once. Parameters are named as
+    above with _amplitude, _center and _sigma, plus the shifts f1 - f4 and
+    f_avg in 1/cm. After `fit`, `out` is the lmfit result, with `params`,
+    `covar`, `nfev`, `success` and `redchi`.
+    """
+
+    def __init__(self, counts, spacing=0.56, crossed=False):
+        self.y = np.asarray(counts, dtype=float)
+        self.x = np.arange(len(self.y))
+        self.spacing = spacing
+        self.crossed = bool(crossed)
+        self.params = None
+        self.out = None
+
+    def guess(self, peak_method='cwt'):
+        """
+        Starting positions of the laser, brillouin and tail peaks, from the
+        max near each laser position and a peak search in each window (as
+        in `brillouin.fit_counts`)
+
+        Returns
+        -------
+        pos : dict
+            {peak name: channel}
+        """
+        y = self.y
+        pos = {}
+        for i, p in enumerate(laser_positions(y)):
+            pos['L%s' % (i + 1)] = p
+        for k, (start, stop) in enumerate(WINDOWS):
+            w = sp.Spectra(self.x[start:stop], y[start:stop])
+            w.smooth_data(window_size=5, order=3)
+            w.find_peaks(width=5, threshold=0, limit=4, smooth=True,
+                         method=peak_method)
+            found = sorted(start + p for p in w.peak_pos)
+            if len(found) == 4:
+                # laser tail, two brillouin peaks, laser tail
+                tails, inner = [found[0], found[3]], found[1:3]
+            else:
+                # peaks near the edges are the laser tails
+                tails = [start, stop - 1]
+                inner = [p for p in found
+                         if start + EDGE <= p < stop - EDGE]
+                if len(inner) < 2:
+                    raise ValueError("found %s brillouin peaks in channels "
+                                     "%s-%s" % (len(inner), start, stop))
+                inner = sorted(sorted(inner, key=lambda p: -y[p])[:2])
+            pos['P%s' % (2 * k + 1)], pos['P%s' % (2 * k + 2)] = inner
+            pos['T%s' % (2 * k + 1)], pos['T%s' % (2 * k + 2)] = tails
+        return pos
+
+    def build(self, pos, init=None):
+        """
+        Make the parameters, starting from the peak positions `pos` (see
+        `guess`), or the values of the parameters `init` of an earlier fit
+        """
+        y = self.y
+        laser_width = sp.Spectra(self.x, y).test_peak_width
+        pars = Parameters()
+        for name, p in sorted(pos.items()):
+            # width bounds as in `Spectra.build_model`
+            pw = laser_width if name.startswith('L') else 5
+            pars.add(name + '_sigma', value=pw / 2, min=pw * 0.25,
+                     max=pw * 2)
+            height = y[min(max(p, 0), len(y) - 1)]
+            pars.add(name + '_amplitude', value=height * pi * pw / 2)
+            pars.add(name + '_center', value=p)
+        for name in ['bg_l', 'bg_b1', 'bg_b2']:
+            pars.add(name, value=0)
+
+        pars.add('spacing', value=self.spacing, vary=False)
+        pars.add('ch_wn', expr='spacing * (L3_center - L1_center)')
+        pars['L2_center'].set(expr='(L1_center + L3_center) / 2')
+        ch_wn = self.spacing * (pos['L3'] - pos['L1'])
+        if not self.crossed:
+            f = [pos['P1'] - pos['L1'], pos['L2'] - pos['P2'],
+                 pos['P3'] - pos['L2'], pos['L3'] - pos['P4']]
+        else:
+            f = [pos['P2'] - pos['L1'], pos['L2'] - pos['P1'],
+                 pos['P4'] - pos['L2'], pos['L3'] - pos['P3']]
+        # keep each brillouin peak in its window, f1 and f2 are the shifts
+        # in the first window, f3 and f4 in the second
+        (s1, e1), (s2, e2) = WINDOWS
+        l1, l2, l3 = pos['L1'], pos['L2'], pos['L3']
+        limits = [(s1 - l1, e1 - l1), (l2 - e1, l2 - s1),
+                  (s2 - l2, e2 - l2), (l3 - e2, l3 - s2)]
+        for i, (d, (lo, hi)) in enumerate(zip(f, limits)):
+            pars.add('f%s' % (i + 1), value=d / ch_wn,
+                     min=max(lo, 0) / ch_wn, max=hi / ch_wn)
+        for name, (laser, side, shift) in CENTERS[self.crossed].items():
+            pars[name + '_center'].set(expr='%s_center %s %s * ch_wn' % (
+                laser, '+' if side > 0 else '-', shift))
+        pars.add('f_avg', expr='(f1 + f2 + f3 + f4) / 4')
+
+        if init is not None:
+            for name, par in pars.items():
+                if name in init and par.vary:
+                    par.set(value=init[name].value)
+        self.params = pars
+        return pars
+
+    def _indices(self):
+        """ Channels of each section, see `SECTIONS` """
+        return [self.x] + [self.x[start:stop] for start, stop in WINDOWS]
+
+    def _peaks(self, params, names, bg):
+        """ Peak parameters of a section as an array for `lorentzians` """
+        return np.array([[params[n + p].value for n in names
+                          for p in ('_amplitude', '_center', '_sigma')] +
+                         [params[bg].value]])
+
+    def sections(self, params):
+        """
+        Model of each section
+
+        Returns
+        -------
+        sections : list of (channel indices, model)
+        """
+        return [(idx, lorentzians(idx, self._peaks(params, names, bg))[0])
+                for idx, (names, bg) in zip(self._indices(), SECTIONS)]
+
+    def model(self, params=None):
+        """ Model of the whole spectrum, the windows from their sections """
+        y = np.empty(len(self.y))
+        for idx, m in self.sections(params or self.out.params):
+            y[idx] = m
+        return y
+
+    def residual(self, params):
+        return np.concatenate([(m - self.y[idx]) * w for (idx, m), w in
+                               zip(self.sections(params), self.weights)])
+
+    def _center_partials(self, params):
+        """
+        Derivatives of the center of every peak with respect to the
+        parameters it depends on, {peak: {parameter: derivative}}
+        """
+        partials = {'L1': {'L1_center': 1.0}, 'L3': {'L3_center': 1.0},
+                    'L2': {'L1_center': 0.5, 'L3_center': 0.5}}
+        for name in ['T1', 'T2', 'T3', 'T4']:
+            partials[name] = {name + '_center': 1.0}
+        # center = laser + side * shift * spacing * (L3_center - L1_center)
+        ch_wn = params['ch_wn'].value
+        for name, (laser, side, shift) in CENTERS[self.crossed].items():
+            d = side * params[shift].value * self.spacing
+            p = dict(partials[laser])
+            p['L1_center'] = p.get('L1_center', 0) - d
+            p['L3_center'] = p.get('L3_center', 0) + d
+            p[shift] = side * ch_wn
+            partials[name] = p
+        return partials
+
+    def jacobian(self, params):
+        """
+        Analytic jacobian of `residual` with respect to the varying
+        parameters, one row per parameter (use with col_deriv=1)
+        """
+        names = [name for name, p in params.items()
+                 if p.vary and not p.expr]
+        row = dict((name, i) for i, name in enumerate(names))
+        jac = np.zeros((len(names), sum(len(w) for w in self.weights)))
+        centers = self._center_partials(params)
+        start = 0
+        for idx, (peaks, bg), w in zip(self._indices(), SECTIONS,
+                                       self.weights):
+            part = slice(start, start + len(idx))
+            d = lorentzians_jac(idx, self._peaks(params, peaks, bg))[0] * w
+            for k, n in enumerate(peaks):
+                for p, i in ((n + '_amplitude', 3 * k),
+                             (n + '_sigma', 3 * k + 2)):
+                    if p in row:
+                        jac[row[p], part] += d[i]
+                for p, dc in centers[n].items():
+                    if p in row:
+                        jac[row[p], part] += dc * d[3 * k + 1]
+            if bg in row:
+                jac[row[bg], part] += d[-1]
+            start += len(idx)
+        return jac
+
+    def fit(self, weighted=True, max_nfev=None, deadline=None):
+        """
+        Fit the spectrum in two passes. The lorentzians do not describe the
+        laser lines to within counting noise, so the first pass takes the
+        noise of the laser section as `LASER_NOISE` of the highest count.
+        The second pass starts from the first, with the weights of each
+        section scaled so that its residual is of order one, which gives the
+        covariance of the shifts. Parameters that end up at a bound are
+        fixed in the second pass, as they have no uncertainty. Both passes
+        use the analytic `jacobian`, and the second one, starting at the
+        minimum of the first, takes only a few iterations.
+
+        Parameters
+        ----------
+        weighted : bool (default=True)
+            weight the windows by 1/sqrt(counts) (counting noise), otherwise
+            every channel of a section has the same weight
+        max_nfev : int (default=None)
+            function evaluations allowed for both passes together, the
+            leastsq default for each if None
+        deadline : float (default=None)
+            time (as `time.time()`) at which the fit is aborted, the result
+            then has `aborted` set and `success` False, and the second pass
+            is not run
+        """
+        sp._print("Fitting Data...")
+        y = self.y
+        self.weights = [np.ones(len(idx)) if k == 0 or not weighted
+                        else 1 / np.sqrt(np.maximum(y[idx], 1))
+                        for k, idx in enumerate(self._indices())]
+        self.weights[0] /= LASER_NOISE * y.max()
+        first = self._minimize(self.params, max_nfev, deadline)
+        self.out = first
+        if not getattr(first, 'aborted', False):
+            pars = first.params
+            for (idx, m), w in zip(self.sections(pars), self.weights):
+                w /= np.sqrt(np.mean(((m - y[idx]) * w) ** 2)) or 1
+            for par in pars.values():
+                if (par.vary and
+                        np.isclose(par.value, [par.min, par.max]).any()):
+                    par.vary = False
+            if max_nfev is not None:
+                max_nfev -= first.nfev
+            self.out = self._minimize(pars, max_nfev, deadline)
+            self.out.nfev += first.nfev
+        self.best_fit = self.model()
+        return self.out
+
+    def _minimize(self, params, max_nfev=None, deadline=None):
+        """ One pass of `fit`, with the budget of `Spectra.fit_data` """
+        kws = dict(Dfun=self.jacobian, col_deriv=1)
+        if max_nfev is not None:
+            kws['maxfev'] = max(int(max_nfev), 1)
+        iter_cb = None
+        if deadline is not None:
+            def iter_cb(params, iteration, resid, *args, **kws):
+                return time.time() > deadline
+        out = minimize(self.residual, params, iter_cb=iter_cb, **kws)
+        if getattr(out, 'aborted', False):
+            out.success = False
+        return out
+
+    def results(self):
+        """
+        Shifts and peak widths, in the columns of output.csv
+
+        Returns
+        -------
+        values, errors : np.ndarray (12,)
+            F1 - F4, F_avg, then the FWHM (2 sigma) of L1 - L3 and P1 - P4
+        """
+        params = self.out.params
+        names = (['f1', 'f2', 'f3', 'f4', 'f_avg'] +
+                 ['%s_sigma' % n for n in ['L1', 'L2', 'L3', 'P1', 'P2',
+                                           'P3', 'P4']])
+        scale = np.array([1.0] * 5 + [2.0] * 7)
+        values = np.array([params[n].value for n in names])
+        errors = np.array([params[n].stderr if params[n].stderr is not None
+                           else np.nan for n in names])
+        return values * scale, errors * scale
+
+    def plot_data(self):
+        """ Data for `brillouin.render_fit`, see `brillouin.plot_data` """
+        params = self.out.params
+        centers = [params['%s_center' % n].value
+                   for n in ['L1', 'L2', 'L3', 'P1', 'P2', 'P3', 'P4']]
+        return {'centers': centers,
+                'windows': [[self.x[a:b].astype(float).tolist(),
+                             self.y[a:b].tolist(),
+                             self.best_fit[a:b].tolist()]
+                            for a, b in WINDOWS]}
+
+
+@timed('fit_global', _fit_info)
+def fit_global(counts, spacing=0.56, crossed=False, previous=None,
+               peak_method='cwt', weighted=True, max_nfev=None,
+               deadline=None):
+    """
+    Fit a spectrum with a single `GlobalFit`
+
+    Parameters
+    ----------
+    counts : array (256,)
+    spacing : float (default=0.56)
+        mirror spacing in cm
+    crossed : bool (default=False)
+    previous : GlobalFit (default=None)
+        fit of the previous spectrum in a series, its parameters are used as
+        the starting values instead of a peak search
+    peak_method : string (default='cwt')
+        peak search in the windows, 'cwt' or 'prominence'
+    weighted, max_nfev, deadline :
+        see `GlobalFit.fit`
+
+    Returns
+    -------
+    g : GlobalFit
+    """
+    g = GlobalFit(counts, spacing, crossed)
+    if previous is not None:
+        init = previous.out.params
+        pos = dict((name[:-7], int(round(p.value)))
+                   for name, p in init.items() if name.endswith('_center'))
+        g.build(pos, init)
+    else:
+        g.build(g.guess(peak_method))
+    g.fit(weighted, max_nfev, deadline)
+    return g
@@ -0,0 +1,185 @@
+"""
+description: optional instrumentation of the fitting stages. Decorated
+functions send the time they took and any fit statistics as events to the
+sinks that are registered, and cost a single check when there are none
+author: Rohan Isaac
+"""
+from __future__ import division
+import time
+import json
+import logging
+from functools import wraps
+from contextlib import contextmanager
+
+# fitting time and function evaluations allowed per spectrum, over all the
+# attempts of `supervisor.supervised_fit`. Kept here, rather than in
+# supervisor, so entry points can use them without importing lmfit
+TIME_BUDGET = 60.0
+MAX_NFEV = 20000
+
+_sinks = []
+
+
+def add_sink(sink):
+    """ Send events to `sink`, a callable taking the event dict """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def enabled():
+    """ If any sink is registered """
+    return bool(_sinks)
+
+
+def emit(stage, seconds, **info):
+    """
+    Send an event to all the sinks
+
+    Parameters
+    ----------
+    stage : string
+        name of the timed stage, eg. 'Spectra.fit_data'
+    seconds : float
+        time taken
+    info :
+        other values of the event, eg. nfev and success of a fit
+    """
+    event = dict(info, stage=stage, seconds=seconds)
+    for sink in _sinks:
+        sink(event)
+
+
+def timed(stage, info=None):
+    """
+    Decorator that times every call of a function and emits it as `stage`
+
+    Parameters
+    ----------
+    info : function (default=None)
+        called as info(args, result), returns a dict of extra values for the
+        event
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kws):
+            if not _sinks:
+                return func(*args, **kws)
+            start = time.time()
+            try:
+                result = func(*args, **kws)
+            except Exception as e:
+                emit(stage, time.time() - start, error=type(e).__name__)
+                raise
+            extra = info(args, result) if info is not None else {}
+            emit(stage, time.time() - start, **extra)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect():
+    """
+    Collect all the events emitted inside the block
+
+    Examples
+    --------
+    >>> with collect() as events:
+    ...     fit_file(fname)
+    >>> Collector(events).report()
+    """
+    events = []
+    add_sink(events.append)
+    try:
+        yield events
+    finally:
+        remove_sink(events.append)
+
+
+class LoggingSink:
+    """ Log every event to a `logging` logger """
+
+    def __init__(self, logger='brillouin', level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def __call__(self, event):
+        extra = ", ".join("%s=%s" % (k, v) for k, v in sorted(event.items())
+                          if k not in ('stage', 'seconds'))
+        self.logger.log(self.level, "%s %.4f s %s", event['stage'],
+                        event['seconds'], extra)
+
+
+class JsonLinesSink:
+    """ Append every event as a line of JSON to a file """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def __call__(self, event):
+        self.file.write(json.dumps(dict(event, time=time.time())) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class Collector:
+    """ Keep the events in memory and summarize them per stage """
+
+    def __init__(self, events=None):
+        self.events = list(events or [])
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        stages : dict
+            {stage: {'calls', 'seconds', 'errors', and 'nfev' and 'failed'
+            for fits, 'accepted' for warm starts}}
+        """
+        stages = {}
+        for e in self.events:
+            s = stages.setdefault(e['stage'], {'calls': 0, 'seconds': 0.0,
+                                               'errors': 0})
+            s['calls'] += 1
+            s['seconds'] += e['seconds']
+            s['errors'] += 'error' in e
+            if 'nfev' in e:
+                s['nfev'] = s.get('nfev', 0) + e['nfev']
+                s['failed'] = s.get('failed', 0) + (not e['success'])
+            if 'accepted' in e:
+                s['accepted'] = s.get('accepted', 0) + e['accepted']
+        return stages
+
+    def report(self, total=None):
+        """
+        Table of the time spent in each stage, as a percentage of `total`
+        seconds if given
+        """
+        lines = ["%-28s %7s %10s %10s %7s %8s" % ('stage', 'calls',
+                                                  'total (s)', 'mean (ms)',
+                                                  '%', 'nfev')]
+        stages = self.summary()
+        for name in sorted(stages, key=lambda n: -stages[n]['seconds']):
+            s = stages[name]
+            pct = ('%6.1f%%' % (100 * s['seconds'] / total) if total
+                   else '-')
+            nfev = ('%s' % s['nfev'] if 'nfev' in s else '-')
+            lines.append("%-28s %7d %10.3f %10.2f %7s %8s" % (
+                name, s['calls'], s['seconds'], 1e3 * s['seconds'] /
+                s['calls'], pct, nfev))
+            if s.get('failed') or s['errors']:
+                lines.append("%28s %s not converged, %s errors" % (
+                    '', s.get('failed', 0), s['errors']))
+            if 'accepted' in s:
+                lines.append("%28s %s of %s accepted" % ('', s['accepted'],
+                                                         s['calls']))
+        return "\n".join(lines)
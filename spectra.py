@@ -8,12 +8,331 @@ author: Rohan Isaac
 """
 
 from __future__ import division
+import time
+from collections import namedtuple, OrderedDict
 import numpy as np
-from numpy import sqrt, pi
+from numpy import sqrt, pi, log
 from scipy import signal
+import backend
+backend.select_backend()  # lmfit imports pyplot
 from lmfit import Model
 from lmfit.models import PolynomialModel
 from lmfit.lineshapes import lorentzian, gaussian, voigt
+from instrument import timed
+from batch_fit import find_fwhm_batch
+
+# print progress and fit reports, turn off for large batches
+verbose = True
+
+
+def _print(msg):
+    if verbose:
+        print msg
+
+
+def _fit_info(args, out):
+    """ Fit statistics of `Spectra.fit_data` for the instrumentation """
+    return {'nfev': out.nfev, 'success': bool(out.success),
+            'redchi': out.redchi, 'num_peaks': args[0].num_peaks}
+
+
+# vectorized peak shapes for MultiPeakModel. Each takes the distance from the
+# center and the peak parameters as (peaks, 1) arrays, and returns the peaks
+# and their derivatives with respect to amplitude, center, sigma (, fraction)
+def _lorentzian_jac(d, a, s):
+    inv = 1 / (d * d + s * s)
+    l = s * inv / pi
+    return a * l, [l, 2 * a * l * d * inv, a * inv * (1 / pi - 2 * s * l)]
+
+
+def _gaussian_jac(d, a, s):
+    g = np.exp(-d * d / (2 * s * s)) / (sqrt(2 * pi) * s)
+    return a * g, [g, a * g * d / s ** 2, a * g * (d * d / s ** 3 - 1 / s)]
+
+
+def _pvoigt_jac(d, a, s, f):
+    # same definition as lmfit.lineshapes.pvoigt, both components have a
+    # fwhm of 2 * sigma
+    k = sqrt(2 * log(2))
+    gv, gd = _gaussian_jac(d, a, s / k)
+    lv, ld = _lorentzian_jac(d, a, s)
+    return ((1 - f) * gv + f * lv,
+            [(1 - f) * gd[0] + f * ld[0], (1 - f) * gd[1] + f * ld[1],
+             (1 - f) * gd[2] / k + f * ld[2], lv - gv])
+
+
+class MultiPeakModel(Model):
+    """
+    Sum of `num_peaks` peaks of a single shape on a polynomial background,
+    evaluated as one vectorized expression instead of a composite of one
+    Model per peak. Parameters are named the same as those of the composite
+    models (p0_center, p0_sigma, ..., bg_c0), and `jacobian` gives the
+    analytic derivatives of the residual for use as the leastsq Dfun.
+
+    Shapes are 'LO' (lorentzian), 'GA' (gaussian) and 'PV' (pseudo-voigt,
+    with an extra p{i}_fraction parameter)
+    """
+    shapes = {'LO': (_lorentzian_jac, ['amplitude', 'center', 'sigma']),
+              'GA': (_gaussian_jac, ['amplitude', 'center', 'sigma']),
+              'PV': (_pvoigt_jac,
+                     ['amplitude', 'center', 'sigma', 'fraction'])}
+
+    def __init__(self, shape, num_peaks, bg_ord=0, **kws):
+        self.peak_function, self.peak_params = self.shapes[shape]
+        self.num_peaks = num_peaks
+        self.bg_ord = bg_ord
+        names = (['bg_c%i' % i for i in range(bg_ord + 1)] +
+                 ['p%i_%s' % (i, p) for i in range(num_peaks)
+                  for p in self.peak_params])
+
+        def multi_peak(x, **pars):
+            return self._evaluate(x, pars)[0]
+        # lmfit reads the signature from these for functions without
+        # explicit arguments
+        multi_peak.argnames = ['x']
+        multi_peak.kwargs = [(name, 0.0) for name in names]
+
+        Model.__init__(self, multi_peak, independent_vars=['x'],
+                       param_names=names, **kws)
+
+    def _evaluate(self, x, pars):
+        """ Model, partial derivatives of the peaks, background powers of x """
+        x = np.asarray(x, dtype=float)
+        p = [np.array([pars['p%i_%s' % (i, name)]
+                       for i in range(self.num_peaks)])[:, None]
+             for name in self.peak_params]
+        peaks, partials = self.peak_function(x - p[1], p[0], p[2], *p[3:])
+        powers = x ** np.arange(self.bg_ord + 1)[:, None]
+        bg = np.dot([pars['bg_c%i' % i] for i in range(self.bg_ord + 1)],
+                    powers)
+        return peaks.sum(axis=0) + bg, partials, powers
+
+    def jacobian(self, params, data, weights, x=None, **kws):
+        """
+        Jacobian of the residual with respect to the varying parameters, one
+        row per parameter (use with col_deriv=1)
+        """
+        values = dict((name, p.value) for name, p in params.items())
+        model, partials, powers = self._evaluate(x, values)
+        rows = {}
+        for i in range(self.bg_ord + 1):
+            rows['bg_c%i' % i] = powers[i]
+        for k, name in enumerate(self.peak_params):
+            for i in range(self.num_peaks):
+                rows['p%i_%s' % (i, name)] = partials[k][i]
+        jac = np.array([rows[name] for name, p in params.items()
+                        if p.vary and not p.expr])
+        if weights is not None:
+            jac = jac * weights
+        return jac
+
+
+def _window_min(y, before, after):
+    """
+    Minimum of y[i - before:i + after + 1] along the last axis for every i,
+    with the edges padded by the end values
+    """
+    padded = np.concatenate([np.repeat(y[:, :1], before, axis=1), y,
+                             np.repeat(y[:, -1:], after, axis=1)], axis=1)
+    padded = np.ascontiguousarray(padded)
+    n, points = y.shape
+    s0, s1 = padded.strides
+    windows = np.lib.stride_tricks.as_strided(
+        padded, shape=(n, points, before + after + 1), strides=(s0, s1, s1))
+    return windows.min(axis=2)
+
+
+def find_peaks_batch(y, width, threshold=5, limit=20, data_max=None):
+    """
+    Find peaks in many spectra at once from the zero crossings of the
+    smoothed derivative, ranked by their prominence. Unlike the wavelet
+    transform this is deterministic and vectorized over all spectra.
+
+    Rising data at the first or last point (eg. the tail of a peak outside
+    the range) counts as a peak near the edge, half the derivative filter
+    in from it, the same way the wavelet search reports them. Peaks closer
+    than `width` to a more prominent one are skipped.
+
+    Parameters
+    ----------
+    y : array (N, points)
+        data, usually smoothed
+    width : float
+        estimate of peak width in points, sets the derivative filter and the
+        window the prominence is measured over (4 * width each side)
+    threshold : float (default=5)
+        min percent of `data_max` to count as a peak
+    limit : int (default=20)
+        max number of peaks to report per spectrum (most prominent first)
+    data_max : array (N,) (default=None)
+        max of each spectrum for the threshold, max of `y` if not given
+
+    Returns
+    -------
+    num_peaks : array of int (N,)
+        number of peaks found in each spectrum
+    peak_pos : array of int (N, limit)
+        indices of the peaks sorted by position, padded with -1
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n, points = y.shape
+    if data_max is None:
+        data_max = y.max(axis=1)
+
+    window = max(int(width) // 2 * 2 + 1, 5)
+    window = min(window, points - (points + 1) % 2)
+    dy = signal.savgol_filter(y, window, 2, deriv=1, axis=1)
+
+    # maxima where the derivative goes from rising to falling, at the higher
+    # of the two points either side of the crossing
+    peak = np.zeros((n, points), dtype=bool)
+    cross = (dy[:, :-1] > 0) & (dy[:, 1:] <= 0)
+    left = y[:, :-1] >= y[:, 1:]
+    peak[:, :-1] |= cross & left
+    peak[:, 1:] |= cross & ~left
+    # data still rising at an end is a peak outside the range, placed at the
+    # outermost point the derivative filter covers without extrapolating
+    edge = window // 2
+    peak[:, edge] |= dy[:, 0] < 0
+    peak[:, -1 - edge] |= dy[:, -1] > 0
+
+    # the base on each side is the minimum within the window, a side cut
+    # short by the end of the data has none (the tail of a peak outside the
+    # range never comes back down there), so only the other side counts
+    wlen = max(int(4 * width), 1)
+    idx = np.arange(points)
+    left = np.where(idx >= wlen, _window_min(y, wlen, 0), -np.inf)
+    right = np.where(idx < points - wlen, _window_min(y, 0, wlen), -np.inf)
+    base = np.maximum(left, right)
+    base = np.where(np.isfinite(base), base,
+                    np.minimum(_window_min(y, wlen, 0),
+                               _window_min(y, 0, wlen)))
+    prominence = np.where(peak, y - base, -np.inf)
+    prominence[y / data_max[:, None] <= threshold / 100] = -np.inf
+
+    # most prominent first, skipping candidates closer than the peak width
+    # to one already taken (noise on the side of a broad peak)
+    rows = np.arange(n)
+    sep = max(int(round(width)), 1)
+    peak_pos = np.full((n, limit), points, dtype=int)
+    for k in range(limit):
+        best = np.argmax(prominence, axis=1)
+        found = np.isfinite(prominence[rows, best])
+        peak_pos[found, k] = best[found]
+        near = np.abs(idx - best[:, None]) < sep
+        prominence[near & found[:, None]] = -np.inf
+    num_peaks = (peak_pos < points).sum(axis=1)
+    peak_pos = np.sort(peak_pos, axis=1)
+    peak_pos[peak_pos == points] = -1
+    return num_peaks, peak_pos
+
+
+def guess_batch(y, x=None, smooth=None, peak_pos=None, peak_type='LO'):
+    """
+    Initial guesses for many spectra at once, what `Spectra` works out per
+    object in its constructor (`guess_peak_width`), `smooth_data` and
+    `build_model`, in a few array operations
+
+    Parameters
+    ----------
+    y : array (N, points)
+    x : array (points,) (default=None)
+        x-data shared by all spectra, the index if not given
+    smooth : (window_size, order) (default=None)
+        also smooth the spectra, see `Spectra.smooth_data`
+    peak_pos : array of int (N, peaks) (default=None)
+        indices of the peaks of each spectrum, padded with -1 as returned
+        by `find_peaks_batch`, to also get the starting parameters
+    peak_type : string (default='LO')
+        peak shape of the starting amplitudes, see `Spectra.build_model`
+
+    Returns
+    -------
+    guess : dict of np.ndarray
+        'data_max', 'data_max_pos' and 'peak_width' (N,), as the attributes
+        of `Spectra` (peak_width is its test_peak_width), 'y_smooth'
+        (N, points) with `smooth`, and with `peak_pos` the starting 'center',
+        'sigma', 'amplitude' and the bounds 'sigma_min', 'sigma_max'
+        (N, peaks) of `Spectra.build_model`, nan for padding
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n, points = y.shape
+    x = np.arange(points) if x is None else np.asarray(x)
+    guess = {'data_max_pos': y.argmax(axis=1)}
+    guess['data_max'] = y[np.arange(n), guess['data_max_pos']]
+    pw = find_fwhm_batch(y, guess['data_max_pos'], x).astype(float)
+    guess['peak_width'] = pw
+    if smooth is not None:
+        guess['y_smooth'] = signal.savgol_filter(y, smooth[0], smooth[1],
+                                                 axis=1)
+    if peak_pos is not None:
+        peak_pos = np.atleast_2d(peak_pos)
+        valid = peak_pos >= 0
+        pos = np.where(valid, peak_pos, 0)
+        pw = np.where(valid, pw[:, None], np.nan)
+        afactor = PEAK_FACTORS[peak_type][0]
+        guess['center'] = np.where(valid, x[pos], np.nan)
+        guess['sigma'] = pw / 2
+        guess['amplitude'] = y[np.arange(n)[:, None], pos] * pw / 2 * afactor
+        guess['sigma_min'] = pw * 0.25
+        guess['sigma_max'] = pw * 2
+    return guess
+
+
+# area / (height * sigma) and fwhm / sigma of each peak type, see
+# `Spectra.amplitude` and `Spectra.fwhm`. The pseudo-voigt is an equal mix
+# of a gaussian and lorentzian of the same fwhm.
+PEAK_FACTORS = {'LO': (pi, 2.0), 'FLO': (pi, 2.0),
+                'GA': (sqrt(2 * pi), 2.354820),
+                'FGA': (sqrt(2 * pi), 2.354820),
+                'VO': (sqrt(2 * pi), 3.60131),
+                'FPV': (1 / (0.5 * sqrt(log(2) / pi) + 0.5 / pi), 2.0)}
+
+# compiled models by (peak_type, num_peaks, bg_ord), see `model_template`
+_templates = {}
+
+
+def model_template(peak_type, num_peaks, bg_ord):
+    """
+    Model of `num_peaks` peaks of `peak_type` on a polynomial background of
+    order `bg_ord` (see `Spectra.build_model`), and its parameters with the
+    initial values that do not depend on the data. Each model is built once
+    and kept, fits of the same structure share the model and start from a
+    copy of the parameters.
+
+    Returns
+    -------
+    model : lmfit.Model
+    pars : lmfit.Parameters
+        template parameters, copy before changing them
+    """
+    key = (peak_type, num_peaks, bg_ord)
+    if key in _templates:
+        return _templates[key]
+
+    if peak_type in ('FLO', 'FGA', 'FPV'):
+        model = MultiPeakModel(peak_type[1:], num_peaks, bg_ord)
+        pars = model.make_params()
+    else:
+        peak_function = {'LO': lorentzian, 'GA': gaussian,
+                         'VO': voigt}[peak_type]
+        # start with polynomial background
+        model = PolynomialModel(bg_ord, prefix='bg_')
+        pars = model.make_params()
+        for i in range(num_peaks):
+            temp_model = Model(peak_function, prefix='p%s_' % i)
+            pars.update(temp_model.make_params())
+            model += temp_model
+
+    # set inital background as flat line at zeros
+    for i in range(bg_ord + 1):
+        pars['bg_c%i' % i].set(0)
+    if peak_type == 'FPV':
+        for i in range(num_peaks):
+            pars['p%s_fraction' % i].set(0.5, min=0, max=1)
+
+    _templates[key] = model, pars
+    return model, pars
 
 
 class Spectra:
@@ -51,7 +370,7 @@ class Spectra:
 
         """
         # import data into spec object
-        print "Loading file ... "
+        _print("Loading file ... ")
 
         self.x, self.y = args
         self.num_points = len(self.y)
@@ -63,14 +382,17 @@ class Spectra:
         self.y_bak = self.y[:]
         self.x_bak = self.x[:]
 
+    @timed('Spectra.smooth_data')
     def smooth_data(self, window_size=25, order=2):
         """ Smooths data using savgol_filter """
         self.y_smooth = signal.savgol_filter(self.y, window_size, order)
 
+    @timed('Spectra.find_peaks',
+           lambda args, result: {'num_peaks': result[0]})
     def find_peaks(self, width=None, w_range=5, threshold=5, limit=20,
-                   smooth=False):
+                   smooth=False, method='cwt'):
         """ Find peaks in active data set using continuous wavelet
-        transformation
+        transformation, or the prominence of maxima in the derivative
 
         Parameters
         ----------
@@ -84,7 +406,11 @@ class Spectra:
             min percent of max to count as a peak (eg 5 = only peaks above 5
             percent reported)
         limit: int
-            max limit of peaks to report (sorted by intensity)
+            max limit of peaks to report (sorted by intensity, or prominence
+            with method='prominence')
+        method: string (default='cwt')
+            - 'cwt' : scipy.signal.find_peaks_cwt over `w_range` widths
+            - 'prominence' : `find_peaks_batch`, faster and deterministic
 
         Returns
         -------
@@ -94,7 +420,7 @@ class Spectra:
             number of peaks found
 
         """
-        print "Looking for peaks ... "
+        _print("Looking for peaks ... ")
 
         if smooth:
             try:
@@ -116,19 +442,28 @@ class Spectra:
             # if width is given here, use it everywhere else
             self.test_peak_width = width
 
+        if method == 'prominence':
+            num_peaks, peak_pos = find_peaks_batch(
+                y, width * xscale, threshold=threshold, limit=limit,
+                data_max=np.array([self.data_max]))
+            self.peak_pos = list(peak_pos[0, :num_peaks[0]])
+            self.num_peaks = len(self.peak_pos)
+            _print("Using %s peaks at %s" % (self.num_peaks, self.peak_pos))
+            return self.num_peaks, self.peak_pos
+
         lower = width * xscale * 0.75
         upper = width * xscale * 1.25
 
         peak_pos = signal.find_peaks_cwt(y, np.linspace(lower, upper, w_range))
 
-        print "Found %s peaks at %s" % (len(peak_pos), peak_pos)
+        _print("Found %s peaks at %s" % (len(peak_pos), peak_pos))
 
         # remove peaks that are not above the threshold.
         peak_pos = [i for i in peak_pos if
                     (y[i] / self.data_max) > (threshold / 100)]
 
-        print "After filtering out peaks below ", threshold, \
-            "percent, we have ", len(peak_pos), " peaks."
+        _print("After filtering out peaks below %s percent, we have %s "
+               "peaks." % (threshold, len(peak_pos)))
 
         # only use the most intense peaks, zip two lists together,
         # make the y-values as the first item, and sort by it (descending)
@@ -138,10 +473,12 @@ class Spectra:
         self.peak_pos = sorted(peak_pos[0:limit])
         self.num_peaks = len(self.peak_pos)
 
-        print "Using ", self.num_peaks, " peaks at ", self.peak_pos
+        _print("Using %s peaks at %s" % (self.num_peaks, self.peak_pos))
         return self.num_peaks, self.peak_pos
 
-    def build_model(self, peak_type='LO', max_width=None, bg_ord=2):
+    @timed('Spectra.build_model')
+    def build_model(self, peak_type='LO', max_width=None, bg_ord=2,
+                    init_params=None, center_range=None):
         """ Builds a lmfit model of peaks in listed by index in `peak_pos`
         Uses some basic algorithms to determine initial parameters for
         amplitude and fwhm (limit on fwhm to avoid fitting background as peaks)
@@ -153,6 +490,10 @@ class Spectra:
 
             - 'LO' : symmetric lorentzian
             - 'GA' : symmetric gaussain
+            - 'VO' : voigt
+            - 'FLO', 'FGA', 'FPV' : lorentzian, gaussian and pseudo-voigt
+              as a single `MultiPeakModel`, fitted with an analytic
+              jacobian
 
         max_width : int (default = total points/10)
             max width (in data points) that peak fitted can be
@@ -161,6 +502,15 @@ class Spectra:
             order of the background polynomial
             0: constant, 1: linear, ...
 
+        init_params : lmfit.Parameters (default=None)
+            parameters of an earlier fit to start from, eg. of a similar
+            spectrum. Values of matching parameter names replace the initial
+            guesses, bounds are kept.
+
+        center_range : float (default=None)
+            bound each peak center to within this distance (in x-data units)
+            of its starting position, unbounded if None
+
         Returns
         -------
         pars : model parameters
@@ -171,66 +521,86 @@ class Spectra:
         x = self.x
         y = self.y
         pw = self.test_peak_width
-        peak_guess = self.x[self.peak_pos]
-        print "Building model ... "
+        _print("Building model ... ")
 
-        # start with polynomial background
-        # second order
-        model = PolynomialModel(bg_ord, prefix='bg_')
-        pars = model.make_params()
+        self.template = (peak_type, len(self.peak_pos), bg_ord)
+        model, template = model_template(*self.template)
+        pars = template.copy()
 
-        if peak_type == 'LO':
-            peak_function = lorentzian
-            self.afactor = pi
-            self.wfactor = 2.0
-        elif peak_type == 'GA':
-            peak_function = gaussian
-            self.afactor = sqrt(2 * pi)
-            self.wfactor = 2.354820
-        elif peak_type == 'VO':
-            peak_function = voigt
-            self.afactor = sqrt(2 * pi)
-            self.wfactor = 3.60131
-
-        # add lorentizian peak for all peaks
-        for i, peak in enumerate(peak_guess):
-            temp_model = Model(peak_function, prefix='p%s_' % i)
-            pars.update(temp_model.make_params())
-            model += temp_model
-
-        # set inital background as flat line at zeros
-        for i in range(bg_ord + 1):
-            pars['bg_c%i' % i].set(0)
+        self.afactor, self.wfactor = PEAK_FACTORS[peak_type]
 
         # give values for other peaks
         for i, peak in enumerate(self.peak_pos):
-            print 'Peak %i: pos %s, height %s' % (i, x[peak], y[peak])
-            # could set bounds #, min=x[peak]-5, max=x[peak]+5)
-            pars['p%s_center' % i].set(x[peak])
+            _print('Peak %i: pos %s, height %s' % (i, x[peak], y[peak]))
+            if center_range is None:
+                pars['p%s_center' % i].set(x[peak])
+            else:
+                pars['p%s_center' % i].set(x[peak],
+                                           min=x[peak] - center_range,
+                                           max=x[peak] + center_range)
             pars['p%s_sigma' % i].set(pw / 2, min=pw * 0.25, max=pw * 2)
             # here as well #, min=0, max=2*max(y))
             pars['p%s_amplitude' % i].set(self.amplitude(y[peak], (pw / 2)))
 
+        if init_params is not None:
+            for name, par in pars.items():
+                if name in init_params:
+                    par.set(value=init_params[name].value)
+
         self.pars = pars
         self.model = model
         return self.pars, self.model
 
-    def fit_data(self):
+    @timed('Spectra.fit_data', _fit_info)
+    def fit_data(self, max_nfev=None, deadline=None):
         """
         Attempt to fit data using lmfit fit function with the
         generated model. Updates model with fit parameters.
 
+        Parameters
+        ----------
+        max_nfev : int (default=None)
+            max number of function evaluations, the leastsq default if None
+        deadline : float (default=None)
+            time (as `time.time()`) at which the fit is aborted, the result
+            then has `aborted` set and `success` False
+
         Returns
         -------
         fitted object
         """
 
-        print "Fitting Data..."
-        out = self.model.fit(self.y, self.pars, x=self.x)
-        print out.fit_report(show_correl=False)
+        _print("Fitting Data...")
+        fit_kws = {}
+        if isinstance(self.model, MultiPeakModel):
+            fit_kws.update(Dfun=self.model.jacobian, col_deriv=1)
+        if max_nfev is not None:
+            fit_kws['maxfev'] = max(int(max_nfev), 1)
+        iter_cb = None
+        if deadline is not None:
+            def iter_cb(params, iteration, resid, *args, **kws):
+                return time.time() > deadline
+        out = self.model.fit(self.y, self.pars, x=self.x, iter_cb=iter_cb,
+                             fit_kws=fit_kws or None)
+        if getattr(out, 'aborted', False):
+            out.success = False
+        if verbose:
+            print out.fit_report(show_correl=False)
         self.out = out
         return self.out
 
+    def summary(self, keep_data=False):
+        """
+        Compact record of the fit, see `FitSummary`
+
+        Parameters
+        ----------
+        keep_data : bool (default=False)
+            also keep the y-data, needed to plot the fit
+        """
+        return FitSummary(self, keep_data)
+
+    @timed('Spectra.guess_peak_width')
     def guess_peak_width(self, max_width=None):
         """ Find an initial guess for the peak with of the data imported,
         use in peak finding and model buildings and other major functions,
@@ -259,11 +629,12 @@ class Spectra:
         if max_width is None:
             max_width = self.num_points / 5
 
-        self.data_max = max(self.y)
         self.data_max_pos = np.argmax(self.y)
+        self.data_max = self.y[self.data_max_pos]
         self.test_peak_width = self.find_fwhm(self.data_max_pos)
 
-        print "Peak width of about %s (in x-data units)" % self.test_peak_width
+        _print("Peak width of about %s (in x-data units)" %
+               self.test_peak_width)
         return self.data_max, self.data_max_pos, self.test_peak_width
 
     def set_peak_width(self, width):
@@ -338,3 +709,108 @@ class Spectra:
         voigt: 3.60131
         """
         return self.wfactor * sigma
+
+
+# fitted parameter of a `FitSummary`
+SummaryParam = namedtuple('SummaryParam', ['value', 'stderr'])
+
+# parameter layout of each model template, see `_layout`
+_layouts = {}
+
+
+def _layout(template):
+    """
+    Key of the model template (see `model_template`), names of its varied
+    parameters and names of its peak centers, shared by all the summaries
+    of fits with that model
+    """
+    if template not in _layouts:
+        model, pars = model_template(*template)
+        names = tuple(n for n, p in pars.items() if p.expr is None)
+        centers = tuple('p%s_center' % i for i in range(template[1]))
+        _layouts[template] = (template, names, centers)
+    return _layouts[template]
+
+
+class FitSummary(object):
+    """
+    Compact record of a fitted `Spectra`, to keep the results of many
+    spectra in memory. It holds the values and stderrs of the varied
+    parameters, the covariance of the peak centers and the fit statistics,
+    instead of the copies of the data, the model, its parameters and the
+    full lmfit result.
+
+    A summary can be used in place of its Spectra by the functions that
+    read fit results. `out` is the summary itself, with `params` (name:
+    (value, stderr)), `covar` and `var_names` (of the peak centers only),
+    `success`, `aborted`, `nfev`, `redchi` and `best_fit` (evaluated from
+    the parameters when asked for). `x`, `num_peaks` and `y` (None unless
+    kept) are as in the Spectra.
+    """
+    __slots__ = ('layout', 'x0', 'dx', 'num_points', 'fit', 'covar', 'y',
+                 'y_mean', 'success', 'aborted', 'nfev', 'redchi')
+
+    def __init__(self, spectra, keep_data=False):
+        out = spectra.out
+        self.layout = _layout(spectra.template)
+        template, names, centers = self.layout
+        x = np.asarray(spectra.x, dtype=float)
+        self.x0 = x[0]
+        self.dx = (x[-1] - x[0]) / (len(x) - 1) if len(x) > 1 else 1.0
+        if not np.allclose(np.diff(x), self.dx):
+            raise ValueError("x-data must be evenly spaced")
+        self.num_points = len(x)
+        params = out.params
+        self.fit = np.array([[params[n].value for n in names],
+                             [params[n].stderr if params[n].stderr
+                              is not None else np.nan for n in names]])
+        self.covar = None
+        if out.covar is not None and all(n in out.var_names
+                                         for n in centers):
+            idx = [out.var_names.index(n) for n in centers]
+            self.covar = out.covar[np.ix_(idx, idx)]
+        y = np.asarray(spectra.y, dtype=float)
+        self.y = y.copy() if keep_data else None
+        self.y_mean = y.mean()
+        self.success = bool(out.success)
+        self.aborted = bool(getattr(out, 'aborted', False))
+        self.nfev = out.nfev
+        self.redchi = out.redchi
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def out(self):
+        return self
+
+    @property
+    def num_peaks(self):
+        return self.layout[0][1]
+
+    @property
+    def x(self):
+        return self.x0 + self.dx * np.arange(self.num_points)
+
+    @property
+    def params(self):
+        """ {name: SummaryParam(value, stderr)}, stderr None if unknown """
+        return OrderedDict(
+            (n, SummaryParam(v, None if np.isnan(e) else e))
+            for n, v, e in zip(self.layout[1], self.fit[0], self.fit[1]))
+
+    @property
+    def var_names(self):
+        return list(self.layout[2]) if self.covar is not None else []
+
+    @property
+    def best_fit(self):
+        model, template = model_template(*self.layout[0])
+        pars = template.copy()
+        for name, value in zip(self.layout[1], self.fit[0]):
+            pars[name].set(value=value)
+        return model.eval(pars, x=self.x)
@@ -0,0 +1,166 @@
+"""
+description: persistent store of fit results for a folder of DAT files, so
+that a folder can be re-processed without refitting unchanged files
+author: Rohan Isaac
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+STORE_NAME = 'fit_results.sqlite'
+
+
+def file_hash(fname):
+    """ sha1 hex digest of the contents of a file """
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fit_params(fits):
+    """
+    Values and stderrs of all the parameters of a set of fit objects
+
+    Parameters
+    ----------
+    fits : list of Spectra
+        fitted sections of a file, eg. the output of `brillouin.fit_file`
+
+    Returns
+    -------
+    params : list of dict
+        {parameter name: (value, stderr)} for each section
+    """
+    return [dict((name, (p.value, p.stderr))
+                 for name, p in fit.out.params.items()) for fit in fits]
+
+
+def _settings(settings):
+    """ Settings of a fit as a JSON string with sorted keys """
+    return json.dumps(settings or {}, sort_keys=True)
+
+
+class FitStore:
+    """
+    SQLite database in a data folder with one row per DAT file, holding the
+    content hash of the file, the `spacing` and `crossed` used, the fit
+    parameters, the derived shifts and peak widths, the fit status (see
+    `supervisor.supervised_fit`) and the other settings the file was fitted
+    with (peak search, covariance, time budget, ...). A second table holds
+    the `brillouin.plot_data` of each file, for rendering the plots later
+    """
+
+    def __init__(self, folder, name=STORE_NAME):
+        self.path = os.path.join(folder, name)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS fits (
+                           filename TEXT PRIMARY KEY,
+                           hash TEXT,
+                           spacing REAL,
+                           crossed INTEGER,
+                           params TEXT,
+                           results TEXT,
+                           updated REAL,
+                           status TEXT,
+                           settings TEXT)""")
+        # stores written before the status column, their fits were 'ok'
+        columns = [c[1] for c in self.db.execute("PRAGMA table_info(fits)")]
+        if 'status' not in columns:
+            self.db.execute("ALTER TABLE fits ADD COLUMN status TEXT "
+                            "DEFAULT 'ok'")
+        # stores written before the settings column, their settings are not
+        # known so their files are fitted again
+        if 'settings' not in columns:
+            self.db.execute("ALTER TABLE fits ADD COLUMN settings TEXT")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS plots (
+                           filename TEXT PRIMARY KEY,
+                           spacing REAL,
+                           crossed INTEGER,
+                           data TEXT)""")
+        self.db.commit()
+
+    def get(self, filename, digest, spacing, crossed, settings=None):
+        """
+        Stored results of a file, or None if the file is not in the store or
+        was fitted from different contents or with different parameters
+
+        Parameters
+        ----------
+        settings : dict (default=None)
+            other settings that change the results, eg. the peak search and
+            covariance options, compared as JSON
+
+        Returns
+        -------
+        results : list of (value, uncertainty) tuples
+        """
+        row = self.db.execute(
+            "SELECT results FROM fits WHERE filename=? AND hash=? AND "
+            "spacing=? AND crossed=? AND settings=?",
+            (filename, digest, spacing, int(crossed),
+             _settings(settings))).fetchone()
+        if row is None:
+            return None
+        return [tuple(v) for v in json.loads(row[0])]
+
+    def params(self, filename):
+        """ Stored fit parameters of a file, see `fit_params` """
+        row = self.db.execute("SELECT params FROM fits WHERE filename=?",
+                              (filename,)).fetchone()
+        if row is None:
+            return None
+        return [dict((k, tuple(v)) for k, v in section.items())
+                for section in json.loads(row[0])]
+
+    def status(self, filename):
+        """ Stored fit status of a file, None if it is not in the store """
+        row = self.db.execute("SELECT status FROM fits WHERE filename=?",
+                              (filename,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, filename, digest, spacing, crossed, params, results,
+            status='ok', settings=None):
+        """ Add or replace the results of a file, see `get` for `settings` """
+        self.db.execute(
+            "INSERT OR REPLACE INTO fits (filename, hash, spacing, crossed, "
+            "params, results, updated, status, settings) VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (filename, digest, spacing, int(crossed), json.dumps(params),
+             json.dumps(results), time.time(), status, _settings(settings)))
+        self.db.commit()
+
+    def put_plot(self, filename, spacing, crossed, data):
+        """ Add or replace the plot data of a file """
+        self.db.execute("INSERT OR REPLACE INTO plots VALUES (?, ?, ?, ?)",
+                        (filename, spacing, int(crossed), json.dumps(data)))
+        self.db.commit()
+
+    def plots(self, filenames=None):
+        """
+        Stored plot data, of all files or only those in `filenames`
+
+        Returns
+        -------
+        plots : list of (filename, spacing, crossed, data)
+        """
+        rows = self.db.execute("SELECT filename, spacing, crossed, data FROM "
+                               "plots ORDER BY filename")
+        keep = None if filenames is None else set(filenames)
+        return [(f, s, bool(c), json.loads(d)) for f, s, c, d in rows
+                if keep is None or f in keep]
+
+    def prune(self, filenames):
+        """ Remove all files not in `filenames` from the store """
+        keep = set(filenames)
+        stale = [(f,) for (f,) in self.db.execute("SELECT filename FROM fits")
+                 if f not in keep]
+        stale += [(f,) for (f,) in self.db.execute(
+            "SELECT filename FROM plots") if f not in keep]
+        self.db.executemany("DELETE FROM fits WHERE filename=?", stale)
+        self.db.executemany("DELETE FROM plots WHERE filename=?", stale)
+        self.db.commit()
+        return len(set(stale))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,152 @@
+"""
+description: fit supervisor for the sectioned fits of `brillouin.fit_counts`.
+Checks the fits of a spectrum for non-convergence, missing peaks and
+unusable uncertainties, and refits with a list of escalating strategies
+within a time and function evaluation budget per spectrum, so a bad scan
+costs a bounded amount of time and ends up with a status instead of an
+exception
+author: Rohan Isaac
+"""
+from __future__ import division
+import time
+import numpy as np
+import spectra as sp
+from brillouin import fit_counts, stack_fits
+from instrument import timed, TIME_BUDGET, MAX_NFEV
+
+# largest acceptable stderr of a peak center, in channels
+MAX_STDERR = 2.0
+
+# attempts in order, each as (name, options of `brillouin.fit_counts`). The
+# first uses the options as given (including a warm start from the previous
+# spectrum), the others start from a peak search and are skipped when they
+# would not change the options.
+STRATEGIES = [('default', {}),
+              ('prominence', {'peak_method': 'prominence'}),
+              ('cwt', {'peak_method': 'cwt'}),
+              ('bounded', {'center_range': 5}),
+              ('FPV', {'peak_type': 'FPV', 'center_range': 5})]
+
+# problems of `check_fits` that still give shifts worth keeping, best first.
+# Fits with any other problem are not used.
+USABLE = ['stderr', 'not-converged']
+
+
+def check_fits(fits, max_stderr=MAX_STDERR):
+    """
+    Check the three fit objects of a spectrum
+
+    Parameters
+    ----------
+    fits : tuple of Spectra
+        see `brillouin.fit_counts`
+    max_stderr : float (default=`MAX_STDERR`)
+        largest acceptable stderr of the seven peak centers, in channels
+
+    Returns
+    -------
+    problem : string or None
+        None if the fits are usable, otherwise 'missing-peaks' (a window
+        has fewer than the 3 peaks the shifts need), 'budget' (a fit was
+        aborted at the deadline), 'not-converged', 'outside-window' (a
+        brillouin peak converged outside its window) or 'stderr' (a center
+        has no or a too large stderr)
+    """
+    if any(b.num_peaks < 3 for b in fits[1:]):
+        return 'missing-peaks'
+    if any(getattr(s.out, 'aborted', False) for s in fits):
+        return 'budget'
+    if not all(s.out.success for s in fits):
+        return 'not-converged'
+    for b in fits[1:]:
+        centers = [b.out.params['p%s_center' % i].value for i in (1, 2)]
+        if min(centers) < b.x[0] or max(centers) > b.x[-1]:
+            return 'outside-window'
+    centers, errors = stack_fits([fits])
+    if not (np.isfinite(errors).all() and (errors <= max_stderr).all()):
+        return 'stderr'
+    return None
+
+
+@timed('supervised_fit', lambda args, result: {'status': result[1]})
+def supervised_fit(counts, previous=None, time_budget=TIME_BUDGET,
+                   max_nfev=MAX_NFEV, max_stderr=MAX_STDERR,
+                   strategies=STRATEGIES, **fit_kws):
+    """
+    Fit a spectrum with `brillouin.fit_counts`, retrying with the next of
+    `strategies` until `check_fits` passes or the budget is used up
+
+    Parameters
+    ----------
+    counts : array (256,)
+    previous : tuple of Spectra (default=None)
+        fits of the previous spectrum in a series, only used by the first
+        attempt
+    time_budget : float (default=`TIME_BUDGET`)
+        seconds of fitting allowed for the spectrum, a fit still running at
+        the end is aborted. No limit if None.
+    max_nfev : int (default=`MAX_NFEV`)
+        function evaluations allowed for the spectrum, no limit if None.
+        Each attempt but the last may use half of what the earlier ones
+        left, so a fit that does not converge cannot use up the retries.
+    max_stderr : float (default=`MAX_STDERR`)
+        see `check_fits`
+    strategies : list of (name, dict) (default=`STRATEGIES`)
+    fit_kws :
+        options of `brillouin.fit_counts`
+
+    Returns
+    -------
+    fits : tuple of Spectra
+    status : string
+        'ok' if the first attempt passed, 'retried:<strategy>' if a later
+        one did, or 'suspect:<problem>' for the best attempt when none
+        passed but one of them has a problem in `USABLE`
+
+    Raises
+    ------
+    ValueError
+        if no attempt gave usable fits
+    """
+    # the defaults of `brillouin.fit_counts`, to skip repeated strategies
+    fit_kws.setdefault('peak_method', 'cwt')
+    fit_kws.setdefault('peak_type', 'LO')
+    deadline = time.time() + time_budget if time_budget else None
+    attempts = [(k, name, options)
+                for k, (name, options) in enumerate(strategies)
+                if k == 0 or not all(fit_kws.get(key) == value
+                                     for key, value in options.items())]
+    used = 0
+    problems = []
+    best = None
+    for i, (k, name, options) in enumerate(attempts):
+        if deadline is not None and time.time() >= deadline:
+            problems.append('out of time')
+            break
+        if max_nfev is not None and used >= max_nfev:
+            problems.append('out of function evaluations')
+            break
+        kws = dict(fit_kws, **options)
+        # an attempt may use half of the evaluations left, so a fit that
+        # does not converge leaves some for the retries
+        left = None if max_nfev is None else max_nfev - used
+        if left is not None and i < len(attempts) - 1:
+            left //= 2
+        try:
+            fits = fit_counts(counts, previous if k == 0 else None,
+                              max_nfev=left, deadline=deadline, **kws)
+        except Exception as e:
+            problems.append('%s: %s: %s' % (name, type(e).__name__, e))
+            continue
+        used += sum(s.out.nfev for s in fits)
+        problem = check_fits(fits, max_stderr)
+        if problem is None:
+            return fits, 'ok' if k == 0 else 'retried:%s' % name
+        sp._print("Fit strategy %s failed (%s)" % (name, problem))
+        problems.append('%s: %s' % (name, problem))
+        if problem in USABLE and (best is None or USABLE.index(problem) <
+                                  USABLE.index(best[1])):
+            best = (fits, problem)
+    if best is None:
+        raise ValueError("no usable fit (%s)" % "; ".join(problems))
+    return best[0], 'suspect:%s' % best[1]
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+description: synthetic brillouin spectra with known shifts, for load and
+accuracy testing. Spectra follow the geometry of
+docs/extracting_brillouin_shifts_from_spectra.md, with Poisson noise and
+drift of the laser positions, and come with their ground truth, in memory or
+written as DAT files
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import csv
+import argparse
+import numpy as np
+from datfile import CHANNELS
+
+# ground truth of each spectrum, f1 - f4 and f_avg in 1/cm
+TRUTH_DTYPE = np.dtype([('l1', 'f8'), ('l2', 'f8'), ('l3', 'f8'),
+                        ('p1', 'f8'), ('p2', 'f8'), ('p3', 'f8'),
+                        ('p4', 'f8'), ('f1', 'f8'), ('f2', 'f8'),
+                        ('f3', 'f8'), ('f4', 'f8'), ('f_avg', 'f8'),
+                        ('scale', 'f8')])
+TRUTH_FILE = 'truth.csv'
+
+
+def pearson7(x, height, center, width, exponent=1.0):
+    """
+    Peak of `height` at `center`, a lorentzian of half width `width` for
+    `exponent` 1 with faster decaying tails for larger exponents
+    """
+    return height * (1 + ((x - center) / width) ** 2) ** -exponent
+
+
+def peak_centers(l1, l3, f, spacing=0.56, crossed=False):
+    """
+    Centers of the seven peaks for laser peaks at `l1` and `l3` and the
+    shifts `f`
+
+    Parameters
+    ----------
+    l1, l3 : array (N,)
+        centers of the first and last laser peak, L2 is at their midpoint
+    f : array (N, 4)
+        shifts f1 - f4 in 1/cm
+    spacing : float (default=0.56)
+        mirror spacing in cm
+    crossed : bool (default=False)
+
+    Returns
+    -------
+    centers : np.ndarray (N, 7)
+        L1, L2, L3, P1, P2, P3, P4 in channels
+    """
+    l1 = np.asarray(l1, dtype=float)
+    l3 = np.asarray(l3, dtype=float)
+    l2 = (l1 + l3) / 2
+    # channels per wavenumber, the inverse of wn/ch = 1/(d (L3 - L1))
+    ch_wn = spacing * (l3 - l1)
+    a = l1 + f[:, 0] * ch_wn
+    b = l2 - f[:, 1] * ch_wn
+    c = l2 + f[:, 2] * ch_wn
+    d = l3 - f[:, 3] * ch_wn
+    if crossed:
+        a, b, c, d = b, a, d, c
+    return np.column_stack([l1, l2, l3, a, b, c, d])
+
+
+def generate(n, shift=0.407, spacing=0.56, crossed=False, drift=1.5,
+             spread=0.005, laser_height=2e6, laser_width=4.5,
+             laser_exponent=3.0, height=150.0, sigma=3.5, background=4.0,
+             seed=0):
+    """
+    Make `n` noisy 256 channel spectra with known peak positions
+
+    The laser peaks start at channels 5 and 254 and wander together by a
+    random walk of at most `drift` channels over the spectra. Every spectrum
+    is scaled in intensity by a random factor between 0.5 and 1.5, and the
+    counts are Poisson samples of the model. The brillouin peaks are
+    lorentzian, the laser lines have the steeper tails of the measured ones
+    (a `pearson7` of exponent 3), so the fit models do not match them
+    exactly, as in real data.
+
+    Parameters
+    ----------
+    n : int
+    shift : float (default=0.407)
+        mean brillouin shift in 1/cm
+    spacing : float (default=0.56)
+        mirror spacing in cm
+    crossed : bool (default=False)
+    drift : float (default=1.5)
+        max drift of the laser peaks, in channels
+    spread : float (default=0.005)
+        standard deviation of the four shifts of a spectrum around `shift`
+    laser_height, laser_width, laser_exponent : float
+        height (counts), width (channels) and exponent of the laser lines,
+        see `pearson7`
+    height, sigma : float
+        height (counts) and half width (channels) of the brillouin peaks
+    background : float (default=4.0)
+        constant background counts
+    seed : int (default=0)
+
+    Returns
+    -------
+    counts : np.ndarray of uint32 (n, 256)
+    truth : np.ndarray of `TRUTH_DTYPE` (n,)
+    """
+    rng = np.random.RandomState(seed)
+    steps = rng.normal(0, drift / np.sqrt(max(n, 1)), size=n)
+    offset = np.clip(np.cumsum(steps), -drift, drift)
+    f = shift + spread * rng.standard_normal((n, 4))
+    scale = rng.uniform(0.5, 1.5, size=n)
+    centers = peak_centers(5 + offset, 254 + offset, f, spacing, crossed)
+
+    x = np.arange(CHANNELS, dtype=float)
+    counts = np.empty((n, CHANNELS), dtype=np.uint32)
+    heights = np.array([laser_height] * 3 + [height] * 4)[:, None]
+    widths = np.array([laser_width] * 3 + [sigma] * 4)[:, None]
+    exponents = np.array([laser_exponent] * 3 + [1.0] * 4)[:, None]
+    for i in range(n):
+        y = pearson7(x, heights, centers[i][:, None], widths,
+                     exponents).sum(axis=0)
+        counts[i] = rng.poisson(scale[i] * y + background)
+
+    truth = np.zeros(n, dtype=TRUTH_DTYPE)
+    for k, name in enumerate(['l1', 'l2', 'l3', 'p1', 'p2', 'p3', 'p4']):
+        truth[name] = centers[:, k]
+    for k in range(4):
+        truth['f%s' % (k + 1)] = f[:, k]
+    truth['f_avg'] = f.mean(axis=1)
+    truth['scale'] = scale
+    return counts, truth
+
+
+def write_dat(fname, counts, scan_number=0, spacing=0.56):
+    """ Write a spectrum in the format of the instrument DAT files """
+    header = ["Sample : synthetic", "Scan number: %s" % scan_number, "",
+              "Wavelength: 532", "Polarization :   ", "Power: 0",
+              "Mirror sp. : %s" % spacing, "Ch. duration : 0",
+              "Scan amplitude : 0", "", "", ""]
+    with open(fname, 'wb') as f:
+        f.write("\r\n".join(header + ["%d" % c for c in counts]) + "\r\n")
+
+
+def write_folder(fol, n, prefix='synthetic', **kws):
+    """
+    Write `n` spectra from `generate` as DAT files in `fol`, and their
+    ground truth to truth.csv
+
+    Returns
+    -------
+    names : list of string
+        filenames of the DAT files
+    truth : np.ndarray of `TRUTH_DTYPE` (n,)
+    """
+    if not os.path.isdir(fol):
+        os.makedirs(fol)
+    counts, truth = generate(n, **kws)
+    width = len(str(max(n - 1, 0)))
+    names = ['%s_%0*d.DAT' % (prefix, width, i) for i in range(n)]
+    spacing = kws.get('spacing', 0.56)
+    for i, name in enumerate(names):
+        write_dat(os.path.join(fol, name), counts[i], i, spacing)
+    with open(os.path.join(fol, TRUTH_FILE), 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Filename'] + list(TRUTH_DTYPE.names))
+        for name, row in zip(names, truth):
+            writer.writerow([name] + list(row))
+    return names, truth
+
+
+def read_truth(fol):
+    """ truth.csv of `write_folder`, as {filename: record} """
+    truth = {}
+    with open(os.path.join(fol, TRUTH_FILE)) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        for row in reader:
+            rec = np.zeros((), dtype=TRUTH_DTYPE)
+            for name, value in zip(header[1:], row[1:]):
+                rec[name] = float(value)
+            truth[row[0]] = rec[()]
+    return truth
+
+
+def recovery(fitted, true):
+    """
+    Errors of fitted shifts against the ground truth
+
+    Parameters
+    ----------
+    fitted, true : array (N, 5)
+        F1 - F4 and F_avg, nan where a fit failed
+
+    Returns
+    -------
+    stats : dict
+        'n', 'failed', and the 'bias', 'rms' and 'max' error of each shift
+        and the average, in 1/cm
+    """
+    err = np.asarray(fitted, dtype=float) - np.asarray(true, dtype=float)
+    ok = np.isfinite(err).all(axis=1)
+    err = err[ok]
+    stats = {'n': len(ok), 'failed': int((~ok).sum())}
+    if len(err):
+        stats['bias'] = err.mean(axis=0).tolist()
+        stats['rms'] = np.sqrt((err ** 2).mean(axis=0)).tolist()
+        stats['max'] = np.abs(err).max(axis=0).tolist()
+    return stats
+
+
+def check_folder(fol):
+    """ `recovery` of the shifts in output.csv of a folder from truth.csv """
+    truth = read_truth(fol)
+    fitted, true = [], []
+    with open(os.path.join(fol, 'output.csv')) as f:
+        for row in csv.reader(f):
+            if not row or row[0] not in truth:
+                continue
+            fitted.append([float(v) for v in row[1:11:2]])
+            t = truth[row[0]]
+            true.append([t['f1'], t['f2'], t['f3'], t['f4'], t['f_avg']])
+    # files that are missing from output.csv failed
+    missing = len(truth) - len(fitted)
+    fitted += [[np.nan] * 5] * missing
+    true += [[0.0] * 5] * missing
+    return recovery(np.reshape(fitted, (-1, 5)), np.reshape(true, (-1, 5)))
+
+
+def print_recovery(stats):
+    print "%s spectra, %s failed" % (stats['n'], stats['failed'])
+    if 'rms' not in stats:
+        return
+    print "%-8s %10s %10s %10s" % ('', 'bias', 'rms', 'max')
+    for k, name in enumerate(['F1', 'F2', 'F3', 'F4', 'F_avg']):
+        print "%-8s %10.5f %10.5f %10.5f" % (name, stats['bias'][k],
+                                             stats['rms'][k],
+                                             stats['max'][k])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('folder')
+    parser.add_argument('-n', type=int, default=100,
+                        help='number of spectra')
+    parser.add_argument('--shift', type=float, default=0.407,
+                        help='mean brillouin shift in 1/cm')
+    parser.add_argument('-s', '--spacing', type=float, default=0.56,
+                        help='mirror spacing in cm')
+    parser.add_argument('-c', '--crossed', action='store_true',
+                        help='brillouin peaks are crossed')
+    parser.add_argument('--drift', type=float, default=1.5,
+                        help='max drift of the laser peaks in channels')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true',
+                        help='compare output.csv of the folder with its '
+                        'truth.csv instead of writing spectra')
+    args = parser.parse_args()
+
+    if args.check:
+        print_recovery(check_folder(args.folder))
+        return
+    names, truth = write_folder(args.folder, args.n, shift=args.shift,
+                                spacing=args.spacing, crossed=args.crossed,
+                                drift=args.drift, seed=args.seed)
+    print "Wrote %s spectra to %s" % (len(names), args.folder)
+
+if __name__ == '__main__':
+    main()
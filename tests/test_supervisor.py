@@ -0,0 +1,101 @@
+"""
+description: tests of the function evaluation budget of `supervisor` and
+`brillouin.fit_counts`, run with `python -m unittest discover tests`
+author: Rohan Isaac
+"""
+from __future__ import division
+import os
+import unittest
+import spectra as sp
+from brillouin import fit_counts
+from datfile import read_dat
+from supervisor import supervised_fit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, os.pardir, 'sample_data', 'test_full')
+
+
+def counts(name):
+    return read_dat(os.path.join(DATA, name))[1]
+
+
+class CountFits(object):
+    """
+    Record the nfev of every fit while in the block, also of warm starts
+    that are rejected and refitted
+    """
+    def __enter__(self):
+        self.fits = []
+        self.original = sp.Spectra.fit_data
+        fits = self.fits
+        original = self.original
+
+        def fit_data(s, *args, **kws):
+            out = original(s, *args, **kws)
+            fits.append((out.nfev, out.nvarys))
+            return out
+
+        sp.Spectra.fit_data = fit_data
+        return self
+
+    def __exit__(self, *exc):
+        sp.Spectra.fit_data = self.original
+
+    @property
+    def nfev(self):
+        return sum(nfev for nfev, nvarys in self.fits)
+
+    @property
+    def slack(self):
+        # MINPACK only stops at the end of an iteration, which costs up to
+        # nvarys + 1 evaluations with a numerical jacobian
+        return sum(nvarys + 1 for nfev, nvarys in self.fits)
+
+
+class TestBudget(unittest.TestCase):
+
+    def setUp(self):
+        sp.verbose = False
+        self.counts = counts('04_04_10_08_16_03.DAT')
+        self.previous = fit_counts(counts('04_04_10_08_16_02.DAT'))
+
+    def test_attempt_total(self):
+        """ All the fits of an attempt share its evaluations """
+        for max_nfev in (50, 300, 1000):
+            with CountFits() as c:
+                supervised_fit(self.counts, max_nfev=max_nfev,
+                               strategies=[('default', {})])
+            self.assertGreater(len(c.fits), 1)
+            self.assertLessEqual(c.nfev, max_nfev + c.slack)
+            # more than the slack of the last fit, so the budget binds
+            self.assertGreater(c.nfev, c.fits[-1][1] + 1)
+
+    def test_retries_total(self):
+        """ The attempts together stay within the spectrum budget """
+        with CountFits() as c:
+            try:
+                supervised_fit(self.counts, self.previous, max_nfev=200)
+            except ValueError:
+                pass
+        self.assertLessEqual(c.nfev, 200 + c.slack)
+
+    def test_nfev_of_fits(self):
+        """ The nfev of the three fits include rejected warm starts """
+        # no chi-square passes the tolerance, so all warm starts are refitted
+        with CountFits() as c:
+            fits = fit_counts(self.counts, self.previous, chi_tol=0.0)
+        self.assertGreater(len(c.fits), 3)
+        self.assertEqual(sum(s.out.nfev for s in fits), c.nfev)
+
+    def test_unlimited(self):
+        """ A large budget does not change the fits """
+        fits = fit_counts(self.counts)
+        capped = fit_counts(self.counts, max_nfev=10 ** 6)
+        for s, t in zip(fits, capped):
+            self.assertEqual(s.out.nfev, t.out.nfev)
+            self.assertEqual(s.out.params['p1_center'].value,
+                             t.out.params['p1_center'].value)
+
+
+if __name__ == '__main__':
+    unittest.main()
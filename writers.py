@@ -0,0 +1,179 @@
+"""
+description: columnar writers for the results of a folder. Each format is
+written in one bulk write with typed columns for the shifts, peak widths,
+uncertainties, fit status and the DAT header fields, the run parameters as
+file metadata and the best-fit curves as a single (N, 256) array, and the
+lines of output.csv
+author: Rohan Isaac
+"""
+from __future__ import division
+import json
+from collections import OrderedDict
+import numpy as np
+from datfile import CHANNELS, HEADER_DTYPE
+
+# result columns, in the order of output.csv
+VALUE_NAMES = (['F%s' % i for i in range(1, 5)] + ['F_avg'] +
+               ['l%s' % i for i in range(1, 4)] +
+               ['b%s' % i for i in range(1, 5)])
+
+
+def csv_header():
+    """ Header line of output.csv (shifts, avg, peak_widths, status) """
+    return ("Filename," +
+            "".join(["F{0},u_F{0},".format(i) for i in range(1, 5)]) +
+            "F_avg,u_F_avg," +
+            "".join(["l{0},u_l{0},".format(i) for i in range(1, 4)]) +
+            "".join(["b{0},u_b{0},".format(i) for i in range(1, 5)]) +
+            "status\n")
+
+
+def csv_row(f, values, status='ok'):
+    """
+    Line of output.csv for file `f`, values and status from
+    `brillouin_folder.process_file`
+    """
+    return (f + ',' + "".join(["{},{},".format(n, s) for n, s in values]) +
+            status + "\n")
+
+
+def csv_footer(fol, spacing, crossed):
+    """ Lines after the rows of output.csv, the folder and its settings """
+    return "\nFolder{}\nSpacing:{} cm\nCrossed:{}\n".format(fol, spacing,
+                                                           crossed)
+
+
+def result_columns(names, values, errors, status, headers=None):
+    """
+    Typed columns of the results of a folder
+
+    Parameters
+    ----------
+    names : list of string (N,)
+        DAT filenames
+    values, errors : array (N, 12)
+        shifts and peak widths with their uncertainties, nan for files that
+        were not fitted, see `brillouin.results_array`
+    status : list of string (N,)
+        fit status of each file, eg. 'ok', 'retried:bounded' or 'failed',
+        see `supervisor.supervised_fit`
+    headers : np.ndarray of `datfile.HEADER_DTYPE` (N,) (default=None)
+        header fields of the DAT files, added as columns
+
+    Returns
+    -------
+    columns : OrderedDict
+        {column name: np.ndarray (N,)}
+    """
+    values = np.asarray(values, dtype=float).reshape(len(names), -1)
+    errors = np.asarray(errors, dtype=float).reshape(len(names), -1)
+    columns = OrderedDict()
+    columns['filename'] = np.array(names, dtype=str)
+    columns['status'] = np.array(status, dtype=str)
+    for i, name in enumerate(VALUE_NAMES):
+        columns[name] = values[:, i]
+        columns['u_' + name] = errors[:, i]
+    if headers is not None:
+        for name in HEADER_DTYPE.names:
+            columns[name] = np.asarray(headers[name])
+    return columns
+
+
+def curve_array(plots, size=CHANNELS):
+    """
+    Best fit of the inelastic windows of each file on the full channel
+    range, nan outside the windows or where there is no fit
+
+    Parameters
+    ----------
+    plots : list of dict or None (N,)
+        `brillouin.plot_data` of each file
+
+    Returns
+    -------
+    curves : np.ndarray of float32 (N, `size`)
+    """
+    curves = np.full((len(plots), size), np.nan, dtype=np.float32)
+    for i, data in enumerate(plots):
+        if data is None:
+            continue
+        for x, y, fit in data['windows']:
+            curves[i, np.asarray(x, dtype=int)] = fit
+    return curves
+
+
+def write_npz(path, columns, meta, curves=None):
+    """ Compressed numpy archive, the metadata as a JSON string """
+    arrays = dict(columns)
+    arrays['meta'] = np.array(json.dumps(meta))
+    if curves is not None:
+        arrays['curves'] = curves
+    np.savez_compressed(path, **arrays)
+
+
+def write_hdf5(path, columns, meta, curves=None):
+    """
+    HDF5 file with a 'results' group of one dataset per column, the
+    metadata as attributes of the file and a gzip compressed 'curves'
+    dataset. Requires h5py
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("writing hdf5 requires h5py")
+    with h5py.File(path, 'w') as f:
+        for key, value in meta.items():
+            f.attrs[key] = value
+        group = f.create_group('results')
+        for name, col in columns.items():
+            if col.dtype.kind == 'U':
+                col = col.astype('S')
+            group.create_dataset(name, data=col)
+        if curves is not None:
+            f.create_dataset('curves', data=curves, compression='gzip',
+                             chunks=(min(len(curves), 1024) or 1,
+                                     curves.shape[1]))
+
+
+def write_parquet(path, columns, meta, curves=None):
+    """
+    Parquet file with one column per result and a 'curve' list column, the
+    metadata as JSON in the schema metadata. Requires pyarrow
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("writing parquet requires pyarrow")
+    arrays = [pa.array(col.tolist() if col.dtype.kind in 'SU' else col)
+              for col in columns.values()]
+    names = list(columns.keys())
+    if curves is not None:
+        arrays.append(pa.array([None if np.isnan(c).all() else c.tolist()
+                                for c in curves],
+                               type=pa.list_(pa.float32())))
+        names.append('curve')
+    table = pa.Table.from_arrays(arrays, names=names)
+    table = table.replace_schema_metadata({'brillouin': json.dumps(meta)})
+    pq.write_table(table, path, compression='snappy')
+
+
+# format: (file extension, writer), add entries here for other formats
+WRITERS = OrderedDict([('npz', ('.npz', write_npz)),
+                       ('hdf5', ('.h5', write_hdf5)),
+                       ('parquet', ('.parquet', write_parquet))])
+
+
+def write_results(base, fmt, columns, meta, curves=None):
+    """
+    Write the results with the writer of `fmt` to `base` plus the format's
+    extension
+
+    Returns
+    -------
+    path : string
+    """
+    ext, writer = WRITERS[fmt]
+    path = base + ext
+    writer(path, columns, meta, curves)
+    return path